@@ -0,0 +1,241 @@
+#!/usr/bin/env python3
+
+"""
+Benchmarks the model fitting and evaluation, data assembly, scenario application and a full multi-year run, offline,
+on the bundled test dataset and synthetic larger inputs. Records the (best of n) time and peak memory of each and
+compares them against stored baselines, failing if any are exceeded by more than the tolerance. Times are only
+comparable on the machine the baselines were recorded on, so regenerate them there first (with --save)
+"""
+
+import os
+import io
+import sys
+import json
+import time
+import argparse
+import tempfile
+import subprocess
+import tracemalloc
+import contextlib
+import numpy as np
+import pandas as pd
+
+import simim.models as models
+import simim.synthetic as synthetic
+import simim.data_apis as data_apis
+import simim.simim as simim
+from simim.od import OD
+from simim.panel import Panel
+from simim.scenario import Scenario
+from simim.utils import dist_weighted_sum
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+BASELINE = os.path.join(ROOT, "tests", "data", "benchmarks.json")
+
+def _zones(table):
+  """ Per-zone values from a table in the test dataset schema """
+  return table.groupby("O_GEOGRAPHY_CODE")[["PEOPLE"]].first() \
+    .join(table.groupby("D_GEOGRAPHY_CODE")[["HOUSEHOLDS", "JOBS"]].first()).rename_axis("GEOGRAPHY_CODE")
+
+def run_inputs(table, years, seed=0):
+  """ The (prepared) OD data, migration rates and per-year inputs to simim.project, for an offline run """
+  rng = np.random.RandomState(seed)
+  od_2011 = OD.from_table(table, ["MIGRATIONS", "DISTANCE"])
+  geogs = od_2011.geogs
+  zones = _zones(table).reindex(geogs)
+  areas = rng.uniform(50, 3000, len(geogs))
+  od_2011.set_origin("O_AREA_KM2", areas)
+  od_2011.set_destination("D_AREA_KM2", areas)
+  movers = pd.DataFrame({"PEOPLE": zones.PEOPLE.values, "MIGRATIONS": od_2011.matrix("MIGRATIONS").sum(axis=1)}, index=pd.Index(geogs, name="GEOGRAPHY_CODE"))
+  movers["MIGRATION_RATE"] = movers["MIGRATIONS"] / movers["PEOPLE"]
+  panel = Panel(geogs, years)
+  growth = 1.0 + 0.005 * (panel.years - 2016)[:, np.newaxis]
+  panel.data["PEOPLE"] = zones.PEOPLE.values * growth
+  panel.data["HOUSEHOLDS"] = zones.HOUSEHOLDS.values * growth
+  panel.data["JOBS"] = np.tile(zones.JOBS.values.astype(float), (len(panel.years), 1))
+  panel.data["JOBS_PER_WORKING_AGE_PERSON"] = panel.data["JOBS"] / (0.6 * panel.data["PEOPLE"])
+  panel.data["GVA"] = np.tile(rng.uniform(1000, 20000, len(geogs)), (len(panel.years), 1))
+  return od_2011, movers, panel
+
+def full_run(table, output_dir, model_type="gravity"):
+  """ A mocked (offline) multi-year simim run, with the test scenario """
+  params = {"coverage": "GB", "model_type": model_type, "model_subtype": "pow", "observation": "MIGRATIONS",
+            "emitters": ["PEOPLE"] if model_type == "gravity" else ["GEOGRAPHY_CODE"],
+            "attractors": ["HOUSEHOLDS", "JOBS_DISTWEIGHTED"], "cost": "DISTANCE", "base_projection": "ppp",
+            "scenario": os.path.join(ROOT, "data", "scenarios", "test.csv"), "start_year": 2018, "end_year": 2025,
+            "output_dir": output_dir, "checkpoint": False}
+  simim.prefix_factors(params)
+  scenario_data = Scenario(params["scenario"], params["emitters"] + params["attractors"])
+  od_2011, movers, panel = run_inputs(table, simim.panel_years(params))
+  # a fresh (empty) fit cache each time, so the fit is always timed
+  return lambda: simim.project(dict(params, cache_dir=tempfile.mkdtemp(dir=output_dir)), scenario_data, od_2011, movers, panel, data_apis.Output(params))
+
+def benchmarks(output_dir):
+  """ name -> benchmark function (taking no arguments) """
+  table = pd.read_csv(os.path.join(ROOT, "tests", "data", "testdata.csv.gz")).sort_values(["D_GEOGRAPHY_CODE", "O_GEOGRAPHY_CODE"])
+  large = synthetic.dataset(1000)
+  tests = {}
+
+  # in a fresh interpreter, as for a (headless) run
+  tests["import"] = lambda: subprocess.run([sys.executable, "-c", "import simim.simim, simim.ensemble"], check=True)
+
+  for size, data in [("lad", table), ("n1000", large)]:
+    od = OD.from_table(data, ["MIGRATIONS", "DISTANCE"], origins=["PEOPLE"], destinations=["HOUSEHOLDS", "JOBS"])
+    people, households, jobs = od.zones("PEOPLE"), od.zones("HOUSEHOLDS"), od.zones("JOBS")
+    # model type, emitter/attractor columns and the (changed) values to evaluate with
+    fits = [("gravity", "PEOPLE", ["HOUSEHOLDS", "JOBS"], people, [households * 1.01, jobs]),
+            ("production", "O_GEOGRAPHY_CODE", ["HOUSEHOLDS", "JOBS"], None, [households * 1.01, jobs]),
+            ("attraction", "PEOPLE", "D_GEOGRAPHY_CODE", people * 1.01, None),
+            ("doubly", "O_GEOGRAPHY_CODE", "D_GEOGRAPHY_CODE", None, None)]
+    for model_type, xo_cols, xd_cols, xo, xd in fits:
+      # the synthetic flows follow a power law, to which exponential decay can't be fitted
+      for model_subtype in ["pow", "exp"] if size == "lad" else ["pow"]:
+        tests["fit/%s/%s/%s" % (model_type, model_subtype, size)] = lambda model_type=model_type, model_subtype=model_subtype, od=od, xo_cols=xo_cols, xd_cols=xd_cols: \
+          models.Model(model_type, model_subtype, od, "MIGRATIONS", xo_cols, xd_cols, "DISTANCE")
+      # (doubly-constrained flows don't depend on the emitter/attractor values)
+      if model_type != "doubly":
+        model = models.Model(model_type, "pow", od, "MIGRATIONS", xo_cols, xd_cols, "DISTANCE")
+        tests["evaluate/%s/%s" % (model_type, size)] = lambda model=model, xo=xo, xd=xd: model(xo, xd)
+
+    zones = _zones(data).reset_index()
+    pairs = data[["O_GEOGRAPHY_CODE", "D_GEOGRAPHY_CODE", "DISTANCE"]]
+    tests["merge_factor/%s" % size] = lambda pairs=pairs, zones=zones: simim._merge_factor(pairs, zones, ["PEOPLE", "HOUSEHOLDS", "JOBS"])
+    tests["dist_weighted_sum/%s" % size] = lambda od=od: dist_weighted_sum(od.copy(), "JOBS", 20.0, simim._decay)
+
+  scenario = Scenario(os.path.join(ROOT, "data", "scenarios", "test.csv"), ["D_HOUSEHOLDS", "D_JOBS"])
+  od = OD.from_table(table, ["DISTANCE"])
+  od.set_factors(_zones(table).reset_index(), ["HOUSEHOLDS", "JOBS"])
+  tests["scenario_apply/lad"] = lambda: [scenario.apply(od.copy(), year) for year in range(2020, 2030)]
+
+  for model_type in ["gravity", "production"]:
+    tests["run/%s/lad" % model_type] = full_run(table, output_dir, model_type)
+  return tests
+
+def measure(function, repeat, warmup=True):
+  """
+  Best per-call time (s) of repeat runs, after a warm-up call, and the peak memory (MB) allocated by a separate (traced)
+  call. Quick functions are called enough times per run to take at least 0.1s
+  """
+  times = []
+  number = 1
+  with contextlib.redirect_stdout(io.StringIO()):
+    if warmup:
+      start = time.perf_counter()
+      function()
+      number = max(1, int(0.1 / (time.perf_counter() - start)))
+    for _ in range(repeat):
+      start = time.perf_counter()
+      for _ in range(number):
+        function()
+      times.append((time.perf_counter() - start) / number)
+    tracemalloc.start()
+    function()
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+  return min(times), peak / 1024 / 1024
+
+# model type, emitter and attractor columns
+_scaling_models = [("gravity", "PEOPLE", ["HOUSEHOLDS", "JOBS"]), ("production", "O_GEOGRAPHY_CODE", ["HOUSEHOLDS", "JOBS"]),
+                   ("attraction", "PEOPLE", "D_GEOGRAPHY_CODE"), ("doubly", "O_GEOGRAPHY_CODE", "D_GEOGRAPHY_CODE")]
+
+def _fit_mb(model_type, pairs):
+  """ Rough peak memory of fitting the model to the given number of OD pairs (as measured at LAD scale) """
+  return pairs * {"gravity": 300, "production": 120, "attraction": 260, "doubly": 100}[model_type] / 1024 / 1024
+
+def scaling(sizes, repeat, memory_mb, cutoff=None, neighbours=None):
+  """
+  Reports how the time and peak memory of generating synthetic data, and fitting and evaluating each model type,
+  grow with the number of zones. Fits that would need more than (half of) memory_mb are skipped. If cutoff (km)
+  and/or neighbours are given the (sparse) OD data contains only those pairs
+  """
+  results = {}
+  # so that one-off (e.g. import) costs aren't timed
+  with contextlib.redirect_stdout(io.StringIO()):
+    models.Model("gravity", "pow", synthetic.od(10), "MIGRATIONS", "PEOPLE", "HOUSEHOLDS", "DISTANCE")
+  print("%-12s %8s %10s %10s %10s %10s" % ("model", "zones", "fit(s)", "peak(MB)", "eval(s)", "peak(MB)"))
+  for n in sizes:
+    elapsed, peak = measure(lambda: synthetic.od(n, cutoff=cutoff, neighbours=neighbours), 1, warmup=False)
+    od = synthetic.od(n, cutoff=cutoff, neighbours=neighbours)
+    print("%-12s %8d %10.4f %10.1f (%d pairs)" % ("(generate)", n, elapsed, peak, len(od)))
+    results.setdefault("generate", []).append((n, elapsed, peak))
+    values = { "PEOPLE": od.zones("PEOPLE") * 1.01, "HOUSEHOLDS": od.zones("HOUSEHOLDS") * 1.01, "JOBS": od.zones("JOBS") }
+    for model_type, xo_cols, xd_cols in _scaling_models:
+      if _fit_mb(model_type, len(od)) > memory_mb / 2:
+        print("%-12s %8d %10s (needs ~%.0fMB)" % (model_type, n, "skipped", _fit_mb(model_type, len(od))))
+        continue
+      fit_time, fit_peak = measure(lambda: models.Model(model_type, "pow", od, "MIGRATIONS", xo_cols, xd_cols, "DISTANCE"), repeat, warmup=False)
+      model = models.Model(model_type, "pow", od, "MIGRATIONS", xo_cols, xd_cols, "DISTANCE")
+      xo = values["PEOPLE"] if model_type in ["gravity", "attraction"] else None
+      xd = [values[col] for col in xd_cols] if model_type in ["gravity", "production"] else None
+      eval_time, eval_peak = measure(lambda: model(xo, xd), repeat)
+      print("%-12s %8d %10.4f %10.1f %10.4f %10.1f" % (model_type, n, fit_time, fit_peak, eval_time, eval_peak))
+      results.setdefault(model_type, []).append((n, fit_time, fit_peak, eval_time, eval_peak))
+
+  # growth as the exponent of n (2 is quadratic)
+  print("%-12s %10s %10s %10s %10s" % ("growth (n^)", "fit/gen", "peak", "eval", "peak"))
+  for name, rows in results.items():
+    if len(rows) > 1:
+      rows = np.array(rows)
+      exponents = [np.polyfit(np.log(rows[:, 0]), np.log(rows[:, i]), 1)[0] for i in range(1, rows.shape[1])]
+      print("%-12s" % name + "".join(" %10.2f" % e for e in exponents))
+  return results
+
+def main(args):
+  if args.scaling:
+    scaling(args.scaling, args.repeat, args.memory or os.sysconf("SC_PAGE_SIZE") * os.sysconf("SC_PHYS_PAGES") / 1024 / 1024,
+            args.cutoff, args.neighbours)
+    return 0
+
+  baseline = {}
+  if os.path.isfile(args.baseline):
+    with open(args.baseline) as baseline_file:
+      baseline = json.load(baseline_file)
+
+  results = {}
+  regressions = []
+  with tempfile.TemporaryDirectory() as output_dir:
+    with contextlib.redirect_stdout(io.StringIO()):
+      tests = benchmarks(output_dir)
+    print("%-32s %10s %10s %7s %10s %10s %7s" % ("benchmark", "time(s)", "baseline", "ratio", "peak(MB)", "baseline", "ratio"))
+    for name, function in tests.items():
+      if args.filter and not any(f in name for f in args.filter):
+        continue
+      elapsed, peak = measure(function, args.repeat)
+      results[name] = {"time": elapsed, "peak_mb": peak}
+      base = baseline.get(name)
+      if base is None:
+        print("%-32s %10.4f %10s %7s %10.1f %10s %7s" % (name, elapsed, "-", "-", peak, "-", "-"))
+        continue
+      time_ratio, peak_ratio = elapsed / base["time"], peak / base["peak_mb"]
+      # ratios of very short times (or small allocations, e.g. of the import, which is in a subprocess) are mostly noise
+      slower = time_ratio > args.tolerance and max(elapsed, base["time"]) >= args.min_time
+      larger = peak_ratio > args.memory_tolerance and max(peak, base["peak_mb"]) >= 1.0
+      failed = slower or larger
+      print("%-32s %10.4f %10.4f %7.2f %10.1f %10.1f %7.2f%s" % (name, elapsed, base["time"], time_ratio, peak, base["peak_mb"], peak_ratio, "  REGRESSION" if failed else ""))
+      if failed:
+        regressions.append(name)
+
+  if args.save:
+    baseline.update(results)
+    with open(args.baseline, "w") as baseline_file:
+      json.dump(baseline, baseline_file, indent=2, sort_keys=True)
+    print("baseline saved to %s" % args.baseline)
+  elif regressions:
+    print("%d regression(s): %s" % (len(regressions), ", ".join(regressions)))
+    return 1
+  return 0
+
+if __name__ == "__main__":
+  parser = argparse.ArgumentParser(description="spatial interaction model of internal migration: benchmarks")
+  parser.add_argument("-k", "--filter", nargs="*", metavar="name", help="only run benchmarks whose names contain any of these")
+  parser.add_argument("-n", "--repeat", type=int, default=3, help="number of timed runs of each benchmark (the best is reported)")
+  parser.add_argument("-b", "--baseline", default=BASELINE, metavar="baseline-file", help="the stored baselines (json)")
+  parser.add_argument("-t", "--tolerance", type=float, default=1.5, help="the maximum ratio of time to the baseline")
+  parser.add_argument("--min-time", type=float, default=0.01, metavar="s", help="times are only compared if either this or the baseline is at least this long")
+  parser.add_argument("-m", "--memory-tolerance", type=float, default=1.2, help="the maximum ratio of peak memory to the baseline")
+  parser.add_argument("-s", "--save", action="store_true", help="store the results as the new baselines")
+  parser.add_argument("-z", "--scaling", nargs="+", type=int, metavar="zones", help="instead, report how fitting and evaluation scale with these numbers of (synthetic) zones")
+  parser.add_argument("--cutoff", type=float, metavar="km", help="for scaling, only model OD pairs within this distance")
+  parser.add_argument("--neighbours", type=int, metavar="k", help="for scaling, only model OD pairs to each origin's k nearest zones")
+  parser.add_argument("--memory", type=float, metavar="MB", help="the memory available for the scaling fits (defaults to physical memory)")
+  sys.exit(main(parser.parse_args()))
@@ -0,0 +1,33 @@
+#!/usr/bin/env python3
+
+""" runs model configuration(s) against multiple scenarios in parallel """
+
+import os
+import time
+import json
+import argparse
+from simim import ensemble
+
+def main(configs, scenarios, processes):
+
+  for params in configs:
+    if not os.path.isdir(params["output_dir"]):
+      print("Creating output directory %s" % params["output_dir"])
+      os.makedirs(params["output_dir"], exist_ok=True)
+
+  start_time = time.time()
+  output_files = ensemble.run(configs, scenarios, processes)
+  print("%d run(s) done. Exec time(s): " % len(output_files), time.time() - start_time)
+
+if __name__ == "__main__":
+  parser = argparse.ArgumentParser(description="spatial interaction model of internal migration: scenario ensemble")
+  parser.add_argument("-c", "--config", required=True, nargs="+", type=str, metavar="config-file", help="the model configuration file(s) (json). See config/default.json")
+  parser.add_argument("-s", "--scenarios", nargs="*", type=str, metavar="scenario-file", help="scenario file(s) in the configured scenario_dir, overriding the configured scenario")
+  parser.add_argument("-n", "--processes", type=int, help="the number of worker processes (defaults to the number of CPUs)")
+  args = parser.parse_args()
+
+  configs = []
+  for config in args.config:
+    with open(config) as config_file:
+      configs.append(json.load(config_file))
+  main(configs, args.scenarios, args.processes)
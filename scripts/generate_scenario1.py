@@ -2,7 +2,7 @@ import os
 import numpy as np
 import pandas as pd
 import simim.data_apis as data_apis
-import simim.scenario as scenario
+import simim.scenario_builder as scenario_builder
 
 """ 
 Scenario 1 ("MISTRAL Arc Scenarios", Usher & Hickford by email 3/19):
@@ -63,20 +63,11 @@ params = {
 
 input_data = data_apis.Instance(params)
 
-h = input_data.get_households(2019, g_out)
-scen = pd.DataFrame()
-for y in range(2020,2051):
-  hprev = h.copy()
-  h = input_data.get_households(y, g_out)
-  delta = h.merge(hprev, on="GEOGRAPHY_CODE")
-  delta["D_HOUSEHOLDS"] = -0.3*(delta.HOUSEHOLDS_x - delta.HOUSEHOLDS_y)
-  delta = delta.drop(["HOUSEHOLDS_x", "PROJECTED_YEAR_NAME_y", "HOUSEHOLDS_y"], axis=1).rename({"PROJECTED_YEAR_NAME_x": "PROJECTED_YEAR_NAME"}, axis=1)
-  redist = -delta["D_HOUSEHOLDS"].sum() / 4
-  newtowns = pd.DataFrame({"GEOGRAPHY_CODE": g_in, "PROJECTED_YEAR_NAME": y, "D_HOUSEHOLDS": 4561 + redist})
-  newtowns.loc[newtowns.GEOGRAPHY_CODE=="E07000004", "D_HOUSEHOLDS"] += 4651
-  delta = delta.append(newtowns, sort=False)
-  scen = scen.append(delta, sort=False)
-
-scen.to_csv("data/scenarios/scenario1.csv", index=False)
-
+years = range(2020,2051)
+households = pd.concat([input_data.get_households(y, g_out) for y in range(years[0] - 1, years[-1] + 1)])
+# 30% of baseline growth in existing settlements goes to the new ones...
+redist = scenario_builder.redistribute(scenario_builder.annual_change(households, "HOUSEHOLDS"), "HOUSEHOLDS", 0.3, g_in)
+# ...which each also grow by 4561 households per annum (Aylesbury Vale has two)
+newtowns = scenario_builder.settlements(g_in, years, "HOUSEHOLDS", [4561 + 4651 if g == "E07000004" else 4561 for g in g_in])
 
+scenario_builder.write("data/scenarios/scenario1.csv", redist, newtowns)
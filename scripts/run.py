@@ -6,7 +6,6 @@ import os
 import time
 import numpy as np
 from simim import simim
-import simim.visuals as visuals
 from simim.utils import od_matrix, get_config
 
 def main(params):
@@ -39,12 +38,14 @@ def main(params):
   # visualise
   year = params.get("end_year", data.snpp.max_year("en"))
   if params["graphics"]:
+    # plotting dependencies are only imported when needed
+    import simim.visuals as visuals
     # fig.suptitle("UK LAD SIMs using population as emitter, households as attractor")
     v = visuals.Visual(2,3)
 
-    v.scatter((0,0), model.dataset.MIGRATIONS, model.impl.yhat, "b.", title="%d %s migration model fit: R^2=%.2f" \
+    v.scatter((0,0), model.dataset["MIGRATIONS"], model.dataset["MODEL_MIGRATIONS"], "b.", title="%d %s migration model fit: R^2=%.2f" \
       % (year, params["model_type"], model.impl.pseudoR2))
-    v.line((0,0), [0,max(model.dataset.MIGRATIONS)], [0,max(model.dataset.MIGRATIONS)], "k", xlabel="Observed", ylabel="Model", linewidth=0.25)
+    v.line((0,0), [0,max(model.dataset["MIGRATIONS"])], [0,max(model.dataset["MIGRATIONS"])], "k", xlabel="Observed", ylabel="Model", linewidth=0.25)
 
     # N.Herts = "E07000099"
     # Cambridge "E07000008"
@@ -58,7 +59,7 @@ def main(params):
     # v.polygons((0,2), gdf, xlim=[120000, 670000], ylim=[0, 550000], linewidth=0.25, edgecolor="darkgrey", facecolor="lightgrey")
     # v.polygons((0,2), gdf[gdf.lad16cd.isin(arclads)], xlim=[120000, 670000], ylim=[0, 550000], linewidth=0.25, edgecolor="darkgrey", facecolor="orange")
     # v.polygons((0,2), gdf[gdf.lad16cd.isin(ctrlads)], xlim=[120000, 670000], ylim=[0, 550000], linewidth=0.25, edgecolor="darkgrey", facecolor="red")
-    gdf = data.get_shapefile().merge(delta)
+    gdf = data.get_geometries().merge(delta)
     # net emigration in blue
     net_out = gdf[gdf.net_delta < 0.0]
     v.polygons((0,2), net_out, title="%s migration model implied impact on population" % params["model_type"], xlim=[120000, 670000], ylim=[0, 550000], 
@@ -13,6 +13,7 @@ Change the housing supply and evaluate the function -> modified OD matrix
 Apply modified OD matrix to existing population projection (principal or variant)
 """
 import os
+import glob
 import numpy as np
 import pandas as pd
 import matplotlib.pyplot as plt
@@ -25,8 +26,10 @@ def main(params):
 
   v = visuals.Visual(1, 2)
 
-  data = pd.read_csv(os.path.join(params["output_dir"], 
-                                  "simim_%s_%s_%s" % (params["model_type"], params["base_projection"], params["scenario"])))
+  # the most recent output for the model and scenario (see data_apis.Output.output_file)
+  outputs = glob.glob(os.path.join(params["output_dir"], "simim_%s_%s_%s_%s_*.csv" % (params["model_type"], params["model_subtype"],
+                                   params["base_projection"], os.path.splitext(params["scenario"])[0])))
+  data = pd.read_csv(max(outputs, key=os.path.getmtime))
 
   lads = pd.read_csv("data/scenarios/camkox_lads.csv").set_index("geo_code")
 
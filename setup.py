@@ -27,9 +27,10 @@ setuptools.setup(name='simim',
   author='Andrew P Smith',
   author_email='a.p.smith@leeds.ac.uk',
   packages=setuptools.find_packages(),
+  python_requires='>=3.8',
   install_requires=['numpy',
                     'pandas',
-                    'geopandas',
+                    'geopandas>=0.9',
                     'scipy',
                     'spint',
                     'ukpopulation',
@@ -1,3 +1,3 @@
-from pkg_resources import get_distribution
+from importlib.metadata import version
 
-__version__ = get_distribution("simim").version
\ No newline at end of file
+__version__ = version("simim")
\ No newline at end of file
@@ -0,0 +1,153 @@
+"""
+cache.py
+Persistent on-disk caching of fitted models (keyed by the content of their inputs) and of input data.
+Files are written atomically (to a temporary file then renamed) so that concurrent runs can share a cache directory
+"""
+
+import os
+import glob
+import json
+import hashlib
+import tempfile
+import numpy as np
+import pandas as pd
+
+import simim.glm as glm
+
+def content_hash(*items):
+  """ Hash of the given (JSON-serialisable) values and/or arrays, including array dtypes and shapes """
+  h = hashlib.sha256()
+  for item in items:
+    if isinstance(item, np.ndarray):
+      # object arrays (e.g. geography codes) are hashed by value not by reference
+      a = np.ascontiguousarray(item.astype(str) if item.dtype == object else item)
+      h.update(json.dumps([a.dtype.str, a.shape]).encode("utf-8"))
+      h.update(a.data)
+    else:
+      h.update(json.dumps(item).encode("utf-8"))
+  return h.hexdigest()
+
+def atomic_save(filename, **arrays):
+  """ Saves arrays to an npz file via a temporary file in the same directory, so readers never see a partial file """
+  fd, tmpfile = tempfile.mkstemp(dir=os.path.dirname(filename), suffix=".tmp")
+  try:
+    with os.fdopen(fd, "wb") as f:
+      np.savez(f, **arrays)
+    os.replace(tmpfile, filename)
+  except BaseException:
+    os.remove(tmpfile)
+    raise
+
+def save_table(filename, table):
+  """ Saves a table of numeric values (with an index and column labels) in binary form """
+  columns = np.asarray(table.columns.values)
+  # (string) labels are stored as fixed-width unicode, which unlike object arrays can be loaded without pickle
+  atomic_save(filename, index=np.asarray(table.index.values).astype(str), columns=columns.astype(str) if columns.dtype == object else columns,
+    values=table.values, index_name=str(table.index.name))
+
+def load_table(filename):
+  """ Loads a table saved by save_table, returns None if not cached """
+  try:
+    with np.load(filename) as data:
+      columns = data["columns"]
+      if columns.dtype.kind == "U":
+        columns = columns.astype(object)
+      return pd.DataFrame(data["values"], index=pd.Index(data["index"].astype(object), name=str(data["index_name"])), columns=columns)
+  except FileNotFoundError:
+    return None
+
+def save_blobs(filename, index, blobs, meta=""):
+  """ Saves variable-length binary values (e.g. WKB geometries) by index, concatenated so they can be loaded without pickle """
+  offsets = np.cumsum([0] + [len(blob) for blob in blobs])
+  atomic_save(filename, index=np.asarray(index, dtype=str), offsets=offsets, data=np.frombuffer(b"".join(blobs), dtype=np.uint8), meta=meta)
+
+def load_blobs(filename):
+  """ Loads the index, binary values and meta string saved by save_blobs, returns None if not cached """
+  try:
+    with np.load(filename) as data:
+      offsets = data["offsets"]
+      blob = data["data"].tobytes()
+      return data["index"].astype(object), [blob[start:end] for start, end in zip(offsets[:-1], offsets[1:])], str(data["meta"])
+  except FileNotFoundError:
+    return None
+
+def save_matrix(filename, matrix, index):
+  """ Saves a (square) matrix and its index as npy files, so that the matrix can be memory-mapped by load_matrix """
+  index_file = filename + ".index.npy"
+  for name, array in [(index_file, np.asarray(index, dtype=str)), (filename, matrix)]:
+    fd, tmpfile = tempfile.mkstemp(dir=os.path.dirname(filename), suffix=".tmp")
+    try:
+      with os.fdopen(fd, "wb") as f:
+        np.save(f, array)
+      os.replace(tmpfile, name)
+    except BaseException:
+      os.remove(tmpfile)
+      raise
+
+def load_matrix(filename, index):
+  """
+  Returns a read-only memory map of a matrix saved by save_matrix (so no data is copied or read until used),
+  or None if not cached or saved with a different index
+  """
+  try:
+    saved_index = np.load(filename + ".index.npy")
+    matrix = np.load(filename, mmap_mode="r")
+  except FileNotFoundError:
+    return None
+  if not np.array_equal(saved_index, np.asarray(index, dtype=str)):
+    return None
+  return matrix
+
+class FitCache:
+  """
+  Cache of model fits (params, yhat, pseudoR2, SRMSE) stored as one npz file per fit in cache_dir.
+  When the total size exceeds max_bytes the least recently used fits are evicted
+  """
+  def __init__(self, cache_dir, max_bytes=1024**3):
+    self.cache_dir = cache_dir
+    self.max_bytes = max_bytes
+    os.makedirs(self.cache_dir, exist_ok=True)
+
+  @staticmethod
+  def key(model_type, model_subtype, solver, y_col, xo_cols, xd_cols, cost_col, y, xo, xd, cost):
+    return content_hash(model_type, model_subtype, solver, y_col, xo_cols, xd_cols, cost_col, y, xo, xd, cost)
+
+  def filename(self, key):
+    return os.path.join(self.cache_dir, "fit_%s.npz" % key)
+
+  def get(self, key):
+    """ Returns the cached fit as a glm.Fit, or None if not cached """
+    filename = self.filename(key)
+    try:
+      with np.load(filename) as data:
+        fit = glm.Fit(data["params"], data["yhat"], int(data["n_iter"]), float(data["pseudoR2"]), float(data["SRMSE"]))
+      # mark as recently used
+      os.utime(filename)
+    except FileNotFoundError:
+      return None
+    return fit
+
+  def put(self, key, fit, n_iter):
+    atomic_save(self.filename(key), params=fit.params, yhat=np.asarray(fit.yhat).ravel(), n_iter=n_iter,
+      pseudoR2=fit.pseudoR2, SRMSE=fit.SRMSE)
+    self.evict()
+
+  def evict(self):
+    """ Removes least recently used fits until the cache is within its size limit """
+    entries = []
+    for filename in glob.glob(os.path.join(self.cache_dir, "fit_*.npz")):
+      try:
+        stat = os.stat(filename)
+      except FileNotFoundError:
+        # removed by another process
+        continue
+      entries.append((stat.st_mtime, stat.st_size, filename))
+    total = sum(size for _, size, _ in entries)
+    for _, size, filename in sorted(entries):
+      if total <= self.max_bytes:
+        break
+      try:
+        os.remove(filename)
+      except FileNotFoundError:
+        pass
+      total -= size
@@ -2,30 +2,133 @@
 data download functionality
 """
 import os
-import requests
 import zipfile
 import re
 import warnings
+import json
 
 import numpy as np
 import pandas as pd
-import geopandas as gpd
 
-import ukcensusapi.Nomisweb as Nomisweb
-import ukcensusapi.NRScotland as NRScotland
-import ukcensusapi.NISRA as NISRA
+import simim.utils as utils
+import simim.cache as cache
+from simim.panel import Panel
+from simim.extrapolation import Extrapolation
+
+class Output():
+  """ 
+  Accumulates the custom SNPP variant produced by a model run, stored as year x zone arrays (see panel.Panel) of the
+  values in COLUMNS. The (long-format) table is only constructed when needed, e.g. for export
+  """
+  # the per-zone values recorded for each year
+  COLUMNS = ["PEOPLE", "PEOPLE_SNPP", "net_delta"]
+  # the configuration the output depends on, other than the model type, base projection and scenario
+  RUN_PARAMS = ["model_subtype", "observation", "emitters", "attractors", "cost", "coverage", "start_year", "end_year",
+                "calibration_year", "refit", "distance_dtype", "od_cutoff", "od_neighbours"]
 
-import ukpopulation.myedata as MYEData
-import ukpopulation.snppdata as SNPPData
-import ukpopulation.nppdata as NPPData
-import ukpopulation.snhpdata as SNHPData
+  def __init__(self, params):
+    if not os.path.isdir(params["output_dir"]):
+      raise ValueError("Output directory %s not found" % params["output_dir"])
 
-import ukpopulation.utils as ukpoputils
+    # kept by reference as the run's years may not yet be resolved
+    self.params = params
+    # csv or parquet (which requires pyarrow or fastparquet)
+    self.output_format = params.get("output_format", "csv")
+    if self.output_format not in ["csv", "parquet"]:
+      raise ValueError("invalid output format %s (must be csv or parquet)" % self.output_format)
+    self.variant = None
 
-import simim.utils as utils
+  @property
+  def output_file(self):
+    """
+    Named by model type and subtype, base projection and scenario, plus a hash of the rest of the configuration, so
+    that runs with different configurations don't overwrite each other
+    """
+    params = self.params
+    name = "simim_%s_%s_%s_%s_%s.%s" % (params["model_type"], params.get("model_subtype"), params["base_projection"],
+      os.path.splitext(os.path.basename(params["scenario"]))[0], cache.content_hash([params.get(p) for p in Output.RUN_PARAMS])[:8],
+      self.output_format)
+    return os.path.join(params["output_dir"], name)
+
+  def reserve(self, geogs, years):
+    """ Preallocates the output for the geographies over the (inclusive) range of years """
+    variant = Panel(geogs, years)
+    for column in Output.COLUMNS:
+      variant.data[column] = np.full((len(variant.years), len(variant.geogs)), np.nan)
+    # the years for which output has been appended
+    variant.data["written"] = np.zeros(len(variant.years), dtype=bool)
+    if self.variant is not None:
+      # keep anything already written
+      rows = self.variant.years - variant.years[0]
+      for name, values in self.variant.data.items():
+        variant.data[name][rows] = values
+    self.variant = variant
+
+  def append_output(self, dataset, year):
+    """ Records the given year's values from a per-zone table """
+    if self.variant is None:
+      self.reserve(dataset.GEOGRAPHY_CODE.values, [year, year])
+    elif not self.variant.years[0] <= year <= self.variant.years[-1]:
+      self.reserve(self.variant.geogs, [min(year, self.variant.years[0]), max(year, self.variant.years[-1])])
+    row = self.variant.row(year)
+    cols = self.variant.index.get_indexer(dataset.GEOGRAPHY_CODE.values)
+    if (cols < 0).any():
+      raise ValueError("geography code(s) not in output: %s" % str(dataset.GEOGRAPHY_CODE.values[cols < 0][:5]))
+    for column in Output.COLUMNS:
+      self.variant.data[column][row, cols] = dataset[column].values
+    self.variant.data["written"][row] = True
+
+  @property
+  def custom_snpp_variant(self):
+    """ The output as a long-format table, by year then geography """
+    if self.variant is None:
+      return pd.DataFrame(columns=["GEOGRAPHY_CODE"] + Output.COLUMNS + ["PROJECTED_YEAR_NAME"])
+    rows = np.flatnonzero(self.variant.data["written"])
+    table = pd.DataFrame({"GEOGRAPHY_CODE": np.tile(self.variant.geogs, len(rows))})
+    for column in Output.COLUMNS:
+      table[column] = self.variant.data[column][rows].ravel()
+    table["PROJECTED_YEAR_NAME"] = np.repeat(self.variant.years[rows], len(self.variant.geogs))
+    return table
 
-class Instance():
+  def summarise_output(self, scenario):
+    written = self.variant.years[self.variant.data["written"]]
+    horizon = written.max()
+    scen_horizon = min(horizon, scenario.data.YEAR.max())
+    print("Cumulative scenario at %d" % scen_horizon)
+    print(scenario.data[scenario.data.YEAR == scen_horizon])
+    print("Summary at horizon year: %d" % horizon)
+    print("In-region population changes:")
+    at_horizon = self.variant.get(horizon, Output.COLUMNS, self.variant.geogs)
+    at_horizon["PROJECTED_YEAR_NAME"] = horizon
+    inreg = at_horizon[at_horizon.GEOGRAPHY_CODE.isin(scenario.geographies())].drop("net_delta", axis=1) 
+    print("TOTAL: %.0f baseline vs %.0f scenario (increase of %.0f)"
+      % (inreg.PEOPLE_SNPP.sum(), inreg.PEOPLE.sum(), inreg.PEOPLE.sum() - inreg.PEOPLE_SNPP.sum()))
+    print(inreg)
+
+    print("10 largest migration origins:")
+    print(at_horizon.nsmallest(10, "net_delta").drop("net_delta", axis=1))
+
+  def write_output(self):
+    """ Writes the output (as a long-format table) to output_file, in the configured output_format """
+    table = self.custom_snpp_variant.drop("net_delta", axis=1)
+    if self.output_format == "parquet":
+      table.to_parquet(self.output_file, index=False)
+    else:
+      table.to_csv(self.output_file, index=False)
+
+class Instance(Output):
+  """ Input data sources, plus the model output """
   def __init__(self, params):
+    # the data source packages are only imported when needed, so that Output can be used (e.g. by ensemble worker
+    # processes) without the cost of importing them
+    import ukcensusapi.Nomisweb as Nomisweb
+    import ukcensusapi.NRScotland as NRScotland
+    import ukcensusapi.NISRA as NISRA
+    import ukpopulation.myedata as MYEData
+    import ukpopulation.snppdata as SNPPData
+    import ukpopulation.nppdata as NPPData
+    import ukpopulation.snhpdata as SNHPData
+    import ukpopulation.utils as ukpoputils
 
     self.coverage = { "EW": ukpoputils.EW, "GB": ukpoputils.GB, "UK": ukpoputils.UK }.get(params["coverage"]) 
     if not self.coverage:
@@ -43,16 +146,18 @@ class Instance():
     # households
     self.baseline = params["base_projection"]
 
-    if not os.path.isdir(params["output_dir"]):
-      raise ValueError("Output directory %s not found" % params["output_dir"])
-
-    self.output_file = os.path.join(params["output_dir"], "simim_%s_%s_%s" % (params["model_type"], params["base_projection"], os.path.basename(params["scenario"])))
-    self.custom_snpp_variant = pd.DataFrame()
+    Output.__init__(self, params)
 
     self.snhp = SNHPData.SNHPData(self.cache_dir)
+    # (cached) extrapolation beyond the projection horizons
+    self.extrapolation = Extrapolation(self.snpp, self.npp, self.snhp)
 
-    # holder for shapefile when requested
+    # holders for shapefile (centroids and areas) and geometries when requested
     self.shapefile = None
+    self.geometries = None
+    # holders for jobs and GVA data, loaded on first use
+    self.jobs = None
+    self.gva = None
 
   def get_od(self):
 
@@ -80,6 +185,7 @@ class Instance():
     if isinstance(geogs, str):
       geogs = [geogs]
 
+    import ukpopulation.utils as ukpoputils
     geogs = ukpoputils.split_by_country(geogs)
     
     alldata = pd.DataFrame()
@@ -92,7 +198,7 @@ class Instance():
         data = self.snpp.aggregate(["GENDER", "C_AGE"], geogs[country], year)
       else:
         print("%d population for %s is extrapolated" % (year, country))
-        data = self.snpp.extrapolagg(["GENDER", "C_AGE"], self.npp, geogs[country], year)
+        data = self.extrapolation.people(country, geogs[country], year)
       alldata = alldata.append(data, ignore_index=True, sort=False)
 
     alldata = alldata.rename({"OBS_VALUE": "PEOPLE"}, axis=1).drop("PROJECTED_YEAR_NAME", axis=1)
@@ -136,6 +242,7 @@ class Instance():
 
   def get_households(self, year, geogs): 
 
+    import ukpopulation.utils as ukpoputils
     geogs = ukpoputils.split_by_country(geogs)
 
     allsnhp = pd.DataFrame()
@@ -148,12 +255,7 @@ class Instance():
         snhp = self.snhp.aggregate(geogs[country], year).rename({"OBS_VALUE": "HOUSEHOLDS"}, axis=1)
       else:
         print("%d households for %s is extrapolated" % (year, country))
-        #print(self.snhp.aggregate(geogs[country], max_year))
-        snhp = self.snhp.aggregate(geogs[country], max_year-1).merge(self.snhp.aggregate(geogs[country], max_year), 
-          left_on="GEOGRAPHY_CODE", right_on="GEOGRAPHY_CODE")
-        snhp["HOUSEHOLDS"] = snhp.OBS_VALUE_y + (snhp.OBS_VALUE_y - snhp.OBS_VALUE_x) * (year - max_year)
-        snhp["PROJECTED_YEAR_NAME"] = year
-        snhp.drop(["PROJECTED_YEAR_NAME_x", "OBS_VALUE_x", "PROJECTED_YEAR_NAME_y", "OBS_VALUE_y"], axis=1, inplace=True)
+        snhp = self.extrapolation.households(country, geogs[country], year).rename({"OBS_VALUE": "HOUSEHOLDS"}, axis=1)
 
       # aggregate census-merged LADs 'E06000053' 'E09000001'
       snhp.loc[snhp.GEOGRAPHY_CODE=="E09000033", "HOUSEHOLDS"] = snhp[snhp.GEOGRAPHY_CODE.isin(["E09000001","E09000033"])].HOUSEHOLDS.sum()
@@ -162,12 +264,81 @@ class Instance():
 
     return allsnhp
 
+  def get_panel(self, geogs, years):
+    """
+    Returns a panel.Panel of the population, households, jobs and GVA for the geographies over the (inclusive) range
+    of years. Equivalent to calling get_people etc for each year, but each source is queried once per country
+    """
+    panel = Panel(geogs, years)
+    years = list(panel.years)
+
+    import ukpopulation.utils as ukpoputils
+    geogs = ukpoputils.split_by_country(list(panel.geogs))
+    for country in geogs:
+      if not geogs[country]: continue
+
+      # population: MYE prior to the projection, then SNPP, then extrapolated beyond the projection horizon
+      min_year = self.snpp.min_year(country)
+      max_year = self.snpp.max_year(country)
+      mye_years = [year for year in years if year < min_year]
+      snpp_years = [year for year in years if min_year <= year <= max_year]
+      ex_years = [year for year in years if year > max_year]
+      if mye_years:
+        panel.set_table(self.mye.aggregate(["GENDER", "C_AGE"], geogs[country], mye_years), "PEOPLE")
+      if snpp_years:
+        panel.set_table(self.snpp.aggregate(["GENDER", "C_AGE"], geogs[country], snpp_years), "PEOPLE")
+      if ex_years:
+        print("%d-%d population for %s is extrapolated" % (ex_years[0], ex_years[-1], country))
+        panel.set_table(self.extrapolation.people(country, geogs[country], ex_years), "PEOPLE")
+
+      # households: SNHP then linearly extrapolated from the final two years
+      max_year = self.snhp.max_year(country)
+      snhp_years = [year for year in years if year <= max_year]
+      ex_years = [year for year in years if year > max_year]
+      if snhp_years:
+        panel.set_table(self.snhp.aggregate(geogs[country], snhp_years), "HOUSEHOLDS")
+      if ex_years:
+        print("%d-%d households for %s is extrapolated" % (ex_years[0], ex_years[-1], country))
+        panel.set_table(self.extrapolation.households(country, geogs[country], ex_years), "HOUSEHOLDS")
+
+    # aggregate census-merged LADs 'E06000053' 'E09000001' (as per get_households)
+    households = panel.data["HOUSEHOLDS"]
+    for merged, into in [("E09000001", "E09000033"), ("E06000053", "E06000052")]:
+      if merged in panel.index and into in panel.index:
+        households[:, panel.index.get_loc(into)] += households[:, panel.index.get_loc(merged)]
+
+    # jobs data is not projected, so is the same for every year
+    jobs = self.get_jobs(None, panel.geogs)
+    for year in years:
+      panel.set(year, jobs, Panel.JOBS)
+      panel.set(year, self.get_gva(year, panel.geogs), Panel.GVA)
+
+    return panel
+
   def get_jobs(self, year, geogs):
     """
     NM57 has both total jobs and density*, but raw data needs to be unstacked for ease of use
     *nomisweb: "Jobs density is the numbers of jobs per resident aged 16-64. For example, 
     a job density of 1.0 would mean that there is one job for every resident of working age."
+    The latest data is used regardless of year
     """
+    jobs = self.__jobs_store()
+    return jobs[jobs.index.isin(geogs)].reset_index()
+
+  # temporarily loading from csv pending response from nomisweb
+  def get_gva(self, year, geogs):
+    gva = self.__gva_store()
+    if year > gva.columns.max():
+      print("using latest available (%d) GVA data" % gva.columns.max())
+      year = gva.columns.max()
+
+    # filter LADs and specific year
+    return gva.loc[gva.index.isin(geogs), [year]].rename({year: "GVA"}, axis=1).reset_index()
+
+  def __jobs_store(self):
+    """ Jobs data by geography, loaded once (and cached in binary form in cache_dir) """
+    if self.jobs is not None:
+      return self.jobs
 
     # http://www.nomisweb.co.uk/api/v01/dataset/NM_57_1.data.tsv?
     # geography=1879048193...1879048573,1879048583,1879048574...1879048582&
@@ -181,39 +352,49 @@ class Instance():
       "geography": "1879048193...1879048573,1879048583,1879048574...1879048582",
       "select": "GEOGRAPHY_CODE,ITEM_NAME,OBS_VALUE"
     }
-    jobs = self.census_ew.get_data("NM_57_1", query_params)
-
-    # aggregate census-merged LADs 'E06000053' 'E09000001'
-    jobs.loc[jobs.GEOGRAPHY_CODE=="E09000033", "OBS_VALUE"] = jobs[jobs.GEOGRAPHY_CODE.isin(["E09000001","E09000033"])].OBS_VALUE.sum()
-    jobs.loc[jobs.GEOGRAPHY_CODE=="E06000052", "OBS_VALUE"] = jobs[jobs.GEOGRAPHY_CODE.isin(["E06000052","E06000053"])].OBS_VALUE.sum()
-    
-    # TODO filter by geogs rather than hard-coding GB
-    jobs = jobs[jobs.GEOGRAPHY_CODE.isin(geogs)]
-
-    jobs = jobs.set_index(["GEOGRAPHY_CODE", "ITEM_NAME"]).unstack(level=-1).reset_index()
-    jobs.columns = jobs.columns.map("".join)
-    return jobs.rename({"OBS_VALUEJobs density": "JOBS_PER_WORKING_AGE_PERSON", "OBS_VALUETotal jobs": "JOBS"}, axis=1)
-
-  # temporarily loading from csv pending response from nomisweb
-  def get_gva(self, year, geogs):
-    gva_all = pd.read_csv("./data/ons_gva1997-2015.csv")
-    if year > 2015:
-      print("using latest available (2015) GVA data")
-      year = 2015
+    cached = os.path.join(self.cache_dir, "jobs_%s.npz" % utils.md5hash(json.dumps(query_params, sort_keys=True)))
+    self.jobs = cache.load_table(cached)
+    if self.jobs is None:
+      jobs = self.census_ew.get_data("NM_57_1", query_params)
 
-    # filter LADs and specific year
-    return gva_all[gva_all.GEOGRAPHY_CODE.isin(geogs)][["GEOGRAPHY_CODE", str(year)]].rename({str(year): "GVA"}, axis=1)
+      # aggregate census-merged LADs 'E06000053' 'E09000001'
+      jobs.loc[jobs.GEOGRAPHY_CODE=="E09000033", "OBS_VALUE"] = jobs[jobs.GEOGRAPHY_CODE.isin(["E09000001","E09000033"])].OBS_VALUE.sum()
+      jobs.loc[jobs.GEOGRAPHY_CODE=="E06000052", "OBS_VALUE"] = jobs[jobs.GEOGRAPHY_CODE.isin(["E06000052","E06000053"])].OBS_VALUE.sum()
+
+      jobs = jobs.set_index(["GEOGRAPHY_CODE", "ITEM_NAME"]).OBS_VALUE.unstack(level=-1)
+      self.jobs = jobs.rename({"Jobs density": "JOBS_PER_WORKING_AGE_PERSON", "Total jobs": "JOBS"}, axis=1)[["JOBS", "JOBS_PER_WORKING_AGE_PERSON"]]
+      cache.save_table(cached, self.jobs)
+    return self.jobs
+
+  def __gva_store(self):
+    """ GVA by geography (rows) and year (columns), loaded once (and cached in binary form in cache_dir) """
+    if self.gva is not None:
+      return self.gva
+
+    source = "./data/ons_gva1997-2015.csv"
+    stat = os.stat(source)
+    cached = os.path.join(self.cache_dir, "gva_%s.npz" % utils.md5hash("%s:%d:%d" % (os.path.abspath(source), stat.st_size, stat.st_mtime_ns)))
+    self.gva = cache.load_table(cached)
+    if self.gva is None:
+      gva = pd.read_csv(source).set_index("GEOGRAPHY_CODE")
+      years = [column for column in gva.columns if column.isdigit()]
+      self.gva = gva[years].rename(columns=int)
+      cache.save_table(cached, self.gva)
+    return self.gva
 
   def get_shapefile(self, zip_url=None):
     """ 
-    Gets and stores a shapefile from the given URL 
-    same shapefile can be subsequently retrieved by calling this function without the zip_url arg
+    Gets the LAD codes (lad16cd), centroids (bng_e, bng_n) and areas (st_areasha) from the shapefile at the given URL.
+    The shapefile is only parsed the first time: these columns and the simplified geometries (see get_geometries) are
+    cached in binary form keyed by the hash of the zip.
+    same data can be subsequently retrieved by calling this function without the zip_url arg
     Fails if no url is supplied and none has previously been specified
     """
     assert self.shapefile is not None or zip_url is not None
     if zip_url is not None:
       local_zipfile = os.path.join(self.cache_dir, utils.md5hash(zip_url) + ".zip")
       if not os.path.isfile(local_zipfile):
+        import requests
         response = requests.get(zip_url)
         response.raise_for_status()
         with open(local_zipfile, 'wb') as fd:
@@ -222,45 +403,59 @@ class Instance():
         print("downloaded OK")
       else: 
         print("using cached data: %s" % local_zipfile)
-      
-      zip = zipfile.ZipFile(local_zipfile)
-      #print(zip.namelist())
-      # find a shapefile in the zip...
-      regex = re.compile(".*\.shp$")
-      f = filter(regex.match, zip.namelist())
-      shapefile = str(next(f))
-      # can't find a way of reading this directly into geopandas
-      zip.extractall(path=self.cache_dir)
-      self.shapefile = gpd.read_file(os.path.join(self.cache_dir, shapefile))
+
+      self.shapefile_zip = local_zipfile
+      self.shapefile_key = utils.md5file(local_zipfile)
+      self.geometries = None
+      self.shapefile = cache.load_table(self.__shapefile_cache("centroids"))
+      if self.shapefile is None:
+        self.__parse_shapefile()
+      else:
+        self.shapefile = self.shapefile.reset_index()
     return self.shapefile
 
+  def get_geometries(self):
+    """ 
+    Returns a GeoDataFrame of the LAD codes (lad16cd) and simplified boundaries, for plotting.
+    Fails if get_shapefile has not previously been called
+    """
+    assert self.shapefile is not None
+    if self.geometries is None:
+      import geopandas as gpd
+      cached = cache.load_blobs(self.__shapefile_cache("geometries"))
+      if cached is None:
+        self.__parse_shapefile()
+      else:
+        codes, wkb, crs = cached
+        self.geometries = gpd.GeoDataFrame({"lad16cd": codes}, geometry=gpd.GeoSeries.from_wkb(wkb), crs=crs or None)
+    return self.geometries
+
+  def __shapefile_cache(self, name):
+    return os.path.join(self.cache_dir, "shapefile_%s_%s.npz" % (name, self.shapefile_key))
+
+  def __parse_shapefile(self):
+    """ Reads the shapefile and caches the columns the model uses and the simplified geometries """
+    import geopandas as gpd
+    zip =zipfile.ZipFile(self.shapefile_zip)
+    #print(zip.namelist())
+    # find a shapefile in the zip...
+    regex = re.compile(".*\.shp$")
+    f = filter(regex.match, zip.namelist())
+    shapefile = str(next(f))
+    # can't find a way of reading this directly into geopandas
+    zip.extractall(path=self.cache_dir)
+    gdf = gpd.read_file(os.path.join(self.cache_dir, shapefile))
+
+    self.shapefile = gdf[["lad16cd", "bng_e", "bng_n", "st_areasha"]].astype({"bng_e": float, "bng_n": float, "st_areasha": float})
+    cache.save_table(self.__shapefile_cache("centroids"), self.shapefile.set_index("lad16cd"))
+    # simplified to (at most) 100m deviation, which is plenty for plotting
+    self.geometries = gpd.GeoDataFrame({"lad16cd": gdf.lad16cd.values}, geometry=gdf.geometry.simplify(100.0).values, crs=gdf.crs)
+    cache.save_blobs(self.__shapefile_cache("geometries"), self.geometries.lad16cd, list(self.geometries.geometry.to_wkb()),
+                     self.geometries.crs.to_wkt() if self.geometries.crs is not None else "")
+
   def get_lad_lookup(self): 
 
     lookup = pd.read_csv("../microsimulation/persistent_data/gb_geog_lookup.csv.gz")
     # only need the CMLAD->LAD mapping
     return lookup[["LAD_CM", "LAD"]].drop_duplicates().reset_index(drop=True)
 
-  def append_output(self, dataset, year):
-    dataset["PROJECTED_YEAR_NAME"] = year
-    self.custom_snpp_variant = self.custom_snpp_variant.append(dataset, ignore_index=True, sort=False)
-
-  def summarise_output(self, scenario):
-    horizon = self.custom_snpp_variant.PROJECTED_YEAR_NAME.unique().max()
-    scen_horizon = min(horizon, scenario.data.YEAR.max())
-    print("Cumulative scenario at %d" % scen_horizon)
-    print(scenario.data[scenario.data.YEAR == scen_horizon])
-    print("Summary at horizon year: %d" % horizon)
-    print("In-region population changes:")
-    inreg = self.custom_snpp_variant[(self.custom_snpp_variant.PROJECTED_YEAR_NAME == horizon)
-                                   & (self.custom_snpp_variant.GEOGRAPHY_CODE.isin(scenario.geographies()))].drop("net_delta", axis=1) 
-    print("TOTAL: %.0f baseline vs %.0f scenario (increase of %.0f)"
-      % (inreg.PEOPLE_SNPP.sum(), inreg.PEOPLE.sum(), inreg.PEOPLE.sum() - inreg.PEOPLE_SNPP.sum()))
-    print(inreg)
-
-    print("10 largest migration origins:")
-    print(self.custom_snpp_variant[self.custom_snpp_variant.PROJECTED_YEAR_NAME == horizon]
-                            .nsmallest(10, "net_delta").drop("net_delta", axis=1))
-
-  def write_output(self):
-    self.custom_snpp_variant.drop(["net_delta","net_delta_prev","PEOPLE_prev"], axis=1).to_csv(self.output_file, index=False)
-
@@ -0,0 +1,163 @@
+"""
+ensemble.py
+Runs model configurations against many scenarios in parallel. The inputs common to every run (OD data, distances,
+migration rates, population/households/jobs/GVA) are loaded once and shared with the worker processes via shared memory
+"""
+
+import os
+import copy
+from concurrent.futures import ProcessPoolExecutor, as_completed
+import numpy as np
+import pandas as pd
+
+import simim.data_apis as data_apis
+import simim.scenario as scenario
+from simim import simim
+from simim.od import OD, SparseOD
+from simim.panel import Panel
+
+# parameters that determine the shared inputs, so must be the same for every run in an ensemble
+_shared_params = ["coverage", "base_projection", "cache_dir", "distance_dtype", "od_cutoff", "od_neighbours"]
+
+def share(arrays):
+  """
+  Copies the arrays into shared memory blocks, returning the blocks (which the caller must close and unlink)
+  and a picklable description of the arrays for attach()
+  """
+  from multiprocessing import shared_memory
+  blocks = []
+  specs = {}
+  for name, array in arrays.items():
+    order = "F" if array.flags.f_contiguous and not array.flags.c_contiguous else "C"
+    block = shared_memory.SharedMemory(create=True, size=max(array.nbytes, 1))
+    np.ndarray(array.shape, array.dtype, buffer=block.buf, order=order)[...] = array
+    blocks.append(block)
+    specs[name] = (block.name, array.shape, array.dtype.str, order)
+  return blocks, specs
+
+def attach(specs):
+  """ Returns the blocks and (read-only) arrays described by specs, without copying """
+  from multiprocessing import shared_memory
+  blocks = []
+  arrays = {}
+  for name, (block_name, shape, dtype, order) in specs.items():
+    block = shared_memory.SharedMemory(name=block_name)
+    array = np.ndarray(shape, dtype, buffer=block.buf, order=order)
+    array.flags.writeable = False
+    blocks.append(block)
+    arrays[name] = array
+  return blocks, arrays
+
+def _flatten(od_2011, movers, panel):
+  """ Splits the shared inputs into numeric arrays (for shared memory) and the (small) remainder, which is pickled """
+  arrays = {}
+  movers = movers.reindex(od_2011.geogs)
+  for group in ["pairs", "origins", "destinations"]:
+    for name, values in getattr(od_2011, group).items():
+      if values.dtype != object:
+        arrays["od/%s/%s" % (group, name)] = values
+  # a sparse OD's stored pairs, for reconstructing it
+  if isinstance(od_2011, SparseOD):
+    arrays["sparse/keys"] = od_2011.keys
+  for name in movers.columns:
+    arrays["movers/" + name] = movers[name].values
+  for name, values in panel.data.items():
+    arrays["panel/" + name] = values
+  return arrays, (od_2011.geogs, movers.index.name, panel.years)
+
+def _unflatten(arrays, meta):
+  geogs, movers_index, years = meta
+  if "sparse/keys" in arrays:
+    keys = arrays["sparse/keys"]
+    od_2011 = SparseOD(geogs, keys % len(geogs), keys // len(geogs))
+  else:
+    od_2011 = OD(geogs)
+  movers = pd.DataFrame(index=pd.Index(geogs, name=movers_index))
+  panel = Panel(geogs, years)
+  for key, values in arrays.items():
+    kind, name = key.split("/", 1)
+    if kind == "od":
+      group, name = name.split("/", 1)
+      getattr(od_2011, group)[name] = values
+    elif kind == "movers":
+      movers[name] = values
+    elif kind == "panel":
+      panel.data[name] = values
+  return od_2011, movers, panel
+
+# state of each worker process
+_worker = {}
+
+def _init_worker(specs, meta):
+  # the blocks must be kept open for the lifetime of the worker
+  _worker["blocks"], arrays = attach(specs)
+  _worker["inputs"] = _unflatten(arrays, meta)
+
+def _run(params):
+  """ Runs the projection for one configuration in a worker process and writes its output """
+  od_2011, movers, panel = _worker["inputs"]
+  scenario_data = scenario.Scenario(os.path.join(params["scenario_dir"], params["scenario"]), params["emitters"] + params["attractors"])
+  output = data_apis.Output(params)
+  simim.project(params, scenario_data, od_2011, movers, panel, output)
+  output.write_output()
+  return output.output_file
+
+def run(configs, scenarios=None, processes=None):
+  """
+  Runs each of the model configurations (params dicts, as per simim.simim) with each of the given scenario files
+  (in scenario_dir), or the configured scenario if none given, over a pool of processes (by default one per CPU).
+  Outputs are written as each run completes. Returns the output files, in order of completion
+  """
+  if scenarios:
+    configs = [dict(config, scenario=s) for config in configs for s in scenarios]
+  configs = [copy.deepcopy(config) for config in configs]
+  for param in _shared_params:
+    if len(set(config.get(param) for config in configs)) > 1:
+      raise ValueError("%s must be the same for every configuration in an ensemble" % param)
+  if configs[0]["base_projection"] != "ppp":
+    raise NotImplementedError("TODO variant projections...")
+
+  # load the inputs common to all runs
+  input_data = data_apis.Instance(configs[0])
+  od_2011, movers = simim.prepare(input_data, configs[0].get("distance_dtype", "float64"), configs[0].get("od_cutoff"), configs[0].get("od_neighbours"))
+
+  scenarios_data = []
+  for params in configs:
+    simim.prefix_factors(params)
+    scenario_data = scenario.Scenario(os.path.join(params["scenario_dir"], params["scenario"]), params["emitters"] + params["attractors"])
+    simim.resolve_years(params, scenario_data, input_data)
+    scenarios_data.append(scenario_data)
+  # concurrent runs mustn't write to the same output (or checkpoint)
+  output_files = [data_apis.Output(params).output_file for params in configs]
+  duplicates = sorted(set(f for f in output_files if output_files.count(f) > 1))
+  if duplicates:
+    raise ValueError("configurations in an ensemble must be different, duplicate output(s): %s" % str(duplicates))
+
+  # the per-year data for every year any run needs
+  years = [year for params in configs for year in simim.panel_years(params)]
+  panel = input_data.get_panel(od_2011.geogs, years)
+
+  # calibrate up front so the (cached) fit is shared rather than repeated concurrently by the workers
+  for params, scenario_data in zip(configs, scenarios_data):
+    if not params.get("refit", False):
+      simim.calibrate(params, scenario_data, od_2011, panel, simim.fit_cache(params))
+
+  arrays, meta = _flatten(od_2011, movers, panel)
+  blocks, specs = share(arrays)
+  output_files = []
+  try:
+    with ProcessPoolExecutor(processes, initializer=_init_worker, initargs=(specs, meta)) as pool:
+      runs = { pool.submit(_run, params): params for params in configs }
+      for completed in as_completed(runs):
+        params = runs[completed]
+        try:
+          output_files.append(completed.result())
+          print("%s/%s %s: written to %s" % (params["model_type"], params["model_subtype"], params["scenario"], output_files[-1]))
+        except Exception as error:
+          # a failed run doesn't stop the others
+          print("%s/%s %s: RUN FAILED: %s" % (params["model_type"], params["model_subtype"], params["scenario"], error))
+  finally:
+    for block in blocks:
+      block.close()
+      block.unlink()
+  return output_files
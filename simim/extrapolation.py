@@ -0,0 +1,68 @@
+"""
+extrapolation.py
+Memoised extrapolation of the population and household projections beyond their horizons
+"""
+
+import numpy as np
+import pandas as pd
+
+def _long(geogs, years, values):
+  """ Long-format (ukpopulation-style) table from a zones x years array """
+  return pd.DataFrame({"GEOGRAPHY_CODE": np.tile(geogs, len(years)),
+                       "PROJECTED_YEAR_NAME": np.repeat(years, len(geogs)),
+                       "OBS_VALUE": values.T.ravel()})
+
+class Extrapolation():
+  """
+  Extrapolates, for any number of years at once:
+  - population, by scaling the final SNPP year by the NPP age/gender ratios (as per ukpopulation's SNPPData.extrapolate)
+  - households, linearly from the final two SNHP years
+  The base data for each country's geographies is computed once and cached
+  """
+  def __init__(self, snpp, npp, snhp):
+    self.snpp = snpp
+    self.npp = npp
+    self.snhp = snhp
+    # (country, geogs) -> final SNPP year by zone and gender/age
+    self.people_base = {}
+    # (country, year) -> NPP ratio to the final SNPP year by gender/age
+    self.npp_ratios = {}
+    # (country, geogs) -> (final SNHP year, zones, final year households, annual change)
+    self.households_trend = {}
+
+  def __people_base(self, country, geogs):
+    key = (country, tuple(geogs))
+    if key not in self.people_base:
+      max_year = self.snpp.max_year(country)
+      self.people_base[key] = self.snpp.filter(list(geogs), max_year) \
+        .pivot_table(index="GEOGRAPHY_CODE", columns=["GENDER", "C_AGE"], values="OBS_VALUE", aggfunc="sum", fill_value=0)
+    return self.people_base[key]
+
+  def __ratios(self, country, years, categories):
+    """ Returns the NPP ratios as a categories x years array """
+    max_year = self.snpp.max_year(country)
+    missing = [year for year in years if (country, year) not in self.npp_ratios]
+    if missing:
+      npp = self.npp.detail("ppp", country, [max_year] + missing) \
+        .pivot_table(index=["GENDER", "C_AGE"], columns="PROJECTED_YEAR_NAME", values="OBS_VALUE")
+      for year in missing:
+        self.npp_ratios[(country, year)] = npp[year] / npp[max_year]
+    return np.column_stack([self.npp_ratios[(country, year)].reindex(categories, fill_value=0).values for year in years])
+
+  def people(self, country, geogs, years):
+    """ Extrapolated population (aggregated over age and gender) for the given year(s), in long format """
+    years = np.atleast_1d(years)
+    base = self.__people_base(country, geogs)
+    return _long(base.index.values, years, base.values @ self.__ratios(country, years, base.columns))
+
+  def households(self, country, geogs, years):
+    """ Extrapolated households for the given year(s), in long format """
+    years = np.atleast_1d(years)
+    key = (country, tuple(geogs))
+    if key not in self.households_trend:
+      max_year = self.snhp.max_year(country)
+      snhp = self.snhp.aggregate(list(geogs), [max_year - 1, max_year]) \
+        .pivot(index="GEOGRAPHY_CODE", columns="PROJECTED_YEAR_NAME", values="OBS_VALUE")
+      self.households_trend[key] = (max_year, snhp.index.values, snhp[max_year].values, (snhp[max_year] - snhp[max_year - 1]).values)
+    max_year, codes, last, change = self.households_trend[key]
+    return _long(codes, years, last[:, np.newaxis] + change[:, np.newaxis] * (years - max_year)[np.newaxis, :])
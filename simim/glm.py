@@ -0,0 +1,263 @@
+"""
+glm.py
+Poisson (log-link) GLM fitting by iteratively reweighted least squares, using the same design matrices and
+parameter layout as spint's models. Unlike spint the iteration can be started from a given set of parameters,
+e.g. those of a model fitted to similar data, in which case it typically converges in very few iterations.
+The production-constrained model has a specialised solver that avoids the (N-1) origin dummy columns altogether.
+"""
+
+import numpy as np
+import pandas as pd
+import scipy.sparse as sp
+from scipy.sparse.linalg import spsolve
+from scipy.special import gammaln
+
+class Fit:
+  """ A fitted Poisson model exposing the subset of the spint model interface used by models.Model """
+  def __init__(self, params, yhat, n_iter, pseudoR2, SRMSE):
+    self.params = params
+    self.yhat = yhat
+    self.n_iter = n_iter
+    self.pseudoR2 = pseudoR2
+    self.SRMSE = SRMSE
+
+def loglike(y, mu):
+  return np.sum(y * np.log(mu) - mu - gammaln(y + 1))
+
+# McFadden's pseudo R2 (relative to the intercept-only model) and standardised RMSE, as computed by spint
+def pseudoR2(y, yhat):
+  return 1 - loglike(y, yhat) / loglike(y, np.full(len(y), np.mean(y)))
+
+def srmse(y, yhat):
+  return np.sqrt(np.mean((y - yhat) ** 2)) / np.mean(y)
+
+def cost_function(model_subtype):
+  return np.log if model_subtype == "pow" else lambda c: c * 1.0
+
+def dummies(categories):
+  """ Sparse indicator columns for each category except the first (sorted) one, as spint constructs them """
+  _, inverse = np.unique(categories, return_inverse=True)
+  inverse = inverse.ravel()
+  rows = np.flatnonzero(inverse > 0)
+  return sp.csr_matrix((np.ones(len(rows)), (rows, inverse[rows] - 1)), shape=(len(inverse), inverse.max()))
+
+def design(model_type, model_subtype, xo, xd, cost):
+  """
+  Returns the design matrix (including the constant) with columns ordered as per spint:
+  gravity:    k, log(xo)..., log(xd)..., f(cost)
+  production: k, origin dummies, log(xd)..., f(cost)  (xo are the origin identifiers)
+  attraction: k, destination dummies, log(xo)..., f(cost)  (xd are the destination identifiers)
+  doubly:     k, origin dummies, destination dummies, f(cost)
+  """
+  n = len(cost)
+  xo = np.reshape(xo, (n, -1))
+  xd = np.reshape(xd, (n, -1))
+  cost = cost_function(model_subtype)(np.reshape(cost, (n, 1)).astype(float))
+  const = np.ones((n, 1))
+  if model_type == "gravity":
+    return np.hstack((const, np.log(xo.astype(float)), np.log(xd.astype(float)), cost))
+  elif model_type == "production":
+    return sp.hstack((const, dummies(xo), np.log(xd.astype(float)), cost), format="csr")
+  elif model_type == "attraction":
+    return sp.hstack((const, dummies(xd), np.log(xo.astype(float)), cost), format="csr")
+  else:
+    return sp.hstack((const, dummies(xo), dummies(xd), cost), format="csr")
+
+def irls(y, X, params=None, tol=1.0e-8, max_iter=200):
+  """
+  Fits a Poisson GLM with log link to observations y and design matrix X (dense or sparse, in which case the
+  least-squares steps are solved sparsely).
+  If params are given they are used as the starting point, otherwise the iteration starts from the data.
+  Converges when no parameter changes by more than tol.
+  """
+  y = np.asarray(y, dtype=float).ravel()
+  if params is None:
+    mu = (y + np.mean(y)) / 2
+    eta = np.log(mu)
+  else:
+    params = np.asarray(params, dtype=float).ravel()
+    if len(params) != X.shape[1]:
+      raise ValueError("initial parameters must have %d values (%d given)" % (X.shape[1], len(params)))
+    eta = X @ params
+    mu = np.exp(eta)
+
+  n_iter = 0
+  while n_iter < max_iter:
+    n_iter += 1
+    # working response and weights for the log link
+    z = eta + (y - mu) / mu
+    if sp.issparse(X):
+      wX = X.multiply(mu[:, np.newaxis]).tocsr()
+      # for the constrained models the normal equations are sparse too: diagonal for the dummies, bordered by the
+      # (few) dense columns, so there is little fill-in
+      new_params = spsolve((X.T @ wX).tocsc(), wX.T @ z)
+    else:
+      wX = X * mu[:, np.newaxis]
+      new_params = np.linalg.solve(X.T @ wX, wX.T @ z)
+    eta = X @ new_params
+    mu = np.exp(eta)
+    converged = params is not None and np.max(np.abs(new_params - params)) < tol
+    params = new_params
+    if converged:
+      break
+  else:
+    raise RuntimeError("Poisson IRLS failed to converge in %d iterations" % max_iter)
+  return Fit(params, mu, n_iter, pseudoR2(y, mu), srmse(y, mu))
+
+def production(y, origins, xd, cost, model_subtype, params=None, tol=1.0e-8, max_iter=200):
+  """
+  Fits the production-constrained Poisson model without the origin dummies. Given the attractor and cost parameters
+  the origin terms are, in closed form, those that reproduce the observed outflows, so only the few remaining
+  parameters are iterated, by Newton's method on the resulting (profiled) likelihood. The parameters (and their layout)
+  are the same as irls(y, design("production", ...)), from whose parameters the iteration can be started.
+  """
+  y = np.asarray(y, dtype=float).ravel()
+  n = len(y)
+  o = pd.factorize(np.ravel(origins), sort=True)[0]
+  Z = np.hstack((np.log(np.reshape(xd, (n, -1)).astype(float)), cost_function(model_subtype)(np.reshape(cost, (n, 1)).astype(float))))
+  outflows = np.bincount(o, y)
+  if np.any(outflows <= 0):
+    raise ValueError("production-constrained model requires a positive total flow from every origin")
+  if params is None:
+    theta = np.zeros(Z.shape[1])
+  else:
+    params = np.asarray(params, dtype=float).ravel()
+    if len(params) != len(outflows) + Z.shape[1]:
+      raise ValueError("initial parameters must have %d values (%d given)" % (len(outflows) + Z.shape[1], len(params)))
+    theta = params[len(outflows):]
+
+  def profile(theta):
+    # fitted flows, log-likelihood (less a constant) and log of the unscaled outflows
+    eta = Z @ theta
+    shift = eta.max()
+    total = np.log(np.bincount(o, np.exp(eta - shift), len(outflows))) + shift
+    return outflows[o] * np.exp(eta - total[o]), y @ eta - outflows @ total, total
+
+  mu, ll, total = profile(theta)
+  n_iter = 0
+  while n_iter < max_iter:
+    n_iter += 1
+    # gradient and (negated) Hessian of the profiled likelihood
+    grad = Z.T @ (y - mu)
+    means = np.column_stack([np.bincount(o, mu * z, len(outflows)) for z in Z.T]) / outflows[:, np.newaxis]
+    hess = Z.T @ (Z * mu[:, np.newaxis]) - means.T @ (means * outflows[:, np.newaxis])
+    step = np.linalg.solve(hess, grad)
+    # the likelihood is concave so halving the step eventually increases it (to within rounding, once converged)
+    for _ in range(50):
+      new_mu, new_ll, new_total = profile(theta + step)
+      if new_ll >= ll or np.max(np.abs(step)) < tol:
+        break
+      step /= 2
+    theta, mu, ll, total = theta + step, new_mu, new_ll, new_total
+    if np.max(np.abs(step)) < tol:
+      break
+  else:
+    raise RuntimeError("production-constrained fit failed to converge in %d iterations" % max_iter)
+  # origin terms relative to the first origin, as per the dummies
+  gamma = np.log(outflows) - total
+  return Fit(np.concatenate(([gamma[0]], gamma[1:] - gamma[0], theta)), mu, n_iter, pseudoR2(y, mu), srmse(y, mu))
+
+def furness(flows, outflows, inflows, b=None, tol=1.0e-10, max_iter=10000, probe=10):
+  """
+  Balances a (dense or sparse) [destination, origin] matrix of unscaled flows to the given totals by iterative
+  proportional fitting, optionally starting from destination factors b. Returns the origin and destination balancing
+  factors a and b, such that b[:, np.newaxis] * flows * a has the given totals to within the relative tolerance, and
+  the number of iterations. The convergence rate is estimated every 2 * probe iterations and the updates over-relaxed
+  accordingly (as successive over-relaxation), reverting to plain updates if that diverges
+  """
+  origin_sums = lambda b: flows.T @ b
+  destination_sums = lambda a: flows @ a
+  relax = lambda x, target, w: target if w == 1.0 else x ** (1 - w) * target ** w
+
+  a = np.ones(len(outflows))
+  b = np.ones(len(inflows)) if b is None else b
+  rows = origin_sums(b)
+  w, errors, best = 1.0, [], (np.inf, a, b)
+  for n_iter in range(1, max_iter + 1):
+    a = relax(a, outflows / rows, w)
+    columns = destination_sums(a)
+    b = relax(b, inflows / columns, w)
+    rows = origin_sums(b)
+    error = max(np.max(np.abs(a * rows - outflows) / outflows), np.max(np.abs(b * columns - inflows) / inflows))
+    if error < tol:
+      return a, b, n_iter
+    if not error < 10 * best[0]:
+      # diverging, so start again from the best solution so far without relaxation
+      w, (_, a, b) = 1.0, best
+      rows = origin_sums(b)
+    elif error < best[0]:
+      best = (error, a, b)
+    errors.append(error)
+    if n_iter % (2 * probe) == 0:
+      # the rate without relaxation from that observed (over the last probe iterations) with it
+      rate = (errors[-1] / errors[-1 - probe]) ** (1.0 / probe)
+      rate = min((rate + w - 1) ** 2 / (rate * w ** 2), 0.9999)
+      w = min(2.0 / (1.0 + np.sqrt(1.0 - rate)), 1.95)
+  raise RuntimeError("Furness balancing failed to converge in %d iterations" % max_iter)
+
+def doubly(y, origins, destinations, cost, model_subtype, params=None, tol=1.0e-10, max_iter=10000, beta_tol=1.0e-8, verbose=False):
+  """
+  Fits the doubly-constrained Poisson model with balancing factors rather than origin and destination dummies. For a
+  given beta the origin and destination terms are those that reproduce the observed totals (see furness) and beta is
+  then the root of its score equation, that the fitted flows have the observed mean (transformed) cost, found by a
+  1-D search. tol and max_iter control the balancing and beta_tol the search, and if verbose each step is reported.
+  The parameters (and their layout) are the same as irls(y, design("doubly", ...)), from whose beta the search can be
+  started.
+  """
+  from scipy.optimize import brentq
+  y = np.asarray(y, dtype=float).ravel()
+  o = pd.factorize(np.ravel(origins), sort=True)[0]
+  d = pd.factorize(np.ravel(destinations), sort=True)[0]
+  g = cost_function(model_subtype)(np.asarray(cost, dtype=float).ravel())
+  outflows, inflows = np.bincount(o, y), np.bincount(d, y)
+  if np.any(outflows <= 0) or np.any(inflows <= 0):
+    raise ValueError("doubly-constrained model requires a positive total flow from every origin and to every destination")
+  # every pair, in destination then origin order, is balanced as a dense matrix, otherwise sparse
+  shape = (len(inflows), len(outflows))
+  dense = len(y) == np.prod(shape) and np.array_equal(o, np.tile(np.arange(shape[1]), shape[0])) \
+    and np.array_equal(d, np.repeat(np.arange(shape[0]), shape[1]))
+  observed = y @ g / y.sum()
+  if params is None:
+    beta = -1.0 if model_subtype == "pow" else -1.0 / observed
+  else:
+    params = np.asarray(params, dtype=float).ravel()
+    if len(params) != len(outflows) + len(inflows):
+      raise ValueError("initial parameters must have %d values (%d given)" % (len(outflows) + len(inflows), len(params)))
+    beta = params[-1]
+
+  # each evaluation starts from the previous destination factors
+  a, b, shift, mu, n_iter, errors = None, None, 0.0, None, 0, {}
+  def evaluate(beta):
+    nonlocal a, b, shift, mu, n_iter
+    shift = np.max(beta * g)
+    flows = np.exp(beta * g - shift)
+    matrix = flows.reshape(shape) if dense else sp.csr_matrix((flows, (d, o)), shape=shape)
+    a, b, n_balance = furness(matrix, outflows, inflows, b, tol, max_iter)
+    mu = a[o] * flows * b[d]
+    n_iter += 1
+    errors[beta] = mu @ g / y.sum() - observed
+    if verbose:
+      print("beta=%.10f: %d balancing iterations, mean cost error %.3e" % (beta, n_balance, errors[beta]))
+    return errors[beta]
+  error = lambda beta: errors[beta] if beta in errors else evaluate(beta)
+
+  # the error increases with beta: step away from the starting point until it changes sign, then search between
+  start, end = beta, beta
+  step = max(0.1 * abs(beta), beta_tol)
+  e = error(beta)
+  direction = -1.0 if e > 0 else 1.0
+  while e * direction < 0:
+    if n_iter > 100:
+      raise RuntimeError("failed to bracket beta for the doubly-constrained model (starting from %f)" % beta)
+    start, end = end, end + direction * step
+    step *= 2
+    e = error(end)
+  if start != end:
+    beta = brentq(error, min(start, end), max(start, end), xtol=beta_tol)
+  # the fit at the solution
+  evaluate(beta)
+
+  # relative to the first origin and destination, as per the dummies
+  gamma, delta = np.log(a), np.log(b)
+  params = np.concatenate(([gamma[0] + delta[0] - shift], gamma[1:] - gamma[0], delta[1:] - delta[0], [beta]))
+  return Fit(params, mu, n_iter, pseudoR2(y, mu), srmse(y, mu))
@@ -2,7 +2,9 @@
 
 import numpy as np
 
-from spint import Gravity, Attraction, Production, Doubly
+import simim.glm as glm
+from simim.od import OD, SparseOD
+from simim.utils import get_named_values
 
 _valid_types = ["gravity", "production", "attraction", "doubly"]
 _valid_subtypes = ["pow", "exp"]
@@ -23,14 +25,22 @@ def validate(model_type, model_subtype, dataset, y_col, xo_cols, xd_cols, cost_c
     raise ValueError("cost function column specified to be %s but it's not in the dataset" % cost_col)
 
 class Model:
-  def __init__(self, model_type, model_subtype, dataset, y_col, xo_cols, xd_cols, cost_col):
+  def __init__(self, model_type, model_subtype, dataset, y_col, xo_cols, xd_cols, cost_col, init=None, cache=None):
+    """
+    init optionally specifies the starting point for the fit: either parameters (in the layout described below) or a 
+    previously fitted Model, e.g. the previous year's. The fit is then a warm-started IRLS (see glm.py) rather than spint
+    Constrained models are always fitted natively: production with the origin terms profiled out (see glm.production),
+    attraction by IRLS with a sparse design matrix and doubly with balancing factors (see glm.doubly)
+    cache optionally specifies a cache.FitCache: if the same model has already been fitted to identical data the cached
+    fit is used, otherwise the fit is added to the cache
+    """
     self.model_type = model_type
     self.model_subtype = model_subtype
     validate(self.model_type, self.model_subtype, dataset, y_col, xo_cols, xd_cols, cost_col)
 
-    # take a copy of the input dataset and ensure sorted by D then O
-    # so that the ordering of mu, alpha is determined
-    self.dataset = dataset.sort_values(["D_GEOGRAPHY_CODE", "O_GEOGRAPHY_CODE"])#.reset_index()
+    self.dataset = self.__prepare(dataset)
+    # see __fixed_terms
+    self.__fixed = None
 
     self.y_col = y_col
     self.xo_cols = [xo_cols] if isinstance(xo_cols, str) else xo_cols
@@ -41,40 +51,71 @@ class Model:
     self.num_emit = 1 if np.isscalar(self.xo_cols) else len(self.xo_cols)
     self.num_attr = 1 if np.isscalar(self.xd_cols) else len(self.xd_cols)
     # for constrained models the above values need to be changed to num of unique O or D less 1
-  
-    if self.model_type == "gravity":
-      self.impl = Gravity(self.dataset[self.y_col].values, 
-                          self.dataset[self.xo_cols].values, 
-                          self.dataset[self.xd_cols].values, 
-                          self.dataset[self.cost_col].values, self.model_subtype)
-    elif self.model_type == "production":
+    if self.model_type == "production":
       assert(self.num_emit == 1)
       self.num_emit = len(self.dataset[self.xo_cols[0]].unique()) - 1
-      self.impl = Production(self.dataset[self.y_col].values, 
-                             self.dataset[self.xo_cols].values, 
-                             self.dataset[self.xd_cols].values, 
-                             self.dataset[self.cost_col].values, self.model_subtype)
     elif self.model_type == "attraction":
       assert(self.num_attr == 1)
       self.num_attr = len(self.dataset[self.xd_cols[0]].unique()) - 1
-      self.impl = Attraction(self.dataset[self.y_col].values, 
-                             self.dataset[self.xd_cols].values, 
-                             self.dataset[self.xo_cols].values, 
-                             self.dataset[self.cost_col].values, self.model_subtype)
-    else: #model_type == "doubly":
+    elif self.model_type == "doubly":
       assert(self.num_emit == 1)
       self.num_emit = len(self.dataset[self.xo_cols[0]].unique()) - 1
       assert(self.num_attr == 1)
       self.num_attr = len(self.dataset[self.xd_cols[0]].unique()) - 1
-      raise NotImplementedError("Doubly constrained model is too constrained")
-      self.impl = Doubly(self.dataset[self.y_col].values, 
-                         self.dataset[self.xo_cols].values, 
-                         self.dataset[self.xd_cols].values, 
-                         self.dataset[self.cost_col].values, self.model_subtype)
+
+    y = self.dataset[self.y_col].values
+    xo = self.dataset[self.xo_cols].values
+    xd = self.dataset[self.xd_cols].values
+    cost = self.dataset[self.cost_col].values
+
+    # the native solvers converge to the same solution regardless of their starting point, spint is (slightly) different
+    solver = {"production": "profiled", "attraction": "irls", "doubly": "balanced"}.get(self.model_type, "spint" if init is None else "irls")
+    key = None if cache is None else cache.key(self.model_type, self.model_subtype, solver, self.y_col, self.xo_cols, self.xd_cols, self.cost_col, y, xo, xd, cost)
+    self.impl = None if cache is None else cache.get(key)
+    cached = self.impl is not None
+
+    if isinstance(init, Model):
+      init = init.impl.params
+
+    if cached:
+      print("Using cached %s/%s fit %s" % (self.model_type, self.model_subtype, key[:12]))
+    elif self.model_type == "production":
+      self.impl = glm.production(y, xo, xd, cost, self.model_subtype, init)
+    elif self.model_type == "doubly":
+      self.impl = glm.doubly(y, xo, xd, cost, self.model_subtype, init)
+    elif init is not None or self.model_type == "attraction":
+      self.impl = glm.irls(y, glm.design(self.model_type, self.model_subtype, xo, xd, cost), init)
+    else:
+      from spint import Gravity
+      self.impl = Gravity(y, xo, xd, cost, self.model_subtype)
+
+    # number of iterations the solver took to converge
+    self.n_iter = self.impl.n_iter if isinstance(self.impl, glm.Fit) else self.impl.results.model.fit_params["n_iter"]
+
+    if cache is not None and not cached:
+      cache.put(key, self.impl, self.n_iter)
 
     # append the model-fitted flows to the dataframe, prefixed with "MODEL_"
     self.dataset["MODEL_"+self.y_col] = self.impl.yhat
 
+  def __prepare(self, dataset):
+    # take a copy of the input dataset and ensure sorted by D then O
+    # so that the ordering of mu, alpha is determined
+    if isinstance(dataset, OD):
+      # already in D then O order, and a shallow copy suffices as the arrays aren't modified
+      return dataset.copy()
+    return dataset.sort_values(["D_GEOGRAPHY_CODE", "O_GEOGRAPHY_CODE"])#.reset_index()
+
+  def rebase(self, dataset):
+    """ 
+    Replaces the model dataset, e.g. with a later year's emitters and attractors, and evaluates the 
+    model on it using the existing calibration. The origins and destinations must be unchanged
+    """
+    validate(self.model_type, self.model_subtype, dataset, self.y_col, self.xo_cols, self.xd_cols, self.cost_col)
+    self.dataset = self.__prepare(dataset)
+    self.__fixed = None
+    self.dataset["MODEL_"+self.y_col] = self(get_named_values(self.dataset, self.xo_cols), get_named_values(self.dataset, self.xd_cols))
+
   # The params array structure, based on N emissiveness factors and M attractiveness factors:
   #
   #   0 1 ... M M+1 ... N N+1 ... N+M+1 N+M+2 
@@ -126,44 +167,99 @@ class Model:
       xd_alpha = xd_alpha * xd[i] ** alpha[i]
     return xd_alpha
 
-  def __call__(self, xo=None, xd=None):
-    if self.model_type == "gravity":
-      assert xo is not None
-      assert xd is not None
-      xo_mu = self.__calc_xo_mu(xo)
-      xd_alpha = self.__calc_xd_alpha(xd)
+  # For OD datasets, per-zone values are broadcast across the [destination, origin] matrix rather than expanded
+  # per row (which are in D then O order), or for sparse OD datasets indexed by the stored pairs' origins or destinations.
+  # Per-row values are also accepted. Values are stacked K x zones or K x rows
+  def __batch_values(self, values, origin):
+    values = np.atleast_2d(np.asarray(values, dtype=float))
+    if not isinstance(self.dataset, OD):
+      return values
+    if isinstance(self.dataset, SparseOD):
+      if values.shape[1] != self.dataset.n:
+        return values
+      return values[:, self.dataset.o] if origin else values[:, self.dataset.d]
+    if values.shape[1] == self.dataset.n:
+      return values[:, np.newaxis, :] if origin else values[:, :, np.newaxis]
+    return values.reshape((len(values), self.dataset.n, self.dataset.n))
+
+  def __cost_decay(self):
+    if isinstance(self.dataset, SparseOD):
+      cost = self.dataset.column(self.cost_col)
+    elif isinstance(self.dataset, OD):
+      # as [destination, origin]
+      cost = self.dataset.matrix(self.cost_col).T
+    else:
+      cost = self.dataset[self.cost_col].values
+    if self.model_subtype == "pow":
+      return cost ** self.beta()
+    else:
+      return np.exp(cost * self.beta())
 
-      if self.model_subtype == "pow":
-        ybar = (np.exp(self.k()) * xo_mu * xd_alpha * self.dataset[self.cost_col] ** self.beta())
+  def __fixed_terms(self):
+    """ 
+    The product of the terms that don't depend on the emitter/attractor values: exp(k), the cost decay and, for
+    constrained models, the exp(mu) origin and/or exp(alpha) destination terms. Computed once for each fit/dataset
+    """
+    if self.__fixed is not None:
+      return self.__fixed
+    fixed = np.exp(self.k()) * self.__cost_decay()
+    if self.model_type in ["production", "doubly"]:
+      mu = np.exp(np.append(0, self.mu()))
+      if isinstance(self.dataset, SparseOD):
+        # every zone must be an origin of a stored pair
+        fixed = fixed * mu[self.dataset.o]
+      elif isinstance(self.dataset, OD):
+        fixed = fixed * mu[np.newaxis, :]
       else:
-        ybar = (np.exp(self.k()) * xo_mu * xd_alpha * np.exp(self.dataset[self.cost_col] * self.beta()))
-      return ybar
-    elif self.model_type == "production":
-      #assert xo is None
-      assert xd is not None
-      xd_alpha = self.__calc_xd_alpha(xd)
-      mu = np.append(0, self.mu())
-      mu = np.tile(mu, int(len(self.dataset)/len(mu)))
-      assert len(mu) == len(self.dataset)
-      # NB ordering is only guaranteed if dataset is sorted by origin then destination code
-      if self.model_subtype == "pow":
-        ybar = (np.exp(self.k()) * np.exp(mu) * xd_alpha * self.dataset[self.cost_col] ** self.beta())
+        # NB ordering is only guaranteed if dataset is sorted by origin then destination code
+        assert len(self.dataset) % len(mu) == 0
+        fixed = fixed * np.tile(mu, len(self.dataset) // len(mu))
+    if self.model_type in ["attraction", "doubly"]:
+      alpha = np.exp(np.append(0, self.alpha()))
+      if isinstance(self.dataset, SparseOD):
+        fixed = fixed * alpha[self.dataset.d]
+      elif isinstance(self.dataset, OD):
+        fixed = fixed * alpha[:, np.newaxis]
       else:
-        ybar = (np.exp(self.k()) * np.exp(mu) * xd_alpha * np.exp(self.dataset[self.cost_col] * self.beta()))
-      return ybar
-    elif self.model_type == "attraction":
+        assert len(self.dataset) % len(alpha) == 0
+        fixed = fixed * np.repeat(alpha, len(self.dataset) // len(alpha))
+    self.__fixed = fixed
+    return fixed
+
+  def batch(self, xo=None, xd=None):
+    """
+    Evaluates the model for K sets of emitter (gravity/attraction) and/or attractor (gravity/production) values in one
+    pass, e.g. for scenario screening or sensitivity analysis. xo and xd are K x zones (OD datasets only) or K x rows
+    arrays, or lists of these (one per factor). Returns a K x rows array of flows, in dataset order
+    """
+    flows = self.__fixed_terms()[np.newaxis]
+    if self.model_type in ["gravity", "attraction"]:
       assert xo is not None
-      #assert xd is None
-      xo_mu = self.__calc_xo_mu(xo)
-      alpha = np.append(0,self.alpha())
-      alpha = np.repeat(alpha, int(len(self.dataset)/len(alpha)))
-      assert len(alpha) == len(self.dataset)
-      # NB ordering is only guaranteed if dataset is sorted by origin then destination code
-      if self.model_subtype == "pow":
-        ybar = (np.exp(self.k()) * xo_mu * np.exp(alpha) * self.dataset[self.cost_col] ** self.beta())
-      else:
-        ybar = (np.exp(self.k()) * xo_mu * np.exp(alpha) * np.exp(self.dataset[self.cost_col] * self.beta()))
-      return ybar
-    else:
-      raise NotImplementedError("%s evaluation not implemented" % self.model_type)
+      flows = flows * self.__batch_values(self.__calc_xo_mu(xo), origin=True)
+    if self.model_type in ["gravity", "production"]:
+      assert xd is not None
+      flows = flows * self.__batch_values(self.__calc_xd_alpha(xd), origin=False)
+    return flows.reshape((len(flows), -1))
 
+  def block(self, xo=None, xd=None, origins=None, destinations=None):
+    """
+    Evaluates the flows between a subset of origins and/or destinations (zone indices, all if None) given per-zone
+    emitter/attractor values (dense OD datasets only), e.g. just the flows affected by changes to some zones' values.
+    Returns the [origin, destination] matrix of flows
+    """
+    if not isinstance(self.dataset, OD) or isinstance(self.dataset, SparseOD):
+      raise ValueError("block evaluation requires a (dense) OD dataset")
+    o = np.arange(self.dataset.n) if origins is None else np.asarray(origins)
+    d = np.arange(self.dataset.n) if destinations is None else np.asarray(destinations)
+    flows = self.__fixed_terms()[np.ix_(d, o)]
+    if self.model_type in ["gravity", "attraction"]:
+      assert xo is not None
+      flows = flows * np.asarray(self.__calc_xo_mu(xo), dtype=float)[np.newaxis, o]
+    if self.model_type in ["gravity", "production"]:
+      assert xd is not None
+      flows = flows * np.asarray(self.__calc_xd_alpha(xd), dtype=float)[d, np.newaxis]
+    return flows.T
+
+  def __call__(self, xo=None, xd=None):
+    """ Evaluates the model for one set of emitter and/or attractor values, per zone (OD datasets only) or per row """
+    return self.batch(xo, xd)[0]
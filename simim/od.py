@@ -0,0 +1,297 @@
+"""
+od.py
+Dense and sparse array-backed origin-destination datasets
+"""
+
+import numpy as np
+import pandas as pd
+
+class OD():
+  """
+  Origin-destination data for N zones indexed by a single (sorted) geography index:
+  - pair values (e.g. flows, cost) are stored as NxN matrices indexed [origin, destination]
+  - origin and destination factors are stored as N-vectors and broadcast on access
+  Columns are accessed by name as in a long-format DataFrame, rows ordered by destination then origin
+  (the ordering models.Model requires), but nothing is materialised at NxN until requested
+  """
+  def __init__(self, geogs, o_col="O_GEOGRAPHY_CODE", d_col="D_GEOGRAPHY_CODE"):
+    self.geogs = np.array(sorted(set(geogs)), dtype=object)
+    self.n = len(self.geogs)
+    self.index = pd.Index(self.geogs)
+    self.o_col = o_col
+    self.d_col = d_col
+    self.pairs = {}
+    self.origins = { o_col: self.geogs }
+    self.destinations = { d_col: self.geogs }
+
+  @classmethod
+  def from_table(cls, table, pairs, origins=[], destinations=[], o_col="O_GEOGRAPHY_CODE", d_col="D_GEOGRAPHY_CODE"):
+    """ Constructs from a long-format table with one row per OD pair. Every pair must be present """
+    od = cls(np.union1d(table[o_col].unique(), table[d_col].unique()), o_col, d_col)
+    o = od.locate(table[o_col])
+    d = od.locate(table[d_col])
+    if len(table) != od.n * od.n or np.unique(o * od.n + d).size != len(table):
+      raise ValueError("OD table must contain exactly one row for each of the %d origin-destination pairs" % (od.n * od.n))
+    for col in pairs:
+      m = np.empty((od.n, od.n), dtype=table[col].values.dtype, order="F")
+      m[o, d] = table[col].values
+      od.pairs[col] = m
+    for col in origins:
+      v = np.empty(od.n, dtype=table[col].values.dtype)
+      v[o] = table[col].values
+      od.origins[col] = v
+    for col in destinations:
+      v = np.empty(od.n, dtype=table[col].values.dtype)
+      v[d] = table[col].values
+      od.destinations[col] = v
+    return od
+
+  def locate(self, codes):
+    """ Returns the integer index of each of the given geography codes """
+    i = self.index.get_indexer(codes)
+    if (i < 0).any():
+      raise ValueError("geography code(s) not in OD index: %s" % str(np.asarray(codes)[i < 0][:5]))
+    return i
+
+  def set_pair(self, name, values):
+    values = np.asarray(values)
+    if values.shape == (self.n * self.n,):
+      values = values.reshape((self.n, self.n), order="F")
+    if values.shape != (self.n, self.n):
+      raise ValueError("pair values for %s must be %dx%d" % (name, self.n, self.n))
+    self.pairs[name] = values
+
+  def set_origin(self, name, values):
+    values = np.asarray(values)
+    if values.shape != (self.n,):
+      raise ValueError("origin values for %s must be of length %d" % (name, self.n))
+    self.origins[name] = values
+
+  def set_destination(self, name, values):
+    values = np.asarray(values)
+    if values.shape != (self.n,):
+      raise ValueError("destination values for %s must be of length %d" % (name, self.n))
+    self.destinations[name] = values
+
+  def set_factors(self, data, factors, o_prefix="O_", d_prefix="D_", geog_col="GEOGRAPHY_CODE"):
+    """ Array equivalent of merging per-zone factors at both origin and destination. Missing zones become NaN """
+    data = data.set_index(geog_col)[factors].reindex(self.geogs)
+    for factor in factors:
+      values = data[factor].values
+      self.origins[o_prefix + factor] = values
+      self.destinations[d_prefix + factor] = values
+
+  def drop(self, name):
+    for values in [self.pairs, self.origins, self.destinations]:
+      if name in values:
+        del values[name]
+        return
+    raise KeyError(name)
+
+  def zones(self, name):
+    """ Returns the N-vector for an origin or destination column """
+    if name in self.origins:
+      return self.origins[name]
+    if name in self.destinations:
+      return self.destinations[name]
+    raise KeyError(name)
+
+  def matrix(self, name):
+    """ Returns the NxN [origin, destination] matrix for a column, origin/destination values are broadcast (read-only) """
+    if name in self.pairs:
+      return self.pairs[name]
+    if name in self.origins:
+      return np.broadcast_to(self.origins[name][:, np.newaxis], (self.n, self.n))
+    if name in self.destinations:
+      return np.broadcast_to(self.destinations[name][np.newaxis, :], (self.n, self.n))
+    raise KeyError(name)
+
+  def column(self, name):
+    """ Returns the values of a column in row order (destination-major) """
+    if name in self.pairs:
+      return self.pairs[name].ravel(order="F")
+    if name in self.origins:
+      return np.tile(self.origins[name], self.n)
+    if name in self.destinations:
+      return np.repeat(self.destinations[name], self.n)
+    raise KeyError(name)
+
+  @property
+  def columns(self):
+    return pd.Index(list(self.origins) + list(self.destinations) + list(self.pairs))
+
+  @property
+  def hasnans(self):
+    return any(pd.isnull(v).any() for d in [self.pairs, self.origins, self.destinations] for v in d.values())
+
+  def __len__(self):
+    return self.n * self.n
+
+  def __contains__(self, name):
+    return name in self.pairs or name in self.origins or name in self.destinations
+
+  def __getitem__(self, name):
+    if isinstance(name, list):
+      return self.to_dataframe(name)
+    return pd.Series(self.column(name), name=name, copy=False)
+
+  def __setitem__(self, name, values):
+    self.set_pair(name, values)
+
+  def outflows(self, name):
+    """ Returns the total of a pair column by origin """
+    return self.pairs[name].sum(axis=1)
+
+  def copy(self):
+    """ Shallow copy: the arrays are shared but columns can be added/replaced independently """
+    od = type(self).__new__(type(self))
+    od.__dict__.update(self.__dict__)
+    od.pairs = dict(self.pairs)
+    od.origins = dict(self.origins)
+    od.destinations = dict(self.destinations)
+    return od
+
+  def to_dataframe(self, columns=None):
+    """ Materialises the long-format (destination-major) table """
+    if columns is None:
+      columns = list(self.columns)
+    return pd.DataFrame({col: self.column(col) for col in columns}, columns=columns)
+
+class SparseOD(OD):
+  """
+  Origin-destination data for which only a subset of the pairs is stored, e.g. those within a distance cutoff and/or
+  each origin's nearest destinations, for zone systems too fine for NxN arrays:
+  - pair values are stored as vectors over the stored pairs, ordered by destination then origin (as OD's rows)
+  - origin and destination factors are stored as N-vectors, as per OD
+  Flows between pairs that aren't stored can be aggregated by origin (see set_pair_table) as a far-field term
+  """
+  def __init__(self, geogs, o, d, o_col="O_GEOGRAPHY_CODE", d_col="D_GEOGRAPHY_CODE"):
+    """ o and d are the indices (into the sorted geogs) of the origin and destination of each stored pair """
+    super().__init__(geogs, o_col, d_col)
+    keys = np.asarray(d, dtype=np.int64) * self.n + np.asarray(o, dtype=np.int64)
+    self.keys = np.unique(keys)
+    if len(self.keys) != len(keys):
+      raise ValueError("sparse OD pairs must be unique")
+    self.o = (self.keys % self.n).astype(np.intp)
+    self.d = (self.keys // self.n).astype(np.intp)
+
+  @classmethod
+  def from_table(cls, table, pairs, origins=[], destinations=[], o_col="O_GEOGRAPHY_CODE", d_col="D_GEOGRAPHY_CODE"):
+    """ Constructs from a long-format table with one row for each stored pair """
+    geogs = np.union1d(table[o_col].unique(), table[d_col].unique())
+    index = pd.Index(geogs)
+    od = cls(geogs, index.get_indexer(table[o_col]), index.get_indexer(table[d_col]), o_col, d_col)
+    rows = od.pair_index(index.get_indexer(table[o_col]), index.get_indexer(table[d_col]))
+    for col in pairs:
+      values = np.empty(len(od), dtype=table[col].values.dtype)
+      values[rows] = table[col].values
+      od.pairs[col] = values
+    for col in origins:
+      od.origins[col] = pd.Series(table[col].values, index=table[o_col].values).groupby(level=0).first().reindex(od.geogs).values
+    for col in destinations:
+      od.destinations[col] = pd.Series(table[col].values, index=table[d_col].values).groupby(level=0).first().reindex(od.geogs).values
+    return od
+
+  @classmethod
+  def from_od(cls, od, cutoff=None, neighbours=None, far=[]):
+    """
+    Selects the pairs of a (dense) OD within the distance cutoff and/or each origin's nearest neighbours destinations
+    (by DISTANCE), and every O=D pair. The pair columns in far are aggregated by origin beyond these, as FAR_ columns
+    """
+    dists = od.matrix("DISTANCE")
+    stored = np.zeros((od.n, od.n), dtype=bool)
+    np.fill_diagonal(stored, True)
+    if cutoff is not None:
+      stored |= dists <= cutoff
+    if neighbours is not None:
+      nearest = np.argpartition(dists, min(neighbours, od.n - 1), axis=1)[:, :neighbours + 1]
+      stored[np.arange(od.n)[:, np.newaxis], nearest] = True
+    o, d = np.nonzero(stored)
+    sparse = cls(od.geogs, o, d, od.o_col, od.d_col)
+    for name, values in od.pairs.items():
+      sparse.pairs[name] = values[sparse.o, sparse.d]
+    sparse.origins.update(od.origins)
+    sparse.destinations.update(od.destinations)
+    for name in far:
+      sparse.set_origin("FAR_" + name, od.outflows(name) - np.bincount(sparse.o, sparse.pairs[name], od.n))
+    return sparse
+
+  @classmethod
+  def neighbourhood(cls, geogs, x, y, cutoff=None, neighbours=None, min_distance=1.0):
+    """
+    Constructs from zone centroids, storing the pairs within the distance cutoff and/or each origin's nearest
+    neighbours destinations, and every O=D pair, with their DISTANCE (min_distance within a zone).
+    Neither the full distance matrix nor the pairs beyond the neighbourhood are computed
+    """
+    from scipy.spatial import cKDTree
+    if cutoff is None and neighbours is None:
+      raise ValueError("sparse OD requires a distance cutoff and/or a number of neighbours")
+    order = np.argsort(geogs)
+    xy = np.column_stack((x, y))[order]
+    n = len(xy)
+    tree = cKDTree(xy)
+    o, d = [np.arange(n)], [np.arange(n)]
+    if cutoff is not None:
+      close = tree.query_pairs(cutoff, output_type="ndarray")
+      o += [close[:, 0], close[:, 1]]
+      d += [close[:, 1], close[:, 0]]
+    if neighbours is not None:
+      nearest = tree.query(xy, k=min(neighbours + 1, n))[1].reshape((n, -1))
+      o.append(np.repeat(np.arange(n), nearest.shape[1]))
+      d.append(nearest.ravel())
+    keys = np.unique(np.concatenate(d).astype(np.int64) * n + np.concatenate(o))
+    od = cls(np.asarray(geogs)[order], keys % n, keys // n)
+    dists = np.sqrt(((xy[od.o] - xy[od.d]) ** 2).sum(axis=1))
+    dists[od.o == od.d] = min_distance
+    od.pairs["DISTANCE"] = dists
+    return od
+
+  def pair_index(self, o, d):
+    """ Returns the position of each of the given (origin, destination) pairs in the stored pairs, -1 if not stored """
+    keys = np.asarray(d, dtype=np.int64) * self.n + np.asarray(o, dtype=np.int64)
+    i = np.minimum(np.searchsorted(self.keys, keys), len(self.keys) - 1)
+    return np.where(self.keys[i] == keys, i, -1)
+
+  def set_pair_table(self, name, table, value_col, o_col="O_GEOGRAPHY_CODE", d_col="D_GEOGRAPHY_CODE", far=True):
+    """
+    Sets a pair column from a long-format table (e.g. of observed flows), zero for stored pairs not in the table.
+    Unless far is False, the values for pairs that aren't stored are aggregated by origin as FAR_<name>
+    """
+    o = self.locate(table[o_col])
+    d = self.locate(table[d_col])
+    values = table[value_col].values
+    rows = self.pair_index(o, d)
+    stored = rows >= 0
+    # preserving the type, e.g. integer counts
+    self.set_pair(name, np.bincount(rows[stored], values[stored], len(self)).astype(values.dtype))
+    if far:
+      self.set_origin("FAR_" + name, np.bincount(o[~stored], values[~stored], self.n).astype(values.dtype))
+
+  def set_pair(self, name, values):
+    values = np.asarray(values)
+    if values.shape != (len(self),):
+      raise ValueError("pair values for %s must be of length %d" % (name, len(self)))
+    self.pairs[name] = values
+
+  def outflows(self, name):
+    """ Returns the total of a pair column by origin, including the far-field (FAR_) values if any """
+    total = np.bincount(self.o, self.pairs[name], self.n)
+    return total + self.origins["FAR_" + name] if "FAR_" + name in self.origins else total
+
+  def matrix(self, name):
+    """ Returns the (scipy.sparse) NxN [origin, destination] matrix for a column, over the stored pairs """
+    import scipy.sparse as sp
+    return sp.csr_matrix((self.column(name), (self.o, self.d)), shape=(self.n, self.n))
+
+  def column(self, name):
+    """ Returns the values of a column over the stored pairs """
+    if name in self.pairs:
+      return self.pairs[name]
+    if name in self.origins:
+      return self.origins[name][self.o]
+    if name in self.destinations:
+      return self.destinations[name][self.d]
+    raise KeyError(name)
+
+  def __len__(self):
+    return len(self.keys)
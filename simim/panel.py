@@ -0,0 +1,74 @@
+"""
+panel.py
+Per-zone input data over a range of years
+"""
+
+import numpy as np
+import pandas as pd
+
+class Panel():
+  """
+  Year x zone arrays of the per-zone model inputs (population, households, jobs, GVA), providing the same
+  get_people/get_households/get_jobs/get_gva interface as data_apis.Instance. See data_apis.Instance.get_panel
+  """
+  # the columns returned by each accessor
+  PEOPLE = ["PEOPLE"]
+  HOUSEHOLDS = ["HOUSEHOLDS"]
+  JOBS = ["JOBS", "JOBS_PER_WORKING_AGE_PERSON"]
+  GVA = ["GVA"]
+
+  def __init__(self, geogs, years, data=None):
+    self.geogs = np.asarray(geogs)
+    self.index = pd.Index(self.geogs)
+    self.years = np.arange(min(years), max(years) + 1)
+    # factor name -> (years, zones) array
+    self.data = {} if data is None else data
+
+  def row(self, year):
+    if not self.years[0] <= year <= self.years[-1]:
+      raise ValueError("year %d is outside the panel (%d-%d)" % (year, self.years[0], self.years[-1]))
+    return year - self.years[0]
+
+  def set_values(self, factor, years, geogs, values):
+    """ Stores values by year and geography code (all of equal length), ignoring any outside the panel """
+    if factor not in self.data:
+      self.data[factor] = np.full((len(self.years), len(self.geogs)), np.nan)
+    rows = np.asarray(years, dtype=int) - self.years[0]
+    cols = self.index.get_indexer(geogs)
+    inside = (rows >= 0) & (rows < len(self.years)) & (cols >= 0)
+    self.data[factor][rows[inside], cols[inside]] = np.asarray(values)[inside]
+
+  def set_table(self, table, factor, value_col="OBS_VALUE", year_col="PROJECTED_YEAR_NAME", geog_col="GEOGRAPHY_CODE"):
+    """ Stores the values from a long-format (e.g. ukpopulation) table of geography, year and value """
+    self.set_values(factor, table[year_col].values, table[geog_col].values, table[value_col].values)
+
+  def set(self, year, table, factors, geog_col="GEOGRAPHY_CODE"):
+    """ Stores the given year's values from a per-zone table. Zones not in the table are NaN """
+    table = table.set_index(geog_col)[factors].reindex(self.geogs)
+    for factor in factors:
+      if factor not in self.data:
+        self.data[factor] = np.full((len(self.years), len(self.geogs)), np.nan)
+      self.data[factor][self.row(year)] = table[factor].values
+
+  def get(self, year, factors, geogs):
+    """ Returns the given year's values as a per-zone table """
+    row = self.row(year)
+    i = self.index.get_indexer(geogs)
+    if (i < 0).any():
+      raise ValueError("geography code(s) not in panel: %s" % str(np.asarray(geogs)[i < 0][:5]))
+    table = pd.DataFrame({"GEOGRAPHY_CODE": self.geogs[i]})
+    for factor in factors:
+      table[factor] = self.data[factor][row, i]
+    return table
+
+  def get_people(self, year, geogs):
+    return self.get(year, Panel.PEOPLE, geogs)
+
+  def get_households(self, year, geogs):
+    return self.get(year, Panel.HOUSEHOLDS, geogs)
+
+  def get_jobs(self, year, geogs):
+    return self.get(year, Panel.JOBS, geogs)
+
+  def get_gva(self, year, geogs):
+    return self.get(year, Panel.GVA, geogs)
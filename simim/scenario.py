@@ -3,8 +3,11 @@ scenario.py
 Manages scenarios
 """
 
+import numpy as np
 import pandas as pd
 
+from simim.od import OD
+
 class Scenario():
   def __init__(self, filename, factors):
     self.data = pd.read_csv(filename)
@@ -52,6 +55,9 @@ class Scenario():
 
     self.current_scenario = None
     self.current_time = None
+    # the geographies and arrays compiled for them, see compile()
+    self.compiled_geogs = None
+    self.compiled = None
 
   def timeline(self):
     return sorted(self.data.YEAR.unique())
@@ -59,6 +65,38 @@ class Scenario():
   def geographies(self):
     return sorted(self.data.GEOGRAPHY_CODE.unique())
 
+  def compile(self, geogs):
+    """
+    Compiles the scenario into (year x zone) arrays of the cumulative changes for each factor, for every year from
+    the start to the end of the timeline. As per update(), in years not in the scenario the changes are those of the
+    most recent scenario year, and zones not in a scenario year are unchanged
+    """
+    timeline = np.array(self.timeline())
+    years = np.arange(timeline[0], timeline[-1] + 1)
+    # position in the timeline of each row, and of the most recent scenario year for each year
+    rows = np.searchsorted(timeline, self.data.YEAR.values)
+    latest = np.searchsorted(timeline, years, side="right") - 1
+    cols = pd.Index(geogs).get_indexer(self.data.GEOGRAPHY_CODE.values)
+    inside = cols >= 0
+    self.compiled = {}
+    for factor in self.factors:
+      if factor != "O_GEOGRAPHY_CODE" and factor != "D_GEOGRAPHY_CODE":
+        cumulative = np.zeros((len(timeline), len(geogs)))
+        cumulative[rows[inside], cols[inside]] = self.data["CUM_" + factor].fillna(0).values[inside]
+        self.compiled[factor] = cumulative[latest]
+    self.compiled_geogs = np.asarray(geogs)
+    return self.compiled
+
+  def cumulative(self, geogs, year):
+    """ Returns the cumulative changes to each factor by zone for the given year """
+    if self.compiled_geogs is None or not np.array_equal(self.compiled_geogs, geogs):
+      self.compile(geogs)
+    timeline = self.timeline()
+    if year < timeline[0]:
+      raise ValueError("Unable to find a scenario for %s" % year)
+    row = min(year, timeline[-1]) - timeline[0]
+    return { factor: values[row] for factor, values in self.compiled.items() }
+
   def update(self, year):
     """ Returns new scenario if there is data for the given year, otherwise returns the current (cumulative) scenario """
     self.current_time = year
@@ -68,9 +106,30 @@ class Scenario():
       return self.current_scenario
     else:
       print("Persisting existing scenario")
+      if self.current_scenario is None:
+        # e.g. when resuming a run part-way through, use the most recent scenario
+        earlier = self.data.YEAR[self.data.YEAR < year]
+        if len(earlier):
+          self.current_scenario = self.data[self.data.YEAR == earlier.max()]
       return self.current_scenario
 
   def apply(self, dataset, year):
+    """
+    Adds the CHANGED_ values of each factor, i.e. with the cumulative scenario changes for the year added. Origin
+    (O_) factors are changed by the scenario for the origin zone, and destination factors for the destination zone
+    """
+    if isinstance(dataset, OD):
+      # the (compiled) cumulative changes by zone, zero where the scenario doesn't apply
+      print("Updating scenario" if year in self.timeline() else "Persisting existing scenario")
+      self.current_time = year
+      for factor, cumulative in self.cumulative(dataset.geogs, year).items():
+        changed = dataset.zones(factor) + cumulative
+        if factor in dataset.origins:
+          dataset.set_origin("CHANGED_" + factor, changed)
+        else:
+          dataset.set_destination("CHANGED_" + factor, changed)
+      return dataset
+
     # if no scenario for a year, reuse the most recent (cumulative) figures
     self.current_scenario = self.update(year)
 
@@ -79,12 +138,17 @@ class Scenario():
     if self.current_scenario is None:
       raise ValueError("Unable to find a scenario for %s" % year)
     #print(most_recent_scenario.head())
+
     dataset = dataset.merge(self.current_scenario.drop(self.factors, axis=1), how="left", left_on="D_GEOGRAPHY_CODE", right_on="GEOGRAPHY_CODE") \
       .drop(["GEOGRAPHY_CODE", "YEAR"], axis=1).fillna(0)
     for factor in self.factors:
       #print(dataset.columns.values)
       # skip constrained
       if factor != "O_GEOGRAPHY_CODE" and factor != "D_GEOGRAPHY_CODE":
+        if factor.startswith("O_"):
+          # the merge is by destination
+          dataset["CUM_" + factor] = self.current_scenario.set_index("GEOGRAPHY_CODE")["CUM_" + factor] \
+            .reindex(dataset["O_GEOGRAPHY_CODE"]).fillna(0).values
         dataset["CHANGED_" + factor] = dataset[factor] + dataset["CUM_" + factor]
 
     return dataset
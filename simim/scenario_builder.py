@@ -0,0 +1,71 @@
+"""
+scenario_builder.py
+Builds scenarios from rules (uniform allocation, redistribution, new settlements) in the format read by scenario.Scenario
+"""
+
+import numpy as np
+import pandas as pd
+
+_index = ["GEOGRAPHY_CODE", "YEAR"]
+
+def _long(geogs, years, factor, values):
+  """ Long-format scenario table from a zones x years array of annual changes """
+  return pd.DataFrame({"GEOGRAPHY_CODE": np.tile(geogs, len(years)),
+                       "YEAR": np.repeat(years, len(geogs)),
+                       factor: values.T.ravel()})
+
+def uniform(geogs, years, factor, total):
+  """ Allocates a total change in factor evenly over the zones and years """
+  years = np.atleast_1d(years)
+  return _long(geogs, years, factor, np.full((len(geogs), len(years)), total / (len(geogs) * len(years))))
+
+def settlements(geogs, years, factor, annual):
+  """
+  Changes factor by a fixed annual amount in each zone, e.g. for new settlements. annual is a scalar, per zone, or
+  a zones x years array
+  """
+  years = np.atleast_1d(years)
+  annual = np.asarray(annual)
+  if annual.ndim == 1:
+    annual = annual[:, np.newaxis]
+  return _long(geogs, years, factor, np.broadcast_to(annual, (len(geogs), len(years))))
+
+def annual_change(levels, factor):
+  """
+  The annual changes in factor from a long-format table of its levels by zone and year (YEAR or PROJECTED_YEAR_NAME),
+  e.g. a household projection. The first year has no change and is omitted
+  """
+  levels = levels.rename({"PROJECTED_YEAR_NAME": "YEAR"}, axis=1).sort_values(_index)
+  change = levels[_index].assign(**{factor: levels.groupby("GEOGRAPHY_CODE")[factor].diff()})
+  return change[change.YEAR > levels.YEAR.min()].reset_index(drop=True)
+
+def redistribute(baseline, factor, share, destinations, weights=None):
+  """
+  Moves a share of the (baseline) annual changes in factor, summed over its zones, to the destination zones,
+  evenly or in proportion to weights
+  """
+  weights = np.ones(len(destinations)) if weights is None else np.asarray(weights, dtype=float)
+  moved = baseline[_index].assign(**{factor: -share * baseline[factor].values})
+  totals = moved.groupby("YEAR")[factor].sum()
+  received = np.outer(weights / weights.sum(), -totals.values)
+  return pd.concat([moved, _long(destinations, totals.index.values, factor, received)], ignore_index=True)
+
+def build(*tables):
+  """
+  Combines tables of annual changes into a scenario, adding the cumulative (CUM_) columns. Every zone has a row for
+  every scenario year (zero where unchanged) so that the cumulative changes persist
+  """
+  scenario = pd.concat(tables, ignore_index=True)
+  factors = [f for f in scenario.columns if f not in _index]
+  scenario = scenario.groupby(_index, sort=False)[factors].sum()
+  geogs = scenario.index.get_level_values("GEOGRAPHY_CODE").unique()
+  years = np.sort(scenario.index.get_level_values("YEAR").unique())
+  scenario = scenario.reindex(pd.MultiIndex.from_product([years, geogs], names=["YEAR", "GEOGRAPHY_CODE"]).swaplevel(), fill_value=0)
+  cumulative = scenario.groupby(level="GEOGRAPHY_CODE", sort=False).cumsum().add_prefix("CUM_")
+  return pd.concat([scenario, cumulative], axis=1).reset_index()[_index + factors + list(cumulative.columns)]
+
+def write(filename, *tables):
+  """ Builds the scenario and writes it to a csv file """
+  scenario = build(*tables)
+  scenario.to_csv(filename, index=False)
+  return scenario
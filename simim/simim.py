@@ -3,16 +3,13 @@
 import os
 import numpy as np
 import pandas as pd
-import geopandas
-import matplotlib.pyplot as plt
-import contextily as ctx
 import simim.data_apis as data_apis
 import simim.scenario as scenario
 import simim.models as models
+from simim.od import OD, SparseOD
+from simim.cache import FitCache, content_hash, atomic_save, save_matrix, load_matrix
 
-import ukpopulation.utils as ukpoputils
-
-from simim.utils import get_named_values, calc_distances, dist_weighted_sum
+from simim.utils import get_named_values, calc_distance_matrix, dist_weighted_sum, DistanceKernel
 
 ORIGIN_PREFIX = "O_"
 DESTINATION_PREFIX = "D_"
@@ -27,10 +24,85 @@ def _merge_factor(dataset, data, factors):
   return dataset
 
 
-def simim(params):
-
-  #pd.set_option('display.max_columns', None)
+# distance decay function is exp(-ln(0.5)d/l) ensure half the attraction at distance l
+def _decay(l, d):
+  return np.exp(np.log(0.5) / l * d)
+
+def distance_kernel(od_2011):
+  """ The distance weighting for jobs, with half the attraction at 20km """
+  return DistanceKernel(od_2011.matrix("DISTANCE"), od_2011.geogs, 20.0, _decay)
+
+def _assemble(od_2011, snpp, input_data, year, geogs, kernel):
+  """ Attaches the given year's emitters and attractors to the OD data """
+  snhp = input_data.get_households(year, geogs)
+  jobs = input_data.get_jobs(year, geogs)
+  gva = input_data.get_gva(year, geogs)
+
+  # Attach attractors and emitters *all at both origin AND destination*
+  # (per-zone vectors, broadcast across the OD arrays rather than merged)
+  dataset = od_2011.copy()
+  dataset.set_factors(snpp, ["PEOPLE", "PEOPLE_SNPP"])
+  dataset.drop("D_PEOPLE_SNPP")
+  dataset.set_factors(snhp, ["HOUSEHOLDS"])
+  dataset.set_factors(jobs, ["JOBS", "JOBS_PER_WORKING_AGE_PERSON"])
+  dataset.set_factors(gva, ["GVA"])
+
+  dataset = dist_weighted_sum(dataset, "D_JOBS", 20.0, _decay, kernel=kernel)
+
+  # Calculate some derived factors
+  for prefix, set_zones in [(ORIGIN_PREFIX, dataset.set_origin), (DESTINATION_PREFIX, dataset.set_destination)]:
+    area = dataset.zones(prefix + "AREA_KM2")
+    set_zones(prefix + "PEOPLE_DENSITY", dataset.zones(prefix + "PEOPLE") / area)
+    set_zones(prefix + "HOUSEHOLDS_DENSITY", dataset.zones(prefix + "HOUSEHOLDS") / area)
+    set_zones(prefix + "HOUSEHOLDS_SIZE", dataset.zones(prefix + "HOUSEHOLDS") / dataset.zones(prefix + "PEOPLE"))
+    set_zones(prefix + "JOBS_DENSITY", dataset.zones(prefix + "JOBS") / area)
+
+  # London's high GVA does not prevent migration so we artificially reduce it
+  gva_ex_london = dataset.zones(DESTINATION_PREFIX + "GVA").copy()
+  gva_ex_london[dataset.index.str.startswith("E09")] = min(gva_ex_london)
+  dataset.set_destination(DESTINATION_PREFIX + "GVA_EX_LONDON", gva_ex_london)
+
+  # scale up migrations to full population?
+  #dataset.loc[dataset.O_GEOGRAPHY_CODE == dataset.D_GEOGRAPHY_CODE, "MIGRATIONS"] = dataset[dataset.O_GEOGRAPHY_CODE == dataset.D_GEOGRAPHY_CODE].MIGRATIONS * 50
+
+  # save dataset for testing
+  #dataset.to_csv("./tests/data/testdata.csv", index=False)
+
+  # check no bad values
+  if dataset.hasnans:
+    dataset.to_dataframe().to_csv("dataset.csv")
+  assert not dataset.hasnans, "Missing/invalid values in model dataset, dumping to dataset.csv and aborting"
+  return dataset
 
+def _fit(params, dataset, year, init=None, cache=None):
+  """ Calibrates the model to the given dataset, optionally starting from a previous model's parameters and/or using a fit cache """
+  model = models.Model(params["model_type"],
+                       params["model_subtype"],
+                       dataset,
+                       params["observation"],
+                       params["emitters"],
+                       params["attractors"],
+                       params["cost"],
+                       init=init,
+                       cache=cache)
+  emitter_values = get_named_values(model.dataset, params["emitters"])
+  attractor_values = get_named_values(model.dataset, params["attractors"])
+  # check recalculation matches the fitted values
+  assert np.allclose(model.impl.yhat, model(emitter_values, attractor_values))
+
+  # print some model params
+  print("%d data %s/%s Poisson fit (%d iterations):\nR2 = %f, RMSE=%f" % (year, params["model_type"], params["model_subtype"], model.n_iter, model.impl.pseudoR2, model.impl.SRMSE))
+  print("k =", model.k())
+  if params["model_type"] == "gravity" or params["model_type"] == "attraction":
+    print("       ", params["emitters"])
+    print("mu    =", *model.mu())
+  if params["model_type"] == "gravity" or params["model_type"] == "production":
+    print("       ", params["attractors"])
+    print("alpha =", *model.alpha())
+  print("beta = %f" % model.beta())
+  return model
+
+def prefix_factors(params):
   # Differentiate between origin and destination values
   # This allows use of e.g. derived values (e.g. population density) to be both an emitter and an attractor. Absolute values cannot (->singular matrix)
   # enure arrays
@@ -42,6 +114,12 @@ def simim(params):
   params["emitters"] = [ORIGIN_PREFIX + e for e in params["emitters"]]
   params["attractors"] = [DESTINATION_PREFIX + e for e in params["attractors"]]
 
+def simim(params):
+
+  #pd.set_option('display.max_columns', None)
+
+  prefix_factors(params)
+
   scenario_data = scenario.Scenario(os.path.join(params["scenario_dir"], params["scenario"]), params["emitters"] + params["attractors"])
 
   input_data = data_apis.Instance(params)
@@ -49,6 +127,41 @@ def simim(params):
   if params["base_projection"] != "ppp":
     raise NotImplementedError("TODO variant projections...")
 
+  od_2011, movers = prepare(input_data, params.get("distance_dtype", "float64"), params.get("od_cutoff"), params.get("od_neighbours"))
+  resolve_years(params, scenario_data, input_data)
+
+  # get all the per-year data up front
+  panel = input_data.get_panel(od_2011.geogs, panel_years(params))
+
+  return project(params, scenario_data, od_2011, movers, panel, input_data)
+
+def distances(cache_dir, shapefile, geogs, dtype="float64"):
+  """
+  Returns the (memory-mapped) cost matrix of centroid distances between geogs, with the O=D minimum distance, computing
+  and caching it in cache_dir if the shapefile centroids and/or geographies have changed. dtype can be float32 to halve
+  the storage for large zone systems
+  """
+  key = content_hash("distance", np.dtype(dtype).str, np.asarray(shapefile.lad16cd, dtype=str), np.asarray(shapefile.bng_e, dtype=float),
+                     np.asarray(shapefile.bng_n, dtype=float), np.asarray(geogs, dtype=str))
+  filename = os.path.join(cache_dir, "dist_%s.npy" % key)
+  dists = load_matrix(filename, geogs)
+  if dists is not None:
+    print("using cached distances: %s" % filename)
+    return dists
+  # setting minimum cost dist for O=D
+  dists = calc_distance_matrix(shapefile, geogs).astype(dtype)
+  np.fill_diagonal(dists, 1e-0)
+  save_matrix(filename, dists, geogs)
+  return load_matrix(filename, geogs)
+
+def prepare(input_data, distance_dtype="float64", od_cutoff=None, od_neighbours=None):
+  """
+  Returns the 2011 OD data (with distances and areas) and the migration rates by origin, i.e. the inputs common to any
+  scenario. If od_cutoff (km) and/or od_neighbours are given the OD data is sparse (see od.SparseOD): only the pairs
+  within the cutoff distance and/or each origin's nearest neighbours are modelled, and migrations between other pairs
+  are only included in the origin totals (as FAR_MIGRATIONS)
+  """
+
   od_2011 = input_data.get_od()
 
   lad_lookup = input_data.get_lad_lookup()
@@ -75,32 +188,43 @@ def simim(params):
   url = "https://opendata.arcgis.com/datasets/686603e943f948acaa13fb5d2b0f1275_4.zip?outSR=%7B%22wkid%22%3A27700%2C%22latestWkid%22%3A27700%7D"
 
   shapefile = input_data.get_shapefile(url)
-  dists = calc_distances(shapefile)
-  # merge dists with OD
-  od_2011 = od_2011.merge(dists, how="left", left_on=["O_GEOGRAPHY_CODE", "D_GEOGRAPHY_CODE"], right_on=["orig", "dest"]).drop(["orig", "dest"], axis=1)
-  # add areas (converting from square metres (not hectares!) to square km)
-  od_2011 = od_2011.merge(shapefile[["lad16cd", "st_areasha"]], left_on="O_GEOGRAPHY_CODE", right_on="lad16cd").drop("lad16cd", axis=1).rename({"st_areasha": "O_AREA_KM2"}, axis=1)
-  od_2011.loc[:,"O_AREA_KM2"] *= 1e-6
-  od_2011 = od_2011.merge(shapefile[["lad16cd", "st_areasha"]], left_on="D_GEOGRAPHY_CODE", right_on="lad16cd").drop("lad16cd", axis=1).rename({"st_areasha": "D_AREA_KM2"}, axis=1)
-  od_2011.loc[:,"D_AREA_KM2"] *= 1e-6
-
-  # set minimum cost dist for O=D rows
-  od_2011.loc[od_2011.O_GEOGRAPHY_CODE == od_2011.D_GEOGRAPHY_CODE, "DISTANCE"] = 1e-0
-  #print(od_2011.head())
+  # only model areas with boundaries 
+  od_2011 = od_2011[(od_2011.O_GEOGRAPHY_CODE.isin(shapefile.lad16cd)) & (od_2011.D_GEOGRAPHY_CODE.isin(shapefile.lad16cd))]
 
   # TODO need to remap old NI codes 95.. to N... ones
   # 26 LGDs -> 11 in 2014 with N09000... codes
   # see https://www.google.com/url?sa=t&rct=j&q=&esrc=s&source=web&cd=1&ved=2ahUKEwiXzuiWu5rfAhURCxoKHYH1A9YQFjAAegQIBRAC&url=http%3A%2F%2Fwww.ninis2.nisra.gov.uk%2FDownload%2FPopulation%2FBirths%2520to%2520Mothers%2520from%2520Outside%2520Northern%2520Ireland%2520%25202013%2520Provisional%2520(administrative%2520geographies).xlsx&usg=AOvVaw3ZI3EDJAJxtsFQVRMEX37C
+  import ukpopulation.utils as ukpoputils
   if ukpoputils.NI not in input_data.coverage:
     ni = ['95TT', '95XX', '95OO', '95GG', '95DD', '95QQ', '95ZZ', '95VV', '95YY', '95CC',
           '95II', '95NN', '95AA', '95RR', '95MM', '95LL', '95FF', '95BB', '95SS', '95HH',
           '95EE', '95PP', '95UU', '95WW', '95KK', '95JJ']
     od_2011 = od_2011[(~od_2011.O_GEOGRAPHY_CODE.isin(ni)) & (~od_2011.D_GEOGRAPHY_CODE.isin(ni))]
 
-  geogs = od_2011.O_GEOGRAPHY_CODE.unique()
+  # from here on the OD data is held as arrays over a single geography index
+  if od_cutoff is not None or od_neighbours is not None:
+    geogs = np.union1d(od_2011.O_GEOGRAPHY_CODE.unique(), od_2011.D_GEOGRAPHY_CODE.unique())
+    centroids = shapefile.set_index("lad16cd").loc[geogs]
+    # distances (in km) for the stored pairs only
+    table = od_2011
+    od_2011 = SparseOD.neighbourhood(geogs, centroids.bng_e.values / 1000.0, centroids.bng_n.values / 1000.0, od_cutoff, od_neighbours)
+    od_2011.set_pair("DISTANCE", od_2011.column("DISTANCE").astype(distance_dtype))
+    od_2011.set_pair_table("MIGRATIONS", table, "MIGRATIONS")
+    print("Modelling %d of %d OD pairs, %.1f%% of migrations" % (len(od_2011), od_2011.n ** 2,
+      100 * od_2011.column("MIGRATIONS").sum() / od_2011.outflows("MIGRATIONS").sum()))
+  else:
+    od_2011 = OD.from_table(od_2011, ["MIGRATIONS"])
+    # add distances
+    od_2011.set_pair("DISTANCE", distances(input_data.cache_dir, shapefile, od_2011.geogs, distance_dtype))
+  geogs = od_2011.geogs
+
+  # add areas (converting from square metres (not hectares!) to square km)
+  areas = shapefile.set_index("lad16cd").loc[geogs, "st_areasha"].values * 1e-6
+  od_2011.set_origin("O_AREA_KM2", areas)
+  od_2011.set_destination("D_AREA_KM2", areas)
 
   # get no of people who moved (by origin) for each LAD - for later use as a scaling factor for migrations
-  movers = od_2011[["MIGRATIONS", "O_GEOGRAPHY_CODE"]].groupby("O_GEOGRAPHY_CODE").sum()
+  movers = pd.DataFrame({"MIGRATIONS": od_2011.outflows("MIGRATIONS")}, index=pd.Index(geogs, name="O_GEOGRAPHY_CODE"))
   movers = input_data.get_people(2011, geogs).set_index("GEOGRAPHY_CODE").join(movers)
   # Fudge factor 
   movers["MIGRATION_RATE"] = movers["MIGRATIONS"] / movers["PEOPLE"]
@@ -110,31 +234,194 @@ def simim(params):
   # # ensure base dataset is sorted so that the mu/alphas for the constrained models are interpreted correctly
   # od_2011.sort_values(["D_GEOGRAPHY_CODE", "O_GEOGRAPHY_CODE"], inplace=True)
 
+  return od_2011, movers
+
+def resolve_years(params, scenario_data, input_data):
+  """ Sets the start and end years of the model run, if not explicitly configured """
   # use start year if defined in config, otherwise default to SNPP start year
-  start_year = params.get("start_year", input_data.snpp.min_year("en"))
+  params["start_year"] = params.get("start_year", input_data.snpp.min_year("en"))
 
-  if start_year > scenario_data.timeline()[0]:
+  if params["start_year"] > scenario_data.timeline()[0]:
     raise RuntimeError("start year for model run cannot be after start year of scenario")
 
+  # use end year if defined in config, otherwise default to SNPP end year (up to 2039 due to Wales SNPP still being 2014-based)
+  params["end_year"] = params.get("end_year", input_data.snpp.max_year("en"))
+  if params["end_year"] < scenario_data.timeline()[0]:
+    raise RuntimeError("end year for model run cannot be before start year of scenario")
+
+def panel_years(params):
+  """ The first and last years for which input data is needed """
+  return [min(params["start_year"], params.get("calibration_year", params["start_year"])), params["end_year"]]
+
+def calibrate(params, scenario_data, od_2011, input_data, cache=None, kernel=None):
+  """ Calibrates the model once, to the calibration year's data, returning the model and the calibration year """
+  # use calibration year if defined in config, otherwise default to scenario start year
+  calibration_year = params.get("calibration_year", scenario_data.timeline()[0])
+  if calibration_year > scenario_data.timeline()[0]:
+    raise RuntimeError("calibration year cannot be after start year of scenario")
+  geogs = od_2011.geogs
+  # pre-scenario the population is the base projection
+  calibration_snpp = input_data.get_people(calibration_year, geogs)
+  calibration_snpp["PEOPLE_SNPP"] = calibration_snpp.PEOPLE
+  if kernel is None:
+    kernel = distance_kernel(od_2011)
+  model = _fit(params, _assemble(od_2011, calibration_snpp, input_data, calibration_year, geogs, kernel), calibration_year, cache=cache)
+  return model, calibration_year
+
+def fit_cache(params):
+  # fits are cached by content in cache_dir, so rerunning an unchanged model skips the fitting
+  return FitCache(os.path.join(params["cache_dir"], "fits"), params.get("fit_cache_mb", 1024) * 1024 * 1024)
+
+# the parameters that a checkpoint depends on, i.e. everything but the scenario (and end year)
+_checkpoint_params = ["model_type", "model_subtype", "emitters", "attractors", "cost", "base_projection", "coverage",
+                      "start_year", "calibration_year", "refit", "distance_dtype", "od_cutoff", "od_neighbours"]
+
+def checkpoint_file(output):
+  return os.path.splitext(output.output_file)[0] + "_checkpoint.npz"
+
+def save_checkpoint(filename, params, output, year, fits):
+  """
+  Saves the state of the run after the given year: the output so far (from which the population carried over to
+  the next year is reconstructed) and the fitted parameters for each year (NaN for years not fitted)
+  """
+  variant = output.variant
+  atomic_save(filename, year=year, fingerprint=content_hash([params.get(p) for p in _checkpoint_params], variant.geogs),
+    geogs=variant.geogs.astype(str), years=variant.years, fits=fits, **{ name: variant.data[name] for name in output.COLUMNS + ["written"] })
+
+def load_checkpoint(filename, params, output, year=None):
+  """
+  Restores the output up to and including the checkpointed year (or the given earlier year) from a checkpoint
+  saved by a run with the same model and data, but possibly a different scenario after that year. The final year of
+  the run is always recomputed. Returns the year and the fitted parameters by year
+  """
+  variant = output.variant
+  with np.load(filename) as checkpoint:
+    if str(checkpoint["fingerprint"]) != content_hash([params.get(p) for p in _checkpoint_params], variant.geogs):
+      raise ValueError("checkpoint %s is from a different model configuration" % filename)
+    last_year = min(int(checkpoint["year"]), params["end_year"] - 1)
+    year = last_year if year is None else year
+    if not checkpoint["years"][0] <= year <= last_year:
+      raise ValueError("cannot resume from %s at %d (must be %d-%d)" % (filename, year, checkpoint["years"][0], last_year))
+    # years in the checkpoint up to and including year
+    rows = np.arange(year - checkpoint["years"][0] + 1)
+    for name in output.COLUMNS + ["written"]:
+      variant.data[name][variant.row(checkpoint["years"][0]) + rows] = checkpoint[name][rows]
+    fits = { int(y): f for y, f in zip(checkpoint["years"][rows], checkpoint["fits"][rows]) if not np.isnan(f).all() }
+  return year, fits
+
+def _fits_array(fits, output):
+  """ The fitted parameters as a years x params array (NaN for years not fitted) """
+  size = len(next(iter(fits.values()))) if fits else 0
+  array = np.full((len(output.variant.years), size), np.nan)
+  for year, params in fits.items():
+    array[output.variant.row(year)] = params
+  return array
+
+def _carried_over(output, year):
+  """ Reconstructs the per-zone state carried over to the year after the given one from the output """
+  snpp = output.variant.get(year, output.COLUMNS, output.variant.geogs)
+  snpp["net_delta_prev"] = 0.0
+  if year > output.variant.years[0] and output.variant.data["written"][output.variant.row(year - 1)]:
+    snpp["net_delta_prev"] = output.variant.data["net_delta"][output.variant.row(year - 1)]
+  return snpp
+
+def _sparse_delta(model, movers, emitter_values, attractor_values, changed_attractor_values):
+  """
+  Evaluates the changes in migration (scaled by the origin migration rates) due to changed attractor values, for
+  gravity and production models on OD data: only the flows to destinations with changed values are recomputed.
+  Returns the changes by zone and the destinations and their [origin, destination] changed flows
+  """
+  geogs = model.dataset.geogs
+  dests = np.flatnonzero(np.any([np.asarray(changed) != np.asarray(values) for changed, values in zip(changed_attractor_values, attractor_values)], axis=0))
+  flows = model.block(emitter_values, changed_attractor_values, destinations=dests)
+  # upscale delta by mover percentage at origin
+  delta = (model.dataset.matrix("MODEL_MIGRATIONS")[:, dests] - flows) / movers["MIGRATION_RATE"].reindex(geogs).values[:, np.newaxis]
+  d_delta = np.zeros(len(geogs))
+  d_delta[dests] = delta.sum(axis=0)
+  return _zone_delta(geogs, delta.sum(axis=1), d_delta), (dests, flows)
+
+def _dense_delta(model, movers):
+  """
+  Computes the changes in migration (scaled by the origin migration rates) by zone from the re-evaluated
+  CHANGED_MIGRATIONS, as row and column sums of the OD matrix or, for sparse OD and table datasets, bincounts over
+  the zones. For sparse OD datasets the (far-field) migrations between pairs that aren't stored are unchanged
+  """
+  if isinstance(model.dataset, SparseOD):
+    geogs = model.dataset.geogs
+    o, d = model.dataset.o, model.dataset.d
+    delta = (model.dataset.column("MODEL_MIGRATIONS") - model.dataset.column("CHANGED_MIGRATIONS")) \
+      / movers["MIGRATION_RATE"].reindex(geogs).values[o]
+    return _zone_delta(geogs, np.bincount(o, delta, len(geogs)), np.bincount(d, delta, len(geogs)))
+  if isinstance(model.dataset, OD):
+    geogs = model.dataset.geogs
+    # upscale delta by mover percentage at origin
+    delta = (model.dataset.matrix("MODEL_MIGRATIONS") - model.dataset.matrix("CHANGED_MIGRATIONS")) \
+      / movers["MIGRATION_RATE"].reindex(geogs).values[:, np.newaxis]
+    return _zone_delta(geogs, delta.sum(axis=1), delta.sum(axis=0))
+  o, geogs = pd.factorize(model.dataset["O_GEOGRAPHY_CODE"], sort=True)
+  d = geogs.get_indexer(model.dataset["D_GEOGRAPHY_CODE"])
+  if np.any(d < 0):
+    raise ValueError("destinations must also be origins")
+  delta = (model.dataset["MODEL_MIGRATIONS"].values - model.dataset["CHANGED_MIGRATIONS"].values) \
+    / movers["MIGRATION_RATE"].reindex(geogs).values[o]
+  return _zone_delta(geogs.values, np.bincount(o, delta, len(geogs)), np.bincount(d, delta, len(geogs)))
+
+def _zone_delta(geogs, o_delta, d_delta):
+  delta = pd.DataFrame({"lad16cd": geogs, "o_delta": o_delta, "d_delta": d_delta})
+  # compute net migration change
+  delta["net_delta"] = delta.o_delta - delta.d_delta
+  return delta
+
+def project(params, scenario_data, od_2011, movers, input_data, output):
+  """
+  Runs the model over the scenario, appending the custom variant to output for each year.
+  input_data supplies the per-year population, households, jobs and GVA (e.g. a data_apis.Instance or a panel.Panel)
+  Unless "checkpoint" is false, the state of the run is saved after each year. Set "resume" to true to continue from
+  the last year in the run's checkpoint or to the filename of another checkpoint (e.g. from a run of a scenario that
+  differs only in later years), and optionally "resume_year" to continue from an earlier year in the checkpoint
+  """
+  geogs = od_2011.geogs
+  # the distance weights don't change from year to year
+  kernel = distance_kernel(od_2011)
+  output.reserve(geogs, [params["start_year"], params["end_year"]])
+  checkpoint = checkpoint_file(output) if params.get("checkpoint", True) else None
+  # fitted parameters by year
+  fits = {}
+
+  resume_year = params["start_year"] - 1
+  if params.get("resume", False):
+    resume_from = checkpoint_file(output) if params["resume"] is True else params["resume"]
+    resume_year, fits = load_checkpoint(resume_from, params, output, params.get("resume_year"))
+    print("resuming from %d (%s)" % (resume_year, resume_from))
+    if resume_year >= params["start_year"]:
+      snpp = _carried_over(output, resume_year)
+
   # loop from snpp start to just before scenario start
-  for year in range(start_year, scenario_data.timeline()[0]):
+  for year in range(resume_year + 1, scenario_data.timeline()[0]):
     snpp = input_data.get_people(year, geogs)
     # pre-secenario the custom variant is same as the base projection
     snpp["PEOPLE_SNPP"] = snpp.PEOPLE
     snpp["net_delta"] = 0
     snpp["net_delta_prev"] = 0
-    input_data.append_output(snpp, year)
+    output.append_output(snpp, year)
+    if checkpoint:
+      save_checkpoint(checkpoint, params, output, year, _fits_array(fits, output))
     print("pre-scenario %d" % year)
 
+  # by default the model is calibrated once and the parameters reused for every projection year, 
+  # set "refit" to recalibrate every year (with that year's emitters and attractors) instead
+  refit = params.get("refit", False)
+  cache = fit_cache(params)
   model = None
+  if not refit:
+    model, calibration_year = calibrate(params, scenario_data, od_2011, input_data, cache, kernel)
 
-  # use end year if defined in config, otherwise default to SNPP end year (up to 2039 due to Wales SNPP still being 2014-based)
-  end_year = params.get("end_year", input_data.snpp.max_year("en"))
-  if end_year < scenario_data.timeline()[0]:
-    raise RuntimeError("end year for model run cannot be before start year of scenario")
+  elif resume_year in fits:
+    # continue from the fit for the year resumed from
+    model = fits[resume_year]
 
   # loop over scenario years to end_year
-  for year in range(scenario_data.timeline()[0], end_year + 1):
+  for year in range(max(scenario_data.timeline()[0], resume_year + 1), params["end_year"] + 1):
     # drop the baseline for the previous year if present (it interferes with the merge)
     # if "PEOPLE_" + params["base_projection"] in snpp:
     #   snpp.drop("PEOPLE_" + params["base_projection"], axis=1, inplace=True)
@@ -151,80 +438,20 @@ def simim(params):
     #print(snpp[snpp.GEOGRAPHY_CODE.isin(scenario_data.geographies())])
     snpp["PEOPLE"] = (snpp.PEOPLE_prev + snpp.net_delta - snpp.net_delta_prev) + (snpp.PEOPLE_SNPP - snpp.PEOPLE_SNPP_prev)
     
-    snpp.drop(["PEOPLE_SNPP_prev", "net_delta_prev", "PROJECTED_YEAR_NAME"], axis=1, inplace=True)
+    snpp.drop(["PEOPLE_SNPP_prev", "net_delta_prev"], axis=1, inplace=True)
     snpp = snpp.rename({"net_delta": "net_delta_prev"}, axis=1)
 
-    snhp = input_data.get_households(year, geogs)
-
-    jobs = input_data.get_jobs(year, geogs)
-
-    gva = input_data.get_gva(year, geogs)
-
-    # Merge attractors and emitters *all at both origin AND destination*
-    dataset = _merge_factor(od_2011, snpp, ["PEOPLE", "PEOPLE_SNPP"]).drop("D_PEOPLE_SNPP", axis=1)
-    #print(dataset.head())
-    dataset = _merge_factor(dataset, snhp, ["HOUSEHOLDS"]) 
-    dataset = _merge_factor(dataset, jobs, ["JOBS", "JOBS_PER_WORKING_AGE_PERSON"])
-    dataset = _merge_factor(dataset, gva, ["GVA"])
-
-    # distance decay function is exp(-ln(0.5)d/l) ensure half the attraction at distance l
-    dataset = dist_weighted_sum(dataset, "D_JOBS", 20.0, lambda l, d: np.exp(np.log(0.5) / l * d))
-
-    # Calculate some derived factors
-    dataset[ORIGIN_PREFIX + "PEOPLE_DENSITY"] = dataset[ORIGIN_PREFIX + "PEOPLE"] / dataset.O_AREA_KM2
-    dataset[ORIGIN_PREFIX + "HOUSEHOLDS_DENSITY"] = dataset[ORIGIN_PREFIX + "HOUSEHOLDS"] / dataset.O_AREA_KM2
-    dataset[ORIGIN_PREFIX + "HOUSEHOLDS_SIZE"] = dataset[ORIGIN_PREFIX + "HOUSEHOLDS"] / dataset.O_PEOPLE
-    dataset[ORIGIN_PREFIX + "JOBS_DENSITY"] = dataset[ORIGIN_PREFIX + "JOBS"] / dataset.O_AREA_KM2
-
-    dataset[DESTINATION_PREFIX + "PEOPLE_DENSITY"] = dataset[DESTINATION_PREFIX + "PEOPLE"] / dataset.D_AREA_KM2
-    dataset[DESTINATION_PREFIX + "HOUSEHOLDS_DENSITY"] = dataset[DESTINATION_PREFIX + "HOUSEHOLDS"] / dataset.D_AREA_KM2
-    dataset[DESTINATION_PREFIX + "HOUSEHOLDS_SIZE"] = dataset[DESTINATION_PREFIX + "HOUSEHOLDS"] / dataset.D_PEOPLE
-    dataset[DESTINATION_PREFIX + "JOBS_DENSITY"] = dataset[DESTINATION_PREFIX + "JOBS"] / dataset.D_AREA_KM2
-
-    # London's high GVA does not prevent migration so we artificially reduce it
-    dataset[DESTINATION_PREFIX + "GVA_EX_LONDON"] = dataset[DESTINATION_PREFIX + "GVA"]
-    min_gva = min(dataset[DESTINATION_PREFIX + "GVA"])
-    dataset.loc[dataset.D_GEOGRAPHY_CODE.str.startswith("E09"), DESTINATION_PREFIX + "GVA_EX_LONDON"] = min_gva 
-
-    # scale up migrations to full population?
-    #dataset.loc[dataset.O_GEOGRAPHY_CODE == dataset.D_GEOGRAPHY_CODE, "MIGRATIONS"] = dataset[dataset.O_GEOGRAPHY_CODE == dataset.D_GEOGRAPHY_CODE].MIGRATIONS * 50
-
-    # save dataset for testing
-    #dataset.to_csv("./tests/data/testdata.csv", index=False)
-
-    # check no bad values
-    if len(dataset[dataset.isnull().any(axis=1)]) > 0:
-      dataset.to_csv("dataset.csv")
-    assert len(dataset[dataset.isnull().any(axis=1)]) == 0, "Missing/invalid values in model dataset, dumping to dataset.csv and aborting"
-
-    # print(dataset[(dataset.O_GEOGRAPHY_CODE == dataset.D_GEOGRAPHY_CODE) 
-    #             & (dataset.O_GEOGRAPHY_CODE.isin(scenario_data.geographies()))])
-    model = models.Model(params["model_type"],
-                         params["model_subtype"],
-                         dataset,
-                         params["observation"],
-                         params["emitters"],
-                         params["attractors"],
-                         params["cost"])
+    dataset = _assemble(od_2011, snpp, input_data, year, geogs, kernel)
+    if refit:
+      # start from the previous year's fit
+      model = _fit(params, dataset, year, init=model, cache=cache)
+      fits[year] = model.impl.params
+    else:
+      model.rebase(dataset)
+      print("%d data evaluated with %s/%s model calibrated on %d data" % (year, params["model_type"], params["model_subtype"], calibration_year))
     # dataset is now sunk into model, prevent accidental access by deleting the original
     del dataset
 
-    emitter_values = get_named_values(model.dataset, params["emitters"])
-    attractor_values = get_named_values(model.dataset, params["attractors"])
-    # check recalculation matches the fitted values
-    assert np.allclose(model.impl.yhat, model(emitter_values, attractor_values))
-
-    # print some model params
-    print("%d data %s/%s Poisson fit:\nR2 = %f, RMSE=%f" % (year, params["model_type"], params["model_subtype"], model.impl.pseudoR2, model.impl.SRMSE))
-    print("k =", model.k())
-    if params["model_type"] == "gravity" or params["model_type"] == "attraction":
-      print("       ", params["emitters"])
-      print("mu    =", *model.mu())
-    if params["model_type"] == "gravity" or params["model_type"] == "production":
-      print("       ", params["attractors"])
-      print("alpha =", *model.alpha())
-    print("beta = %f" % model.beta())
-
     # apply scenario to dataset
     model.dataset = scenario_data.apply(model.dataset, year)
 
@@ -237,35 +464,35 @@ def simim(params):
     # TODO allow for scenarios on origin parameters
     emitter_values = get_named_values(model.dataset, params["emitters"], prefix="")
 
-    # re-evaluate model and record changes
-    model.dataset["CHANGED_MIGRATIONS"] = model(emitter_values, changed_attractor_values)
-    # print(model.dataset[dataset.MIGRATIONS != dataset.CHANGED_MIGRATIONS])
+    if isinstance(model.dataset, OD) and not isinstance(model.dataset, SparseOD) and params["model_type"] in ["gravity", "production"]:
+      # only flows to the destinations whose attractors are changed by the scenario need to be re-evaluated
+      delta, changed = _sparse_delta(model, movers, emitter_values, get_named_values(model.dataset, params["attractors"]), changed_attractor_values)
+    else:
+      changed = None
+      # re-evaluate model and record changes
+      model.dataset["CHANGED_MIGRATIONS"] = model(emitter_values, changed_attractor_values)
+      # print(model.dataset[dataset.MIGRATIONS != dataset.CHANGED_MIGRATIONS])
 
-    # compute migration inflows and outflow changes
-    delta = pd.DataFrame({"o_lad16cd": model.dataset.O_GEOGRAPHY_CODE,
-                          "d_lad16cd": model.dataset.D_GEOGRAPHY_CODE,
-                          "delta": -model.dataset.CHANGED_MIGRATIONS + model.dataset.MODEL_MIGRATIONS})
-    # upscale delta by mover percentage at origin
-    delta = pd.merge(delta, movers, left_on="o_lad16cd", right_index=True) 
-    delta["delta"] = delta["delta"] / delta["MIGRATION_RATE"]
-    delta = delta.drop(["PEOPLE", "MIGRATIONS", "MIGRATION_RATE"], axis=1)
-    
-    # remove in-LAD migrations and sun
-    o_delta = delta.groupby("o_lad16cd").sum().reset_index().rename({"o_lad16cd": "lad16cd", "delta": "o_delta"}, axis=1)
-    d_delta = delta.groupby("d_lad16cd").sum().reset_index().rename({"d_lad16cd": "lad16cd", "delta": "d_delta"}, axis=1)
-    delta = o_delta.merge(d_delta)
-    # compute net migration change
-    delta["net_delta"] = delta.o_delta - delta.d_delta
+      delta = _dense_delta(model, movers)
 
     #print(delta[delta["lad16cd"].isin(scenario_data.geographies())])
     print("Change in migrations to scenario region: %.0f" % delta[delta["lad16cd"].isin(scenario_data.geographies())]["net_delta"].sum())
 
     # add to results
-    snpp = snpp.merge(delta, left_on="GEOGRAPHY_CODE", right_on="lad16cd").drop(["lad16cd", "o_delta", "d_delta"], axis=1)
-    input_data.append_output(snpp, year)
+    snpp["net_delta"] = delta["net_delta"].values[pd.Index(delta["lad16cd"]).get_indexer(snpp["GEOGRAPHY_CODE"])]
+    output.append_output(snpp, year)
+    if checkpoint:
+      save_checkpoint(checkpoint, params, output, year, _fits_array(fits, output))
+
+  if changed is not None:
+    # the full matrix of changed flows is only needed for the final year's result
+    dests, flows = changed
+    changed_flows = model.dataset.matrix("MODEL_MIGRATIONS").copy()
+    changed_flows[:, dests] = flows
+    model.dataset["CHANGED_MIGRATIONS"] = changed_flows
 
-  input_data.summarise_output(scenario_data)
+  output.summarise_output(scenario_data)
 
   #print(model.dataset[["O_GEOGRAPHY_CODE", "D_GEOGRAPHY_CODE", "O_PEOPLE", "D_PEOPLE", "MIGRATIONS", "CHANGED_MIGRATIONS"]].head())
 
-  return model, input_data, delta, model.dataset[["O_GEOGRAPHY_CODE", "D_GEOGRAPHY_CODE", "O_PEOPLE", "D_PEOPLE", "MIGRATIONS", "CHANGED_MIGRATIONS"]]
+  return model, output, delta, model.dataset[["O_GEOGRAPHY_CODE", "D_GEOGRAPHY_CODE", "O_PEOPLE", "D_PEOPLE", "MIGRATIONS", "CHANGED_MIGRATIONS"]]
@@ -0,0 +1,98 @@
+"""
+synthetic.py
+Synthetic zone systems and OD datasets, e.g. for testing and benchmarking at finer (MSOA/LSOA) scales
+"""
+
+import numpy as np
+import pandas as pd
+
+from simim.od import OD, SparseOD
+
+def zones(n, seed=0, population=65e6, extent=(700.0, 1000.0), urban=0.7):
+  """
+  Generates n zones (with codes Z00000000...) in a region of the given extent (km), as census geographies are:
+  similar populations, so smaller and more densely packed in the urban centres, where a fraction (urban) of the zones
+  are clustered. Returns a per-zone table of centroid (EASTING, NORTHING in km), AREA_KM2, PEOPLE, HOUSEHOLDS and JOBS
+  """
+  from scipy.spatial import cKDTree
+  rng = np.random.RandomState(seed)
+  # urban centres of varying size, with the zones around them normally distributed
+  ncentres = int(np.clip(np.sqrt(n), 5, 200))
+  centres = rng.uniform(0, 1, (ncentres, 2)) * extent
+  size = rng.pareto(1.5, ncentres) + 1
+  nurban = int(n * urban)
+  centre = rng.choice(ncentres, nurban, p=size / size.sum())
+  xy = np.vstack([centres[centre] + rng.normal(0, 1, (nurban, 2)) * 5.0 * np.sqrt(size[centre])[:, np.newaxis],
+                  rng.uniform(0, 1, (n - nurban, 2)) * extent])
+  # reflected back into the region at the edges
+  xy = np.asarray(extent) - np.abs(np.asarray(extent) - np.abs(xy))
+  # zone area from the (squared) distance to its nearest neighbours
+  spacing = cKDTree(xy).query(xy, k=min(n, 5))[0][:, 1:].mean(axis=1) if n > 1 else np.full(1, np.sqrt(np.prod(extent)))
+  area = np.maximum(spacing ** 2, 0.01)
+  area *= np.prod(extent) / area.sum()
+
+  people = np.round(rng.lognormal(0, 0.3, n) * population / n)
+  density = people / area
+  # with smaller households in the denser zones
+  households = np.round(people / (rng.uniform(2.3, 2.7, n) - 0.3 * (density > np.median(density))))
+  # jobs are concentrated in the densest zones
+  jobs = np.round(0.45 * people * (density / np.median(density)) ** 0.3 * rng.lognormal(0, 0.4, n))
+  return pd.DataFrame({"GEOGRAPHY_CODE": ["Z%08d" % i for i in range(n)], "EASTING": xy[:, 0], "NORTHING": xy[:, 1],
+                       "AREA_KM2": area, "PEOPLE": people, "HOUSEHOLDS": households, "JOBS": jobs})
+
+def od(n, seed=0, rate=0.1, mu=0.9, alpha=0.8, beta=-1.5, dtype="float64", cutoff=None, neighbours=None, block=None, **kwargs):
+  """
+  Generates an n-zone OD dataset (see zones(), to which kwargs are passed) with Poisson-distributed MIGRATIONS
+  following a (power) gravity model of origin PEOPLE, destination HOUSEHOLDS and DISTANCE between the zone centroids
+  (1km within a zone), totalling rate times the population. If cutoff (km) and/or neighbours are given a SparseOD of
+  those pairs is returned, with the migrations to other destinations as FAR_MIGRATIONS. The flows are computed in
+  blocks of destinations, so the memory required is proportional to the number of pairs stored
+  """
+  data = zones(n, seed, **kwargs)
+  rng = np.random.RandomState(seed + 1)
+  x, y = data.EASTING.values, data.NORTHING.values
+  emitters = data.PEOPLE.values ** mu
+  attractors = data.HOUSEHOLDS.values ** alpha
+  if block is None:
+    block = max(1, 2 ** 24 // n)
+
+  # the (unscaled) total flow from each origin
+  totals = np.zeros(n)
+  for start in range(0, n, block):
+    d = slice(start, start + block)
+    dists = np.sqrt((x[:, np.newaxis] - x[np.newaxis, d]) ** 2 + (y[:, np.newaxis] - y[np.newaxis, d]) ** 2)
+    dists[np.arange(start, min(start + block, n)), np.arange(dists.shape[1])] = 1.0
+    totals += dists ** beta @ attractors[d]
+  totals *= emitters
+  k = rate * data.PEOPLE.sum() / totals.sum()
+
+  if cutoff is not None or neighbours is not None:
+    od = SparseOD.neighbourhood(data.GEOGRAPHY_CODE.values, x, y, cutoff, neighbours)
+    expected = k * emitters[od.o] * attractors[od.d] * od.column("DISTANCE") ** beta
+    od.set_pair("MIGRATIONS", rng.poisson(expected).astype(np.int32))
+    od.set_pair("DISTANCE", od.column("DISTANCE").astype(dtype))
+    od.set_origin("FAR_MIGRATIONS", rng.poisson(np.maximum(k * totals - np.bincount(od.o, expected, n), 0)).astype(np.int32))
+  else:
+    od = OD(data.GEOGRAPHY_CODE.values)
+    flows = np.empty((n, n), dtype=np.int32, order="F")
+    dists = np.empty((n, n), dtype=dtype, order="F")
+    for start in range(0, n, block):
+      d = slice(start, start + block)
+      dists[:, d] = np.sqrt((x[:, np.newaxis] - x[np.newaxis, d]) ** 2 + (y[:, np.newaxis] - y[np.newaxis, d]) ** 2)
+    np.fill_diagonal(dists, 1.0)
+    for start in range(0, n, block):
+      d = slice(start, start + block)
+      flows[:, d] = rng.poisson(k * emitters[:, np.newaxis] * attractors[np.newaxis, d] * dists[:, d].astype(float) ** beta)
+    od.set_pair("MIGRATIONS", flows)
+    od.set_pair("DISTANCE", dists)
+
+  od.set_origin("PEOPLE", data.PEOPLE.values)
+  od.set_destination("HOUSEHOLDS", data.HOUSEHOLDS.values)
+  od.set_destination("JOBS", data.JOBS.values)
+  od.set_origin("O_AREA_KM2", data.AREA_KM2.values)
+  od.set_destination("D_AREA_KM2", data.AREA_KM2.values)
+  return od
+
+def dataset(n, seed=0, **kwargs):
+  """ An n-zone OD dataset in the (long-format) schema of the test dataset, see od() """
+  return od(n, seed, **kwargs).to_dataframe(["MIGRATIONS", "O_GEOGRAPHY_CODE", "D_GEOGRAPHY_CODE", "DISTANCE", "PEOPLE", "HOUSEHOLDS", "JOBS"])
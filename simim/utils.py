@@ -5,20 +5,29 @@ import numpy as np
 import pandas as pd
 import hashlib
 import json
-from scipy.stats.stats import pearsonr 
-from scipy.spatial.distance import squareform, pdist
+
+from simim.od import OD, SparseOD
 
 def md5hash(string):
   m = hashlib.md5()
   m.update(string.encode('utf-8'))
   return m.hexdigest()
 
+def md5file(filename):
+  m = hashlib.md5()
+  with open(filename, "rb") as f:
+    for chunk in iter(lambda: f.read(1024 * 1024), b""):
+      m.update(chunk)
+  return m.hexdigest()
+
 def get_named_values(dataset, colnames, prefix=""):
-  """ Returns a list of Series from dataset, optionally prefixed when modified original values are needed"""
+  """ Returns a list of Series from dataset, optionally prefixed when modified original values are needed
+  For OD datasets the (unexpanded) per-zone values are returned"""
+  get = dataset.zones if isinstance(dataset, OD) else dataset.__getitem__
   if not isinstance(colnames, list):
-    return dataset[prefix+colnames]
+    return get(prefix+colnames)
   else:
-    return [dataset[prefix+colname] for colname in colnames]
+    return [get(prefix+colname) for colname in colnames]
 
 
 def get_data(local, remote):
@@ -29,18 +38,72 @@ def get_data(local, remote):
     data.to_csv(local, index=False)
   return data
 
-def calc_distances(gdf):
+def calc_distance_matrix(gdf, geogs=None):
+  """ Returns the matrix of centroid distances in km, optionally ordered by the given geography codes """
+  from scipy.spatial.distance import squareform, pdist
   # for now makes assumptions about column names and units
-  dists = pd.DataFrame(squareform(pdist(pd.DataFrame({"e": gdf.bng_e, "n": gdf.bng_n}))), columns=gdf.lad16cd.unique(), index=gdf.lad16cd.unique())
+  if geogs is not None:
+    gdf = gdf.set_index("lad16cd").loc[geogs].reset_index()
+  return squareform(pdist(np.column_stack((gdf.bng_e, gdf.bng_n)))) / 1000.0
+
+def calc_distances(gdf):
+  dists = pd.DataFrame(calc_distance_matrix(gdf), columns=gdf.lad16cd.unique(), index=gdf.lad16cd.unique())
   # turn matrix into table
   dists = dists.stack().reset_index().rename({"level_0": "orig", "level_1": "dest", 0: "DISTANCE"}, axis=1)
-  # convert to km 
-  dists.DISTANCE = dists.DISTANCE / 1000.0
   return dists
 
-def dist_weighted_sum(dataset, colname, halfdist, decay_function):
+class DistanceKernel():
+  """
+  Distance decay weights for destination distance-weighted sums, computed once from the (origin x destination)
+  distance matrix: the weight for destination d is the sum over origins o of decay(l, dist[o,d]), with the half-distance
+  l doubled for London (E09) destinations. Several half-distances and/or decay functions can be computed together.
+  For a (scipy.sparse) distance matrix only the stored pairs contribute
+  """
+  def __init__(self, dists, geogs, halfdists, decay_functions):
+    halfdists = np.atleast_1d(halfdists)
+    if callable(decay_functions):
+      decay_functions = [decay_functions]
+    if len(halfdists) == 1:
+      halfdists = np.repeat(halfdists, len(decay_functions))
+    if len(decay_functions) == 1:
+      decay_functions = decay_functions * len(halfdists)
+    if len(halfdists) != len(decay_functions):
+      raise ValueError("half-distances and decay functions must correspond")
+    self.halfdists = halfdists
+    self.decay_functions = decay_functions
+
+    # apart from London, which decays more slowly due to transport links and wages
+    london = pd.Index(geogs).str.startswith("E09")
+    if hasattr(dists, "tocoo"):
+      dists = dists.tocoo()
+      self.weights = np.column_stack([np.bincount(dists.col, decay(np.where(london, 2 * halfdist, halfdist)[dists.col], dists.data), len(geogs))
+                                      for halfdist, decay in zip(halfdists, decay_functions)])
+      return
+    ones = np.ones(len(geogs))
+    self.weights = np.column_stack([ones @ decay(np.where(london, 2 * halfdist, halfdist)[np.newaxis, :], dists)
+                                    for halfdist, decay in zip(halfdists, decay_functions)])
+
+  def __call__(self, values):
+    """ Returns the distance-weighted values, one column per half-distance/decay function """
+    return np.asarray(values)[:, np.newaxis] * self.weights
+
+  def column(self, halfdist, decay_function):
+    """ The column of the weights for the half-distance and decay function """
+    for i, (l, decay) in enumerate(zip(self.halfdists, self.decay_functions)):
+      if l == halfdist and decay is decay_function:
+        return i
+    raise ValueError("distance kernel wasn't computed for half-distance %s and decay function %s" % (halfdist, getattr(decay_function, "__name__", decay_function)))
+
+def dist_weighted_sum(dataset, colname, halfdist, decay_function, kernel=None):
   # exponential decay with half the attraction at 20km
   # apart from London, which decays more slowly due to transport links and wages 
+  if isinstance(dataset, OD):
+    # the kernel can be precomputed as it depends only on the distances, but must be for the same half-distance and decay
+    if kernel is None:
+      kernel = DistanceKernel(dataset.matrix("DISTANCE"), dataset.geogs, halfdist, decay_function)
+    dataset.set_destination(colname + "_DISTWEIGHTED", kernel(dataset.zones(colname))[:, kernel.column(halfdist, decay_function)])
+    return dataset
+
   dataset["LEN"] = halfdist 
   dataset.loc[dataset.D_GEOGRAPHY_CODE.str.startswith("E09"), "LEN"] = 2 * halfdist
 
@@ -49,26 +112,37 @@ def dist_weighted_sum(dataset, colname, halfdist, decay_function):
   dataset = dataset.merge(wsum, on="D_GEOGRAPHY_CODE") \
     .drop(colname + "_DISTWEIGHTED_x", axis=1) \
     .rename({colname + "_DISTWEIGHTED_y": colname + "_DISTWEIGHTED"}, axis=1)
-  dataset.to_csv("wdist.csv", index=False)
 
   return dataset
 
 def r2(fitted, actual):
+  from scipy.stats import pearsonr
   return pearsonr(fitted, actual)[0] ** 2
 
 def rmse(fitted, actual):
   return np.sqrt(np.mean((fitted - actual) ** 2))
 
 def od_matrix(dataset, value_col, o_col, d_col):
+  if isinstance(dataset, SparseOD):
+    # zero for the pairs that aren't stored
+    return np.nan_to_num(dataset.matrix(value_col).toarray())
+  if isinstance(dataset, OD):
+    return np.nan_to_num(dataset.matrix(value_col))
   return np.nan_to_num(dataset[[value_col, o_col, d_col]].set_index([o_col, d_col]).unstack().values)
 
 def get_config():
   parser = argparse.ArgumentParser(description="spatial interaction model of internal migration")
   parser.add_argument("-c", "--config", required=True, type=str, metavar="config-file", help="the model configuration file (json). See config/default.json")
+  parser.add_argument("-r", "--resume", nargs="?", const=True, metavar="checkpoint", help="continue from the run's checkpoint, or the given checkpoint file")
+  parser.add_argument("-y", "--resume-year", type=int, metavar="year", help="continue from this year in the checkpoint, rather than the last")
 
   args = parser.parse_args()
 
   with open(args.config) as config_file:
     params = json.load(config_file)
+  if args.resume:
+    params["resume"] = args.resume
+  if args.resume_year:
+    params["resume_year"] = args.resume_year
   return params
 
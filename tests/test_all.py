@@ -3,12 +3,27 @@
 # Disable "Line too long"
 # pylint: disable=C0301
 
+import os
+import sys
+import subprocess
+import tempfile
 import numpy as np
 import pandas as pd
 from unittest import TestCase
 
-from simim.utils import r2, rmse
+from simim.utils import r2, rmse, get_named_values, dist_weighted_sum, DistanceKernel
 import simim.models as models
+import simim.glm as glm
+import simim.cache as cache
+import simim.ensemble as ensemble
+import simim.scenario_builder as scenario_builder
+import simim.synthetic as synthetic
+import simim.data_apis as data_apis
+import simim.simim as simim
+from simim.panel import Panel
+from simim.extrapolation import Extrapolation
+from simim.scenario import Scenario
+from simim.od import OD, SparseOD
 
 # test methods only run if prefixed with "test"
 class Test(TestCase):
@@ -36,9 +51,483 @@ class Test(TestCase):
     self.assertEqual(rmse(x,x), 0.0)
     self.assertEqual(rmse(x,-x), np.sqrt(np.mean(4*x*x)))
 
+  def test_deferred_imports(self):
+    # a headless run shouldn't load plotting or data source packages until they're used (see scripts/benchmark.py for the import time)
+    script = "import sys; import simim.simim, simim.ensemble; " \
+      "print(','.join(m for m in ['matplotlib', 'geopandas', 'contextily', 'spint', 'ukpopulation', 'ukcensusapi', 'requests'] if m in sys.modules))"
+    loaded = subprocess.run([sys.executable, "-c", script], capture_output=True, text=True, check=True).stdout.strip()
+    self.assertEqual(loaded, "")
+
   def test_dataset(self):
     self.assertTrue(len(Test.dataset) == 378*378)
 
+  def test_od(self):
+    od = OD.from_table(Test.dataset, ["MIGRATIONS", "DISTANCE"], origins=["PEOPLE"], destinations=["HOUSEHOLDS", "JOBS"])
+    self.assertEqual(od.n, 378)
+    self.assertEqual(len(od), 378*378)
+    # rows are in the same (D then O) order as the sorted dataset
+    for col in ["O_GEOGRAPHY_CODE", "D_GEOGRAPHY_CODE", "MIGRATIONS", "DISTANCE", "PEOPLE", "HOUSEHOLDS"]:
+      self.assertTrue(np.array_equal(od[col].values, Test.dataset[col].values))
+    self.assertTrue(np.array_equal(od.matrix("MIGRATIONS").sum(axis=1), Test.dataset.groupby("O_GEOGRAPHY_CODE").MIGRATIONS.sum().values))
+    self.assertEqual(od.matrix("HOUSEHOLDS").shape, (378, 378))
+    self.assertFalse(od.hasnans)
+
+    # factors are looked up by geography code, missing values are NaN
+    od.set_factors(pd.DataFrame({"GEOGRAPHY_CODE": od.geogs[:-1], "X": 1.0}), ["X"])
+    self.assertTrue(np.all(od.zones("O_X")[:-1] == 1.0))
+    self.assertTrue(np.isnan(od.zones("D_X")[-1]))
+    self.assertTrue(od.hasnans)
+
+    # copies share arrays but not columns
+    od2 = od.copy()
+    od2.drop("O_X")
+    od2["Y"] = od2["MIGRATIONS"] * 2
+    self.assertTrue("O_X" in od and "O_X" not in od2)
+    self.assertTrue("Y" in od2 and "Y" not in od)
+
+    with self.assertRaises(ValueError):
+      OD.from_table(Test.dataset.iloc[1:], ["MIGRATIONS"])
+
+  def test_distance_kernel(self):
+    decay = lambda l, d: np.exp(np.log(0.5) / l * d)
+    od = OD.from_table(Test.dataset, ["DISTANCE"], destinations=["JOBS"])
+    table = dist_weighted_sum(Test.dataset[["O_GEOGRAPHY_CODE", "D_GEOGRAPHY_CODE", "DISTANCE", "JOBS"]].copy(), "JOBS", 20.0, decay)
+    dist_weighted_sum(od, "JOBS", 20.0, decay)
+    self.assertTrue(np.allclose(od["JOBS_DISTWEIGHTED"].values, table.JOBS_DISTWEIGHTED.values))
+
+    # several half-distances at once, same as individually
+    kernel = DistanceKernel(od.matrix("DISTANCE"), od.geogs, [10.0, 20.0, 40.0], decay)
+    weighted = kernel(od.zones("JOBS"))
+    self.assertEqual(weighted.shape, (od.n, 3))
+    self.assertTrue(np.allclose(weighted[:, 1], od.zones("JOBS_DISTWEIGHTED")))
+    self.assertTrue(np.all(weighted[:, 0] < weighted[:, 1]) and np.all(weighted[:, 1] < weighted[:, 2]))
+    with self.assertRaises(ValueError):
+      DistanceKernel(od.matrix("DISTANCE"), od.geogs, [10.0, 20.0], [decay] * 3)
+    # a precomputed kernel is used for the matching half-distance and decay, and can't be used for others
+    dist_weighted_sum(od, "JOBS", 40.0, decay, kernel=kernel)
+    self.assertTrue(np.allclose(od.zones("JOBS_DISTWEIGHTED"), weighted[:, 2]))
+    with self.assertRaises(ValueError):
+      dist_weighted_sum(od, "JOBS", 30.0, decay, kernel=kernel)
+    with self.assertRaises(ValueError):
+      dist_weighted_sum(od, "JOBS", 20.0, lambda l, d: decay(l, d), kernel=kernel)
+
+  def test_scenario(self):
+    od = OD.from_table(Test.dataset, ["DISTANCE"], destinations=["HOUSEHOLDS", "JOBS"])
+    with tempfile.TemporaryDirectory() as tmp:
+      filename = os.path.join(tmp, "scenario.csv")
+      # a gap in the timeline, and zones that aren't in every year
+      pd.DataFrame({"GEOGRAPHY_CODE": [od.geogs[0], od.geogs[1], od.geogs[1], od.geogs[2]],
+                    "YEAR": [2020, 2020, 2022, 2022],
+                    "HOUSEHOLDS": [100, 200, 50, 300], "CUM_HOUSEHOLDS": [100, 200, 250, 300],
+                    "JOBS": [10, 0, 20, 0], "CUM_JOBS": [10, 0, 20, 0]}).to_csv(filename, index=False)
+      scenario = Scenario(filename, ["HOUSEHOLDS", "JOBS"])
+      table = Test.dataset[["O_GEOGRAPHY_CODE", "D_GEOGRAPHY_CODE", "DISTANCE", "HOUSEHOLDS", "JOBS"]]
+      # the compiled scenario gives the same changes as per-year merges, persisting between and beyond scenario years
+      for year in [2020, 2021, 2022, 2025]:
+        changed = scenario.apply(od.copy(), year)
+        merged = scenario.apply(table, year)
+        for factor in ["HOUSEHOLDS", "JOBS"]:
+          self.assertTrue(np.array_equal(changed["CHANGED_" + factor].values, merged["CHANGED_" + factor].values))
+      self.assertEqual(scenario.cumulative(od.geogs, 2021)["HOUSEHOLDS"][:3].tolist(), [100, 200, 0])
+      self.assertEqual(scenario.cumulative(od.geogs, 2025)["HOUSEHOLDS"][:3].tolist(), [0, 250, 300])
+      with self.assertRaises(ValueError):
+        scenario.apply(od.copy(), 2019)
+
+      # origin factors are changed by the scenario for the origin zone, in both cases
+      od.set_factors(pd.DataFrame({"GEOGRAPHY_CODE": od.geogs, "HOUSEHOLDS": od.zones("HOUSEHOLDS")}), ["HOUSEHOLDS"])
+      scenario = Scenario(filename, ["O_HOUSEHOLDS", "JOBS"])
+      table = od.to_dataframe(["O_GEOGRAPHY_CODE", "D_GEOGRAPHY_CODE", "O_HOUSEHOLDS", "JOBS"])
+      changed = scenario.apply(od.copy(), 2020)
+      merged = scenario.apply(table, 2020)
+      for factor in ["O_HOUSEHOLDS", "JOBS"]:
+        self.assertTrue(np.array_equal(changed["CHANGED_" + factor].values, merged["CHANGED_" + factor].values))
+      self.assertTrue(np.array_equal(changed.zones("CHANGED_O_HOUSEHOLDS")[:3] - od.zones("O_HOUSEHOLDS")[:3], [100, 200, 0]))
+
+  def test_scenario_builder(self):
+    geogs = ["E06000001", "E06000002", "E06000003"]
+    households = pd.DataFrame({"GEOGRAPHY_CODE": np.repeat(geogs[:2], 3), "PROJECTED_YEAR_NAME": np.tile([2019, 2020, 2021], 2),
+                               "HOUSEHOLDS": [100, 110, 130, 200, 200, 240]})
+    change = scenario_builder.annual_change(households, "HOUSEHOLDS")
+    self.assertEqual(change.HOUSEHOLDS.tolist(), [10, 20, 0, 40])
+    # redistribution is zero-sum
+    redist = scenario_builder.redistribute(change, "HOUSEHOLDS", 0.5, geogs[2:])
+    self.assertEqual(redist.groupby("YEAR").HOUSEHOLDS.sum().tolist(), [0, 0])
+    # jobs only change in one zone in the first year but persist
+    jobs = scenario_builder.settlements(geogs[:1], [2020], "JOBS", 1000)
+    with tempfile.TemporaryDirectory() as tmp:
+      filename = os.path.join(tmp, "scenario.csv")
+      built = scenario_builder.write(filename, redist, jobs, scenario_builder.uniform(geogs, [2020, 2021], "HOUSEHOLDS", 60))
+      self.assertEqual(len(built), 6)
+      self.assertEqual(built[built.YEAR == 2021].CUM_HOUSEHOLDS.tolist(), [-5 - 10 + 20, 0 - 20 + 20, 5 + 30 + 20])
+      self.assertEqual(built[built.YEAR == 2021].CUM_JOBS.tolist(), [1000, 0, 0])
+      scenario = Scenario(filename, ["HOUSEHOLDS", "JOBS"])
+      self.assertEqual(scenario.timeline(), [2020, 2021])
+      self.assertEqual(scenario.cumulative(geogs, 2030)["JOBS"].tolist(), [1000, 0, 0])
+
+  def test_synthetic(self):
+    table = synthetic.dataset(50, seed=1)
+    self.assertEqual(list(table.columns), ["MIGRATIONS", "O_GEOGRAPHY_CODE", "D_GEOGRAPHY_CODE", "DISTANCE", "PEOPLE", "HOUSEHOLDS", "JOBS"])
+    self.assertEqual(len(table), 50 * 50)
+    od = OD.from_table(table, ["MIGRATIONS", "DISTANCE"], origins=["PEOPLE"], destinations=["HOUSEHOLDS"])
+    self.assertFalse(od.hasnans)
+    self.assertTrue(np.array_equal(od.matrix("DISTANCE"), od.matrix("DISTANCE").T))
+    self.assertAlmostEqual(od.matrix("MIGRATIONS").sum() / od.zones("PEOPLE").sum(), 0.1, places=2)
+    # the gravity model the flows were generated from is recovered
+    model = models.Model("gravity", "pow", od, "MIGRATIONS", "PEOPLE", "HOUSEHOLDS", "DISTANCE")
+    self.assertTrue(np.allclose(model.impl.params[1:], [0.9, 0.8, -1.5], atol=0.02))
+
+  def test_od_models(self):
+    od = OD.from_table(Test.dataset, ["MIGRATIONS", "DISTANCE"], origins=["PEOPLE"], destinations=["HOUSEHOLDS", "JOBS"])
+    for model_subtype in ["pow", "exp"]:
+      g = models.Model("gravity", model_subtype, Test.dataset, "MIGRATIONS", "PEOPLE", ["HOUSEHOLDS", "JOBS"], "DISTANCE")
+      god = models.Model("gravity", model_subtype, od, "MIGRATIONS", "PEOPLE", ["HOUSEHOLDS", "JOBS"], "DISTANCE")
+      self.assertTrue(np.allclose(g.impl.params, god.impl.params))
+      self.assertTrue("MODEL_MIGRATIONS" in god.dataset and "MODEL_MIGRATIONS" not in od)
+      # per-zone and per-row values give the same result
+      self.assertTrue(rmse(god(od.zones("PEOPLE"), [od.zones("HOUSEHOLDS"), od.zones("JOBS")]), god.impl.yhat) < 1e-10)
+      self.assertTrue(rmse(god(od["PEOPLE"].values, [od["HOUSEHOLDS"].values, od["JOBS"].values]), god.impl.yhat) < 1e-10)
+
+      p = models.Model("production", model_subtype, od, "MIGRATIONS", "O_GEOGRAPHY_CODE", "HOUSEHOLDS", "DISTANCE")
+      self.assertTrue(rmse(p(xd=od.zones("HOUSEHOLDS")), p.impl.yhat) < 1e-10)
+      a = models.Model("attraction", model_subtype, od, "MIGRATIONS", "PEOPLE", "D_GEOGRAPHY_CODE", "DISTANCE")
+      self.assertTrue(rmse(a(xo=od.zones("PEOPLE")), a.impl.yhat) < 1e-10)
+
+      # batched evaluation of K perturbed sets of factors is the same as evaluating each in turn
+      scale = 1.0 + 0.1 * np.random.RandomState(1).rand(4, od.n)
+      people, households, jobs = scale * od.zones("PEOPLE"), scale * od.zones("HOUSEHOLDS"), scale[::-1] * od.zones("JOBS")
+      flows = god.batch(people, [households, jobs])
+      self.assertEqual(flows.shape, (4, len(od)))
+      for k in range(4):
+        self.assertTrue(np.allclose(flows[k], god(people[k], [households[k], jobs[k]])))
+      # per-row values for the table-based model (rows are in D then O order)
+      rows = g.batch(np.tile(people, od.n), [np.repeat(households, od.n, axis=1), np.repeat(jobs, od.n, axis=1)])
+      self.assertTrue(np.allclose(rows, flows))
+      self.assertTrue(np.allclose(p.batch(xd=households)[2], p(xd=households[2])))
+      self.assertTrue(np.allclose(a.batch(xo=people)[3], a(xo=people[3])))
+
+      # flows for a subset of zones
+      full = god(people[0], [households[0], jobs[0]]).reshape((od.n, od.n), order="F")
+      self.assertTrue(np.array_equal(god.block(people[0], [households[0], jobs[0]], destinations=[3, 7]), full[:, [3, 7]]))
+      self.assertTrue(np.array_equal(god.block(people[0], [households[0], jobs[0]], origins=[5]), full[[5], :]))
+      with self.assertRaises(ValueError):
+        g.block(people[0], [households[0], jobs[0]])
+
+  def test_sparse_od(self):
+    od = OD.from_table(Test.dataset, ["MIGRATIONS", "DISTANCE"], origins=["PEOPLE"], destinations=["HOUSEHOLDS", "JOBS"])
+    near = Test.dataset[(Test.dataset.DISTANCE <= 150) | (Test.dataset.O_GEOGRAPHY_CODE == Test.dataset.D_GEOGRAPHY_CODE)]
+    sparse = SparseOD.from_od(od, cutoff=150, far=["MIGRATIONS"])
+    self.assertEqual(len(sparse), len(near))
+    # rows are in the same (D then O) order as the (sorted) dataset
+    for col in ["O_GEOGRAPHY_CODE", "D_GEOGRAPHY_CODE", "MIGRATIONS", "DISTANCE", "PEOPLE", "HOUSEHOLDS"]:
+      self.assertTrue(np.array_equal(sparse[col].values, near[col].values))
+    # migrations beyond the cutoff are retained by origin
+    self.assertTrue(np.array_equal(sparse.outflows("MIGRATIONS"), od.outflows("MIGRATIONS")))
+    self.assertTrue(np.array_equal(sparse.matrix("MIGRATIONS").toarray()[sparse.o, sparse.d], near.MIGRATIONS.values))
+    table = SparseOD.from_table(near, ["MIGRATIONS", "DISTANCE"], origins=["PEOPLE"], destinations=["HOUSEHOLDS"])
+    self.assertTrue(np.array_equal(table.keys, sparse.keys) and np.array_equal(table.zones("PEOPLE"), od.zones("PEOPLE")))
+    table.set_pair_table("MIGRATIONS", Test.dataset, "MIGRATIONS")
+    self.assertTrue(np.array_equal(table.outflows("MIGRATIONS"), od.outflows("MIGRATIONS")))
+
+    # the models are the same as those fitted to the truncated dataset
+    for model_type, xo_col, xd_col in [("gravity", "PEOPLE", "HOUSEHOLDS"), ("production", "O_GEOGRAPHY_CODE", "HOUSEHOLDS"), ("attraction", "PEOPLE", "D_GEOGRAPHY_CODE")]:
+      t = models.Model(model_type, "pow", near.copy(), "MIGRATIONS", xo_col, xd_col, "DISTANCE")
+      s = models.Model(model_type, "pow", sparse, "MIGRATIONS", xo_col, xd_col, "DISTANCE")
+      self.assertTrue(np.allclose(t.impl.params, s.impl.params))
+      xo = od.zones("PEOPLE") if model_type != "production" else None
+      xd = od.zones("HOUSEHOLDS") if model_type != "attraction" else None
+      self.assertTrue(rmse(s(xo, xd), s.impl.yhat) < 1e-10)
+    with self.assertRaises(ValueError):
+      s.block(xo, xd, destinations=[0])
+
+    dist_weighted_sum(sparse, "JOBS", 20.0, simim._decay)
+    weighted = dist_weighted_sum(near[["O_GEOGRAPHY_CODE", "D_GEOGRAPHY_CODE", "DISTANCE", "JOBS"]].copy(), "JOBS", 20.0, simim._decay)
+    self.assertTrue(np.allclose(sparse["JOBS_DISTWEIGHTED"].values, weighted.JOBS_DISTWEIGHTED.values))
+
+    # flows are aggregated by origin and destination over the stored pairs
+    movers = pd.DataFrame({"MIGRATION_RATE": np.full(od.n, 0.1)}, index=od.geogs)
+    s.dataset["CHANGED_MIGRATIONS"] = s.dataset["MODEL_MIGRATIONS"].values * 1.1
+    delta = simim._dense_delta(s, movers)
+    self.assertTrue(np.allclose(delta.o_delta, -np.bincount(sparse.o, s.impl.yhat, od.n)))
+    self.assertTrue(np.allclose(delta.d_delta, -np.bincount(sparse.d, s.impl.yhat, od.n)))
+
+    # from zone centroids, without the full distance matrix
+    zones = synthetic.zones(200)
+    dense = synthetic.od(200)
+    for cutoff, neighbours in [(50.0, None), (None, 10), (50.0, 10)]:
+      sparse = SparseOD.neighbourhood(zones.GEOGRAPHY_CODE.values, zones.EASTING.values, zones.NORTHING.values, cutoff, neighbours)
+      expected = SparseOD.from_od(dense, cutoff, neighbours)
+      self.assertTrue(np.array_equal(sparse.keys, expected.keys))
+      self.assertTrue(np.allclose(sparse["DISTANCE"].values, expected["DISTANCE"].values))
+    with self.assertRaises(ValueError):
+      SparseOD.neighbourhood(zones.GEOGRAPHY_CODE.values, zones.EASTING.values, zones.NORTHING.values)
+
+  def test_delta(self):
+    od = OD.from_table(Test.dataset, ["MIGRATIONS", "DISTANCE"], origins=["PEOPLE"], destinations=["HOUSEHOLDS"])
+    movers = pd.DataFrame({"MIGRATION_RATE": 0.05 + 0.1 * np.random.RandomState(0).rand(od.n)}, index=od.geogs)
+    households = od.zones("HOUSEHOLDS").astype(float)
+    households[[3, 7]] *= 1.5
+    for dataset in [Test.dataset, od]:
+      model = models.Model("gravity", "pow", dataset, "MIGRATIONS", "PEOPLE", "HOUSEHOLDS", "DISTANCE")
+      # per-row values, in D then O order
+      model.dataset["CHANGED_MIGRATIONS"] = model(od["PEOPLE"].values, np.repeat(households, od.n))
+      dense = simim._dense_delta(model, movers)
+      self.assertTrue(np.array_equal(dense.lad16cd.values, od.geogs))
+      self.assertTrue(np.allclose(dense.net_delta, dense.o_delta - dense.d_delta))
+    # only the changed destinations are re-evaluated, with the same result
+    sparse, (dests, _) = simim._sparse_delta(model, movers, od.zones("PEOPLE"), [od.zones("HOUSEHOLDS")], [households])
+    self.assertEqual(dests.tolist(), [3, 7])
+    for col in ["o_delta", "d_delta", "net_delta"]:
+      self.assertTrue(np.allclose(sparse[col], dense[col]))
+
+  def test_rebase(self):
+    od = OD.from_table(Test.dataset, ["MIGRATIONS", "DISTANCE"], origins=["PEOPLE"], destinations=["HOUSEHOLDS", "JOBS"])
+    for model_type, xo, xd in [("gravity", "PEOPLE", "HOUSEHOLDS"), ("production", "O_GEOGRAPHY_CODE", "HOUSEHOLDS")]:
+      for dataset in [Test.dataset, od]:
+        model = models.Model(model_type, "pow", dataset, "MIGRATIONS", xo, xd, "DISTANCE")
+        params = model.impl.params.copy()
+        # same data reproduces the fit
+        model.rebase(dataset)
+        self.assertTrue(rmse(model.dataset["MODEL_MIGRATIONS"].values, model.impl.yhat) < 1e-10)
+        # changed data is evaluated with the existing calibration
+        changed = dataset.copy()
+        if isinstance(changed, OD):
+          changed.set_destination("HOUSEHOLDS", changed.zones("HOUSEHOLDS") * 1.1)
+        else:
+          changed["HOUSEHOLDS"] = changed.HOUSEHOLDS * 1.1
+        model.rebase(changed)
+        self.assertTrue(np.array_equal(params, model.impl.params))
+        self.assertTrue(np.allclose(model.dataset["MODEL_MIGRATIONS"].values, model.impl.yhat.ravel() * 1.1 ** model.alpha()[0]))
+
+  def test_warm_start(self):
+    for model_type, xo, xd in [("gravity", "PEOPLE", ["HOUSEHOLDS", "JOBS"]), 
+                               ("production", "O_GEOGRAPHY_CODE", ["HOUSEHOLDS", "JOBS"]),
+                               ("attraction", "PEOPLE", "D_GEOGRAPHY_CODE")]:
+      cold = models.Model(model_type, "pow", Test.dataset, "MIGRATIONS", xo, xd, "DISTANCE")
+      warm = models.Model(model_type, "pow", Test.dataset, "MIGRATIONS", xo, xd, "DISTANCE", init=cold)
+      self.assertTrue(isinstance(warm.impl, glm.Fit))
+      # spint's stopping criterion is looser so only approximate agreement is expected
+      self.assertTrue(np.allclose(warm.impl.params, cold.impl.params, atol=0.01))
+      self.assertTrue(abs(warm.impl.pseudoR2 - cold.impl.pseudoR2) < 1e-6)
+      self.assertTrue(rmse(warm(xo=get_named_values(warm.dataset, xo), xd=get_named_values(warm.dataset, xd)), warm.impl.yhat) < 1e-8)
+      # restarting from the converged solution
+      rewarm = models.Model(model_type, "pow", Test.dataset, "MIGRATIONS", xo, xd, "DISTANCE", init=warm.impl.params)
+      self.assertTrue(rewarm.n_iter <= 2)
+      self.assertTrue(np.allclose(rewarm.impl.params, warm.impl.params))
+
+    # perturbed data converges faster from the previous solution
+    previous = models.Model("production", "pow", Test.dataset, "MIGRATIONS", "O_GEOGRAPHY_CODE", "HOUSEHOLDS", "DISTANCE")
+    np.random.seed(0)
+    perturbed = Test.dataset.copy()
+    perturbed["HOUSEHOLDS"] = perturbed.HOUSEHOLDS * np.random.uniform(0.99, 1.01, len(perturbed))
+    warm = models.Model("production", "pow", perturbed, "MIGRATIONS", "O_GEOGRAPHY_CODE", "HOUSEHOLDS", "DISTANCE", init=previous)
+    X = glm.design("production", "pow", perturbed[["O_GEOGRAPHY_CODE"]].values, perturbed[["HOUSEHOLDS"]].values, perturbed.DISTANCE.values)
+    cold = glm.irls(perturbed.MIGRATIONS.values, X)
+    self.assertTrue(warm.n_iter < cold.n_iter)
+    self.assertTrue(np.allclose(warm.impl.params, cold.params))
+
+    with self.assertRaises(ValueError):
+      models.Model("gravity", "pow", Test.dataset, "MIGRATIONS", "PEOPLE", "HOUSEHOLDS", "DISTANCE", init=[0.0, 1.0])
+
+  def test_fit_cache(self):
+    with tempfile.TemporaryDirectory() as cache_dir:
+      fit_cache = cache.FitCache(cache_dir)
+      fitted = models.Model("production", "pow", Test.dataset, "MIGRATIONS", "O_GEOGRAPHY_CODE", "HOUSEHOLDS", "DISTANCE", cache=fit_cache)
+      self.assertEqual(len(os.listdir(cache_dir)), 1)
+      cached = models.Model("production", "pow", Test.dataset, "MIGRATIONS", "O_GEOGRAPHY_CODE", "HOUSEHOLDS", "DISTANCE", cache=fit_cache)
+      self.assertTrue(isinstance(cached.impl, glm.Fit))
+      self.assertTrue(np.array_equal(cached.impl.params, fitted.impl.params))
+      self.assertTrue(np.array_equal(cached.impl.yhat, fitted.impl.yhat))
+      self.assertEqual(cached.impl.pseudoR2, fitted.impl.pseudoR2)
+      self.assertEqual(cached.impl.SRMSE, fitted.impl.SRMSE)
+      self.assertEqual(cached.n_iter, fitted.n_iter)
+      self.assertTrue(np.array_equal(cached.dataset["MODEL_MIGRATIONS"].values, fitted.dataset["MODEL_MIGRATIONS"].values))
+
+      # any change to the inputs is a different fit
+      key = lambda data: fit_cache.key("production", "pow", "profiled", "MIGRATIONS", ["O_GEOGRAPHY_CODE"], ["HOUSEHOLDS"], "DISTANCE", data.MIGRATIONS.values,
+        data[["O_GEOGRAPHY_CODE"]].values, data[["HOUSEHOLDS"]].values, data.DISTANCE.values)
+      self.assertIsNotNone(fit_cache.get(key(Test.dataset)))
+      perturbed = Test.dataset.copy()
+      perturbed.loc[perturbed.index[0], "HOUSEHOLDS"] += 1
+      self.assertIsNone(fit_cache.get(key(perturbed)))
+
+      # the least recently used fit is evicted when the cache is full
+      production_file = os.listdir(cache_dir)[0]
+      small_cache = cache.FitCache(cache_dir, max_bytes=os.path.getsize(os.path.join(cache_dir, production_file)) + 1)
+      models.Model("gravity", "pow", Test.dataset, "MIGRATIONS", "PEOPLE", "HOUSEHOLDS", "DISTANCE", cache=small_cache)
+      self.assertEqual(len(os.listdir(cache_dir)), 1)
+      self.assertNotEqual(os.listdir(cache_dir)[0], production_file)
+
+      # tables of input data
+      gva = pd.DataFrame({2014: [1.0, 2.0], 2015: [3.0, 4.0]}, index=pd.Index(["E06000001", "E06000002"], name="GEOGRAPHY_CODE"))
+      jobs = pd.DataFrame({"JOBS": [1.0, 2.0], "JOBS_PER_WORKING_AGE_PERSON": [0.5, 0.6]}, index=gva.index)
+      for table in [gva, jobs]:
+        filename = os.path.join(cache_dir, "table.npz")
+        self.assertIsNone(cache.load_table(filename))
+        cache.save_table(filename, table)
+        self.assertTrue(cache.load_table(filename).equals(table))
+        os.remove(filename)
+
+      # variable-length binary values, e.g. geometries
+      filename = os.path.join(cache_dir, "blobs.npz")
+      self.assertIsNone(cache.load_blobs(filename))
+      cache.save_blobs(filename, ["E06000001", "E06000002", "E06000003"], [b"\x01\x02", b"", b"\x00" * 5], "EPSG:27700")
+      index, blobs, meta = cache.load_blobs(filename)
+      self.assertEqual(list(index), ["E06000001", "E06000002", "E06000003"])
+      self.assertEqual(blobs, [b"\x01\x02", b"", b"\x00" * 5])
+      self.assertEqual(meta, "EPSG:27700")
+
+      # memory-mapped matrices
+      od = OD.from_table(Test.dataset, ["DISTANCE"])
+      filename = os.path.join(cache_dir, "dist.npy")
+      self.assertIsNone(cache.load_matrix(filename, od.geogs))
+      cache.save_matrix(filename, od.matrix("DISTANCE").astype(np.float32), od.geogs)
+      dists = cache.load_matrix(filename, od.geogs)
+      self.assertTrue(isinstance(dists, np.memmap) and not dists.flags.writeable)
+      self.assertEqual(dists.dtype, np.float32)
+      self.assertTrue(np.allclose(dists, od.matrix("DISTANCE")))
+      # a different index is a miss
+      self.assertIsNone(cache.load_matrix(filename, od.geogs[::-1]))
+
+  def test_panel(self):
+    od = OD.from_table(Test.dataset, ["MIGRATIONS", "DISTANCE"])
+    people = Test.dataset.groupby("O_GEOGRAPHY_CODE").PEOPLE.first().reset_index().rename({"O_GEOGRAPHY_CODE": "GEOGRAPHY_CODE"}, axis=1)
+    panel = Panel(od.geogs, [2018, 2020])
+    for year in [2018, 2019, 2020]:
+      panel.set(year, people.assign(PEOPLE=people.PEOPLE + year), Panel.PEOPLE)
+    table = panel.get_people(2019, od.geogs[::-1])
+    self.assertTrue(np.array_equal(table.GEOGRAPHY_CODE.values, od.geogs[::-1]))
+    self.assertTrue(np.array_equal(table.PEOPLE.values, people.set_index("GEOGRAPHY_CODE").PEOPLE.reindex(od.geogs[::-1]).values + 2019))
+    with self.assertRaises(ValueError):
+      panel.get_people(2021, od.geogs)
+
+    # long-format (ukpopulation-style) data, ignoring years and zones outside the panel
+    table = pd.DataFrame({"GEOGRAPHY_CODE": np.tile(np.append(od.geogs[:2], "X"), 4), "PROJECTED_YEAR_NAME": np.repeat([2017, 2018, 2019, 2020], 3), "OBS_VALUE": np.arange(12.0)})
+    panel.set_table(table, "HOUSEHOLDS")
+    self.assertTrue(np.array_equal(panel.data["HOUSEHOLDS"][:, :2], [[3.0, 4.0], [6.0, 7.0], [9.0, 10.0]]))
+    self.assertTrue(np.isnan(panel.data["HOUSEHOLDS"][:, 2:]).all())
+
+    # inputs shared between processes are reconstructed without copying
+    movers = people.set_index("GEOGRAPHY_CODE")
+    arrays, meta = ensemble._flatten(od, movers, panel)
+    blocks, specs = ensemble.share(arrays)
+    try:
+      attached, shared = ensemble.attach(specs)
+      od2, movers2, panel2 = ensemble._unflatten(shared, meta)
+      self.assertTrue(np.array_equal(od2.column("MIGRATIONS"), od.column("MIGRATIONS")))
+      self.assertTrue(np.array_equal(od2.column("O_GEOGRAPHY_CODE"), od.column("O_GEOGRAPHY_CODE")))
+      self.assertFalse(od2.matrix("DISTANCE").flags.writeable)
+      self.assertTrue(movers2.equals(movers.reindex(od.geogs)))
+      self.assertTrue(panel2.get_people(2020, od.geogs).equals(panel.get_people(2020, od.geogs)))
+      del od2, movers2, panel2, shared
+      for block in attached:
+        block.close()
+    finally:
+      for block in blocks:
+        block.close()
+        block.unlink()
+
+    # as are sparse ODs
+    sparse = SparseOD.from_od(od, cutoff=150, far=["MIGRATIONS"])
+    arrays, meta = ensemble._flatten(sparse, movers, panel)
+    blocks, specs = ensemble.share(arrays)
+    try:
+      attached, shared = ensemble.attach(specs)
+      sparse2 = ensemble._unflatten(shared, meta)[0]
+      self.assertTrue(isinstance(sparse2, SparseOD))
+      self.assertTrue(np.array_equal(sparse2.keys, sparse.keys))
+      self.assertTrue(np.array_equal(sparse2.column("MIGRATIONS"), sparse.column("MIGRATIONS")))
+      self.assertTrue(np.array_equal(sparse2.zones("FAR_MIGRATIONS"), sparse.zones("FAR_MIGRATIONS")))
+      del sparse2, shared
+      for block in attached:
+        block.close()
+    finally:
+      for block in blocks:
+        block.close()
+        block.unlink()
+
+  def test_output(self):
+    geogs = np.array(["E06000001", "E06000002", "E06000003"])
+    with tempfile.TemporaryDirectory() as output_dir:
+      params = {"output_dir": output_dir, "model_type": "gravity", "base_projection": "ppp", "scenario": "test.csv"}
+      output = data_apis.Output(params)
+      output.reserve(geogs, [2020, 2021])
+      for year in [2020, 2021, 2022]:
+        # zones in any order, and years beyond those reserved
+        table = pd.DataFrame({"GEOGRAPHY_CODE": geogs[::-1], "PEOPLE": year + np.arange(3.0), "PEOPLE_SNPP": float(year), "net_delta": 1.0, "net_delta_prev": 0.0})
+        output.append_output(table, year)
+      variant = output.custom_snpp_variant
+      self.assertEqual(list(variant.columns), ["GEOGRAPHY_CODE", "PEOPLE", "PEOPLE_SNPP", "net_delta", "PROJECTED_YEAR_NAME"])
+      self.assertEqual(list(variant.PROJECTED_YEAR_NAME), [2020] * 3 + [2021] * 3 + [2022] * 3)
+      self.assertEqual(list(variant.PEOPLE[variant.PROJECTED_YEAR_NAME == 2022]), [2024.0, 2023.0, 2022.0])
+
+      output.write_output()
+      written = pd.read_csv(output.output_file)
+      self.assertEqual(list(written.columns), ["GEOGRAPHY_CODE", "PEOPLE", "PEOPLE_SNPP", "PROJECTED_YEAR_NAME"])
+      self.assertTrue(np.array_equal(written.PEOPLE.values, variant.PEOPLE.values))
+
+      with self.assertRaises(ValueError):
+        output.append_output(pd.DataFrame({"GEOGRAPHY_CODE": ["E06000004"], "PEOPLE": [1.0], "PEOPLE_SNPP": [1.0], "net_delta": [0.0]}), 2020)
+      with self.assertRaises(ValueError):
+        data_apis.Output(dict(params, output_format="xlsx"))
+      # runs that differ only in their configuration have different outputs
+      self.assertNotEqual(data_apis.Output(dict(params, attractors=["D_JOBS"])).output_file, output.output_file)
+      self.assertTrue(data_apis.Output(dict(params, output_format="parquet")).output_file.endswith(".parquet"))
+
+      # checkpoint after 2021 and restore into a run to 2023
+      params.update(start_year=2020, end_year=2023)
+      filename = simim.checkpoint_file(output)
+      simim.save_checkpoint(filename, params, output, 2021, np.array([[1.0, 2.0], [np.nan, np.nan], [3.0, 4.0]]))
+      resumed = data_apis.Output(params)
+      resumed.reserve(geogs, [2020, 2023])
+      year, fits = simim.load_checkpoint(filename, params, resumed)
+      self.assertEqual(year, 2021)
+      self.assertEqual(list(fits), [2020])
+      self.assertTrue(np.array_equal(resumed.custom_snpp_variant.values, variant[variant.PROJECTED_YEAR_NAME <= 2021].values))
+      self.assertEqual(list(simim._carried_over(resumed, 2021).net_delta_prev), [1.0] * 3)
+      # from an earlier year
+      resumed.reserve(geogs, [2020, 2023])
+      self.assertEqual(simim.load_checkpoint(filename, params, resumed, 2020)[0], 2020)
+      with self.assertRaises(ValueError):
+        simim.load_checkpoint(filename, dict(params, model_type="production"), resumed)
+
+  def test_extrapolation(self):
+    # minimal stand-ins for the ukpopulation projections: 2 zones, 2 genders, 3 ages
+    np.random.seed(0)
+    geogs = ["E07000001", "E07000002"]
+    snpp = pd.DataFrame([(g, s, a, 2041, np.random.uniform(100, 200)) for g in geogs for s in [1, 2] for a in range(3)],
+      columns=["GEOGRAPHY_CODE", "GENDER", "C_AGE", "PROJECTED_YEAR_NAME", "OBS_VALUE"])
+    npp = pd.DataFrame([("E92000001", s, a, y, 1000 * (1 + 0.01 * a) ** (y - 2041)) for s in [1, 2] for a in range(3) for y in range(2041, 2051)],
+      columns=["GEOGRAPHY_CODE", "GENDER", "C_AGE", "PROJECTED_YEAR_NAME", "OBS_VALUE"])
+    snhp = pd.DataFrame({"GEOGRAPHY_CODE": geogs * 2, "PROJECTED_YEAR_NAME": [2040, 2040, 2041, 2041], "OBS_VALUE": [10.0, 20.0, 12.0, 21.0]})
+    class Source:
+      def __init__(self): self.calls = 0
+      def max_year(self, country): return 2041
+      def filter(self, geogs, year):
+        self.calls += 1
+        return snpp[snpp.GEOGRAPHY_CODE.isin(geogs) & (snpp.PROJECTED_YEAR_NAME == year)]
+      def detail(self, variant, country, years):
+        self.calls += 1
+        return npp[npp.PROJECTED_YEAR_NAME.isin(years)]
+      def aggregate(self, geogs, years):
+        self.calls += 1
+        return snhp[snhp.GEOGRAPHY_CODE.isin(geogs) & snhp.PROJECTED_YEAR_NAME.isin(years)]
+    source = Source()
+    extrapolation = Extrapolation(source, source, source)
+
+    people = extrapolation.people("en", geogs, [2045, 2050]).set_index(["PROJECTED_YEAR_NAME", "GEOGRAPHY_CODE"]).OBS_VALUE
+    for year in [2045, 2050]:
+      expected = (snpp.OBS_VALUE * (1 + 0.01 * snpp.C_AGE) ** (year - 2041)).groupby(snpp.GEOGRAPHY_CODE).sum()
+      self.assertTrue(np.allclose(people[year].reindex(geogs).values, expected.reindex(geogs).values))
+    households = extrapolation.households("en", geogs, [2042, 2045]).set_index(["PROJECTED_YEAR_NAME", "GEOGRAPHY_CODE"]).OBS_VALUE
+    self.assertTrue(np.allclose(households[2042].reindex(geogs).values, [14.0, 22.0]))
+    self.assertTrue(np.allclose(households[2045].reindex(geogs).values, [20.0, 25.0]))
+
+    # base data is only queried once, single years are also supported
+    calls = source.calls
+    self.assertTrue(np.allclose(extrapolation.people("en", geogs, 2045).OBS_VALUE.values, people[2045].values))
+    self.assertEqual(len(extrapolation.households("en", geogs, 2046)), 2)
+    self.assertEqual(source.calls, calls)
+
   # basic tests of model functionality
   def test_models(self):
     g = models.Model("gravity", "pow", Test.dataset, "MIGRATIONS", "PEOPLE", "HOUSEHOLDS", "DISTANCE")
@@ -139,6 +628,69 @@ class Test(TestCase):
       Test.dataset.loc[Test.dataset.D_GEOGRAPHY_CODE == "E07000178", "J_CHANGED"] = Test.dataset.loc[Test.dataset.D_GEOGRAPHY_CODE == "E07000178", "JOBS"] + 300000 
       self.assertTrue(rmse(production(xd=[Test.dataset.HH_CHANGED.values, Test.dataset.HH_CHANGED.values]), production.impl.yhat) > 1.0)
 
+  def test_production_solver(self):
+    from spint import Production
+    y, xo, xd, cost = Test.dataset.MIGRATIONS.values, Test.dataset[["O_GEOGRAPHY_CODE"]].values, Test.dataset[["HOUSEHOLDS", "JOBS"]].values, Test.dataset.DISTANCE.values
+    for model_subtype in ["pow", "exp"]:
+      fit = glm.production(y, xo, xd, cost, model_subtype)
+      # the same solution as with the origin dummies, and as spint (to within its looser tolerance)
+      full = glm.irls(y, glm.design("production", model_subtype, xo, xd, cost))
+      self.assertTrue(np.allclose(fit.params, full.params, atol=1e-8))
+      self.assertTrue(np.allclose(fit.params, Production(y, xo, xd, cost, model_subtype).params, atol=0.02))
+      # origin totals are reproduced exactly
+      self.assertTrue(np.allclose(np.bincount(pd.factorize(xo.ravel(), sort=True)[0], fit.yhat), Test.dataset.groupby("O_GEOGRAPHY_CODE").MIGRATIONS.sum().values))
+      self.assertEqual(glm.production(y, xo, xd, cost, model_subtype, fit.params).n_iter, 1)
+    with self.assertRaises(ValueError):
+      glm.production(np.where(Test.dataset.O_GEOGRAPHY_CODE == "E07000178", 0, y), xo, xd, cost, "pow")
+
+  def test_sparse_irls(self):
+    from spint import Attraction
+    y, xo, xd, cost = Test.dataset.MIGRATIONS.values, Test.dataset[["PEOPLE"]].values, Test.dataset[["D_GEOGRAPHY_CODE"]].values, Test.dataset.DISTANCE.values
+    for model_subtype in ["pow", "exp"]:
+      # the same solution as the dense least-squares steps (for a subset of the destinations)...
+      X = glm.design("attraction", model_subtype, xo[:50 * 378], xd[:50 * 378], cost[:50 * 378])
+      self.assertTrue(np.allclose(glm.irls(y[:50 * 378], X).params, glm.irls(y[:50 * 378], X.toarray()).params, atol=1e-8))
+      # ...and as spint (to within its looser tolerance)
+      fit = glm.irls(y, glm.design("attraction", model_subtype, xo, xd, cost))
+      self.assertTrue(np.allclose(fit.params, Attraction(y, xd, xo, cost, model_subtype).params, atol=0.02))
+      attraction = models.Model("attraction", model_subtype, Test.dataset, "MIGRATIONS", "PEOPLE", "D_GEOGRAPHY_CODE", "DISTANCE")
+      self.assertTrue(isinstance(attraction.impl, glm.Fit))
+      self.assertTrue(np.allclose(attraction.impl.params, fit.params))
+
+  def test_doubly(self):
+    y, xo, xd, cost = Test.dataset.MIGRATIONS.values, Test.dataset[["O_GEOGRAPHY_CODE"]].values, Test.dataset[["D_GEOGRAPHY_CODE"]].values, Test.dataset.DISTANCE.values
+    od = OD.from_table(Test.dataset, ["MIGRATIONS", "DISTANCE"])
+    for model_subtype in ["pow", "exp"]:
+      fit = glm.doubly(y, xo, xd, cost, model_subtype)
+      # the same solution as with the origin and destination dummies
+      self.assertTrue(np.allclose(fit.params, glm.irls(y, glm.design("doubly", model_subtype, xo, xd, cost)).params, atol=1e-6))
+      # origin and destination totals are reproduced
+      self.assertTrue(np.allclose(od.outflows("MIGRATIONS"), fit.yhat.reshape((od.n, od.n)).sum(axis=0)))
+      self.assertTrue(np.allclose(od.matrix("MIGRATIONS").sum(axis=0), fit.yhat.reshape((od.n, od.n)).sum(axis=1)))
+      self.assertTrue(glm.doubly(y, xo, xd, cost, model_subtype, fit.params).n_iter < fit.n_iter)
+      # (sparsely) balanced in any row order
+      order = np.random.RandomState(0).permutation(len(y))
+      self.assertTrue(np.allclose(glm.doubly(y[order], xo[order], xd[order], cost[order], model_subtype).params, fit.params))
+      for dataset in [Test.dataset, od]:
+        model = models.Model("doubly", model_subtype, dataset, "MIGRATIONS", "O_GEOGRAPHY_CODE", "D_GEOGRAPHY_CODE", "DISTANCE")
+        self.assertTrue(np.allclose(model.impl.params, fit.params))
+        self.assertTrue(rmse(model(), model.impl.yhat) < 1e-8)
+
+    # beyond a distance cutoff
+    sparse = SparseOD.from_od(od, cutoff=150)
+    model = models.Model("doubly", "pow", sparse, "MIGRATIONS", "O_GEOGRAPHY_CODE", "D_GEOGRAPHY_CODE", "DISTANCE")
+    self.assertTrue(rmse(model(), model.impl.yhat) < 1e-8)
+    self.assertTrue(np.allclose(np.bincount(sparse.d, model.impl.yhat), np.bincount(sparse.d, sparse["MIGRATIONS"].values)))
+
+    flows = np.array([[1.0, 2.0], [3.0, 1.0]])
+    a, b, _ = glm.furness(flows, np.array([5.0, 3.0]), np.array([4.0, 4.0]))
+    self.assertTrue(np.allclose((b[:, np.newaxis] * flows * a).sum(axis=0), [5.0, 3.0]))
+    self.assertTrue(np.allclose((b[:, np.newaxis] * flows * a).sum(axis=1), [4.0, 4.0]))
+    with self.assertRaises(RuntimeError):
+      glm.furness(od.matrix("DISTANCE") ** -2.0, od.outflows("MIGRATIONS"), od.matrix("MIGRATIONS").sum(axis=0), max_iter=2)
+    with self.assertRaises(ValueError):
+      glm.doubly(y, xo, xd, cost, "pow", [0.0, -1.0])
+
   def test_attraction(self):
     # single factor prod
     for model_subtype in ["pow", "exp"]: